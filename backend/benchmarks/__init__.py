@@ -0,0 +1,71 @@
+"""
+Benchmarks of the trivia API.
+
+Every benchmark generates a synthetic question bank (see datagen.py) in
+a sqlite file, or in the database given with --database-uri, and runs
+from the backend folder, e.g.:
+
+    python -m benchmarks.bench_search --sizes 10000 100000
+"""
+# third-party imports
+import json
+import os
+import tempfile
+
+# default folder of the generated sqlite databases
+BENCHMARK_DIR = os.environ.get(
+    'BENCHMARK_DIR', os.path.join(tempfile.gettempdir(), 'trivia_bench'))
+
+
+# method for building the sqlite uri of a generated database
+def sqlite_uri(name):
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    return 'sqlite:///' + os.path.join(BENCHMARK_DIR, name + '.db')
+
+
+'''
+create_benchmark_app(database_uri, **settings)
+    creates the application in testing mode on `database_uri`,
+    `settings` override the configuration values
+'''
+
+
+def create_benchmark_app(database_uri, **settings):
+    from flaskr import create_app
+    settings['SQLALCHEMY_DATABASE_URI'] = database_uri
+    settings.setdefault('SQLALCHEMY_ECHO', False)
+    return create_app('testing', settings=settings)
+
+
+# method for the nearest-rank percentile of sorted samples
+def percentile(samples, rank):
+    if not samples:
+        return None
+    index = max(0, int(round(rank / 100.0 * len(samples))) - 1)
+    return samples[min(index, len(samples) - 1)]
+
+
+'''
+summarize(samples)
+    latency summary of timings in seconds, reported in milliseconds
+'''
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'mean_ms': round(total / len(samples) * 1000, 3),
+        'throughput_rps': round(len(samples) / total, 1) if total else None,
+    }
+
+
+# method for writing benchmark results as a diffable json file
+def write_results(path, results):
+    with open(path, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
@@ -0,0 +1,195 @@
+"""
+Load test of the admission control: tail latency of a well-behaved
+client while another client floods the search.
+
+    python -m benchmarks.bench_admission --abuse-rate 200 --seconds 10
+
+The application runs in a threaded server in its own process. The
+abusive client sends --abuse-rate searches per second from 127.0.0.2,
+with --abusers threads in another process (as many as its clients on
+one host can sustain, without admission control the server falls
+behind), the well-behaved one pages through the questions and plays
+quizzes from 127.0.0.1 at a steady pace. Each mode reports the latency
+of the well-behaved client and the responses of the abusive one:
+without abuse, under abuse without admission control and under abuse
+with it.
+"""
+# third-party imports
+from collections import Counter
+import argparse
+import http.client
+import json
+import multiprocessing
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+# local imports
+from benchmarks import (create_benchmark_app, sqlite_uri, summarize,
+                        write_results)
+from benchmarks.datagen import WORDS, populate
+
+# run in a fresh process, serves the application until killed
+SERVER = '''
+import json, sys
+from werkzeug.serving import make_server
+from flaskr import create_app
+app = create_app('testing', settings=json.loads(sys.argv[1]))
+server = make_server('127.0.0.1', int(sys.argv[2]), app, threaded=True)
+print('ready', flush=True)
+server.serve_forever()
+'''
+
+
+# method for a free TCP port of the loopback interface
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+# method for sending a JSON request, returns the status
+def send(port, method, path, body=None, source='127.0.0.1'):
+    connection = http.client.HTTPConnection(
+        '127.0.0.1', port, timeout=30, source_address=(source, 0))
+    try:
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def abuse(port, threads, rate, stop, statuses):
+    """Floods the search from 127.0.0.2 until `stop` is set"""
+    counts = Counter()
+    lock = threading.Lock()
+
+    def flood(seed):
+        generator = random.Random(seed)
+        interval = threads / rate
+        next_at = time.perf_counter()
+        while not stop.is_set():
+            next_at += interval
+            time.sleep(max(0, next_at - time.perf_counter()))
+            status = send(port, 'POST', '/questions/search',
+                          {'searchTerm': generator.choice(WORDS)},
+                          source='127.0.0.2')
+            with lock:
+                counts[status] += 1
+
+    workers = [threading.Thread(target=flood, args=(seed,))
+               for seed in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    statuses.put(dict(counts))
+
+
+def behave(port, seconds, rate, size):
+    """Latency samples of a client sending `rate` requests per second"""
+    generator = random.Random(0)
+    samples = {'GET /questions': [], 'POST /quizzes': []}
+    statuses = Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        if generator.random() < 0.5:
+            route = 'GET /questions'
+            status = send(port, 'GET', '/questions?page={}'.format(
+                generator.randint(1, size // 10)))
+        else:
+            route = 'POST /quizzes'
+            status = send(port, 'POST', '/quizzes', {
+                'previous_questions': [],
+                'quiz_category': {'type': 'click', 'id': 0}})
+        elapsed = time.perf_counter() - started
+        samples[route].append(elapsed)
+        statuses[status] += 1
+        time.sleep(max(0, 1.0 / rate - elapsed))
+    results = {route: summarize(values) for route, values in samples.items()}
+    results['statuses'] = dict(statuses)
+    return results
+
+
+def run_mode(database_uri, settings, abusive, args):
+    port = free_port()
+    settings = dict(settings, SQLALCHEMY_DATABASE_URI=database_uri,
+                    SQLALCHEMY_ECHO=False, INSTRUMENTATION_ENABLED=False,
+                    HTTP_CACHE_BACKEND='none', SEARCH_BACKEND='ilike')
+    server = subprocess.Popen(
+        [sys.executable, '-c', SERVER, json.dumps(settings), str(port)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        server.stdout.readline()
+        stop = multiprocessing.Event()
+        statuses = multiprocessing.Queue()
+        abuser = None
+        if abusive:
+            abuser = multiprocessing.Process(
+                target=abuse, args=(port, args.abusers, args.abuse_rate,
+                                    stop, statuses))
+            abuser.start()
+            # let the flood build up before measuring
+            time.sleep(1)
+        results = behave(port, args.seconds, args.rate, args.questions)
+        if abuser is not None:
+            stop.set()
+            results['abuser_statuses'] = statuses.get()
+            abuser.join()
+        return results
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--abusers', type=int, default=8,
+                        help='threads of the abusive client')
+    parser.add_argument('--abuse-rate', type=float, default=200,
+                        help='searches per second of the abusive client')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--rate', type=float, default=20,
+                        help='requests per second of the good client')
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--output', default='bench_admission.json')
+    args = parser.parse_args()
+
+    database_uri = args.database_uri or sqlite_uri(
+        'admission_{}'.format(args.questions))
+    populate(create_benchmark_app(database_uri), args.questions, 6)
+
+    modes = (
+        ('no abuse', True, False),
+        ('abuse, unlimited', False, True),
+        ('abuse, limited', True, True),
+    )
+    results = {}
+    for mode, enabled, abusive in modes:
+        results[mode] = run_mode(database_uri,
+                                 {'RATE_LIMIT_ENABLED': enabled}, abusive,
+                                 args)
+        print('{:>16}  GET /questions p50 {:>8} ms  p99 {:>8} ms  '
+              'POST /quizzes p50 {:>8} ms  p99 {:>8} ms  abuser {}'.format(
+                  mode, results[mode]['GET /questions']['p50_ms'],
+                  results[mode]['GET /questions']['p99_ms'],
+                  results[mode]['POST /quizzes']['p50_ms'],
+                  results[mode]['POST /quizzes']['p99_ms'],
+                  results[mode].get('abuser_statuses', '-')))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Latency and throughput of every API route at several dataset sizes.
+
+    python -m benchmarks.bench_api --sizes 1000 10000 100000 \
+        --output bench_api.json
+
+Requests go through the WSGI test client, so the numbers cover routing,
+queries and serialisation without network overhead. The response cache
+is disabled unless --with-cache is given. Compare two result files with
+benchmarks.compare to catch scaling regressions.
+"""
+# third-party imports
+import argparse
+import random
+import time
+
+# local imports
+from benchmarks import (create_benchmark_app, sqlite_uri, summarize,
+                        write_results)
+from benchmarks.datagen import WORDS, populate
+
+# scenarios that are not warmed up
+WRITES = ('POST /questions', 'DELETE /questions/<id>')
+
+
+# method for timing `requests` calls of `send(client, index)`
+def time_route(client, send, requests):
+    samples = []
+    for index in range(requests):
+        started = time.perf_counter()
+        response = send(client, index)
+        samples.append(time.perf_counter() - started)
+        if response.status_code >= 500:
+            raise RuntimeError('{} {}'.format(response.status_code,
+                                              response.get_data(True)))
+    return summarize(samples)
+
+
+'''
+scenarios(size, categories, generator)
+    (name, send) of every measured request, in the order they run: the
+    writes come last and delete what they created
+'''
+
+
+def scenarios(size, categories, generator):
+    last_page = max(1, size // 10)
+    created = []
+    new_question = {'question': 'Which benchmark wrote this question?',
+                    'answer': 'bench_api', 'category': 1,
+                    'difficulty': 3, 'rating': 3}
+
+    def start_session(client):
+        return client.post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'Category 1', 'id': 1}}).get_json()
+
+    sessions = []
+
+    def next_in_session(client, index):
+        if not sessions or index % 20 == 0:
+            sessions.append(start_session(client)['session_id'])
+        return client.post('/quizzes/sessions/{}/next'.format(sessions[-1]))
+
+    decks = []
+
+    def next_in_deck(client, index):
+        if not decks or index % 20 == 0:
+            decks.append(client.post('/quizzes/decks', json={
+                'quiz_category': {'type': 'Category 1', 'id': 1}}
+            ).get_json()['deck_id'])
+        return client.get('/quizzes/decks/{}/{}'.format(
+            decks[-1], index % 20))
+
+    def create(client, index):
+        response = client.post('/questions', json=new_question)
+        created.append(response.get_json()['created'])
+        return response
+
+    def delete(client, index):
+        return client.delete('/questions/{}'.format(created.pop()))
+
+    return [
+        ('GET /categories', lambda client, index: client.get('/categories')),
+        ('GET /questions', lambda client, index: client.get(
+            '/questions?page={}'.format(generator.randint(1, 10)))),
+        ('GET /questions deep page', lambda client, index: client.get(
+            '/questions?page={}'.format(last_page))),
+        ('GET /questions after_id', lambda client, index: client.get(
+            '/questions?after_id={}'.format(size - 10))),
+        ('GET /categories/<id>/questions', lambda client, index: client.get(
+            '/categories/{}/questions'.format(
+                generator.randint(1, categories)))),
+        ('POST /questions/search', lambda client, index: client.post(
+            '/questions/search',
+            json={'searchTerm': generator.choice(WORDS)})),
+        ('GET /stats', lambda client, index: client.get('/stats')),
+        ('GET /questions/suggest', lambda client, index: client.get(
+            '/questions/suggest?q={}'.format(
+                generator.choice(WORDS)[:generator.randint(1, 4)]))),
+        ('POST /quizzes', lambda client, index: client.post(
+            '/quizzes', json={
+                'previous_questions': generator.sample(
+                    range(1, size + 1), min(size, 20)),
+                'quiz_category': {'type': 'Category 1', 'id': 1}})),
+        ('POST /quizzes adaptive', lambda client, index: client.post(
+            '/quizzes', json={
+                'previous_questions': generator.sample(
+                    range(1, size + 1), min(size, 20)),
+                'correct_answers': generator.randint(0, min(size, 20)),
+                'mode': 'adaptive',
+                'quiz_category': {'type': 'Category 1', 'id': 1}})),
+        ('POST /quizzes all categories', lambda client, index: client.post(
+            '/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'type': 'click', 'id': 0}})),
+        ('POST /quizzes malformed', lambda client, index: client.post(
+            '/quizzes', json={
+                'previous_questions': ['one'],
+                'quiz_category': {'type': 'Category 1', 'id': 1}})),
+        ('POST /quizzes/sessions/<id>/next', next_in_session),
+        ('GET /quizzes/decks/<id>/<offset>', next_in_deck),
+        ('PATCH /questions/<id>', lambda client, index: client.patch(
+            '/questions/{}'.format(generator.randint(1, size)),
+            json={'rating': generator.randint(1, 5)})),
+        ('PATCH /questions 50 ratings', lambda client, index: client.patch(
+            '/questions', json={'ratings': [
+                {'id': generator.randint(1, size),
+                 'rating': generator.randint(1, 5)} for _ in range(50)]})),
+        ('POST /questions', create),
+        ('DELETE /questions/<id>', delete),
+    ]
+
+
+def run(size, categories, database_uri, requests, with_cache):
+    settings = {}
+    if not with_cache:
+        settings['HTTP_CACHE_BACKEND'] = 'none'
+    app = create_benchmark_app(database_uri, **settings)
+    populate(app, size, categories)
+    client = app.test_client()
+    generator = random.Random(size)
+    results = {}
+    for name, send in scenarios(size, categories, generator):
+        # one untimed request warms up caches and in-process indexes,
+        # the create and delete requests must stay paired
+        if name not in WRITES:
+            send(client, 0)
+        results[name] = time_route(client, send, requests)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and size')
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--with-cache', action='store_true')
+    parser.add_argument('--output', default='bench_api.json')
+    args = parser.parse_args()
+
+    results = {
+        'parameters': {'categories': args.categories,
+                       'requests': args.requests,
+                       'with_cache': args.with_cache},
+        'sizes': {},
+    }
+    for size in args.sizes:
+        database_uri = args.database_uri or sqlite_uri('api_{}'.format(size))
+        results['sizes'][str(size)] = run(
+            size, args.categories, database_uri, args.requests,
+            args.with_cache)
+        for name, summary in results['sizes'][str(size)].items():
+            print('{:>8} {:34} p50 {:>9} ms  p99 {:>9} ms  {:>8} req/s'
+                  .format(size, name, summary['p50_ms'], summary['p99_ms'],
+                          summary['throughput_rps']))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Throughput of POST /quizzes and POST /questions/search under concurrent
+clients, served by sync Flask workers and by the ASGI application.
+
+    python -m benchmarks.bench_asgi --questions 100000 --clients 1 16 64 \
+        --database-uri postgresql://localhost/trivia_bench
+
+The sync mode serves the clients with --sync-workers threads, like as
+many sync gunicorn workers, the ASGI mode with a single event loop.
+Requests are sent in-process, without network overhead. On sqlite, or
+without asyncpg installed, the native async routes run their queries
+in threads and the comparison says little about postgres.
+"""
+# third-party imports
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+# local imports
+from benchmarks import sqlite_uri, summarize, write_results
+from benchmarks.datagen import WORDS, populate
+
+ROUTES = ('/quizzes', '/questions/search')
+
+
+# method for the body of a request to `path`
+def request_body(path, size, generator):
+    if path == '/quizzes':
+        return {'previous_questions': generator.sample(
+                    range(1, size + 1), min(size, 20)),
+                'quiz_category': {'type': 'Category 1', 'id': 1}}
+    return {'searchTerm': generator.choice(WORDS)}
+
+
+# method for the summary of a run, throughput over the wall time
+def report(samples, elapsed):
+    summary = summarize(samples)
+    summary['throughput_rps'] = round(len(samples) / elapsed, 1)
+    return summary
+
+
+def run_sync(app, path, size, clients, requests, workers):
+    generator = random.Random(clients)
+    # a client waits for one of the sync workers to be free
+    free_workers = threading.BoundedSemaphore(workers)
+    samples = []
+
+    def client(bodies):
+        test_client = app.test_client()
+        for body in bodies:
+            started = time.perf_counter()
+            with free_workers:
+                response = test_client.post(path, json=body)
+            if response.status_code >= 500:
+                raise RuntimeError(response.get_data(True))
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        for future in [executor.submit(client, [
+                request_body(path, size, generator)
+                for _ in range(requests)]) for _ in range(clients)]:
+            future.result()
+    return report(samples, time.perf_counter() - started)
+
+
+async def send_asgi(application, path, body):
+    content = json.dumps(body).encode('utf-8')
+    scope = {'type': 'http', 'method': 'POST', 'path': path,
+             'query_string': b'', 'client': ('127.0.0.1', 0),
+             'headers': [(b'content-type', b'application/json'),
+                         (b'content-length', str(len(content)).encode())]}
+    status = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': content}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+
+    await application(scope, receive, send)
+    if status[0] >= 500:
+        raise RuntimeError('{} {}'.format(status[0], path))
+
+
+async def run_asgi(application, path, size, clients, requests):
+    generator = random.Random(clients)
+    samples = []
+
+    async def client():
+        for _ in range(requests):
+            body = request_body(path, size, generator)
+            started = time.perf_counter()
+            await send_asgi(application, path, body)
+            samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    return report(samples, time.perf_counter() - started)
+
+
+# method for running every ASGI measure on one event loop
+async def run_asgi_all(application, size, clients, requests):
+    await application.start()
+    try:
+        return {(path, count): await run_asgi(
+                    application, path, size, count, requests)
+                for path in ROUTES for count in clients}
+    finally:
+        await application.database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--questions', type=int, default=100000)
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[1, 16, 64])
+    parser.add_argument('--requests', type=int, default=50,
+                        help='requests per client')
+    parser.add_argument('--sync-workers', type=int, default=4)
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--output', default='bench_asgi.json')
+    args = parser.parse_args()
+
+    from flaskr.asgi import create_asgi_app
+    database_uri = args.database_uri or sqlite_uri(
+        'asgi_{}'.format(args.questions))
+    application = create_asgi_app('testing', {
+        'SQLALCHEMY_DATABASE_URI': database_uri,
+        'SQLALCHEMY_ECHO': False,
+        'HTTP_CACHE_BACKEND': 'none',
+    })
+    app = application.app
+    populate(app, args.questions, args.categories)
+
+    results = {
+        'parameters': {'questions': args.questions,
+                       'requests': args.requests,
+                       'sync_workers': args.sync_workers,
+                       'async_database': type(
+                           application.database).__name__},
+        'routes': {},
+    }
+    for path in ROUTES:
+        # warm up the search index and the connections
+        app.test_client().post(path, json=request_body(
+            path, args.questions, random.Random(0)))
+        results['routes'][path] = {
+            str(clients): {'sync': run_sync(
+                app, path, args.questions, clients, args.requests,
+                args.sync_workers)}
+            for clients in args.clients}
+    measures = asyncio.run(run_asgi_all(
+        application, args.questions, args.clients, args.requests))
+    for (path, clients), summary in measures.items():
+        results['routes'][path][str(clients)]['asgi'] = summary
+
+    for path in ROUTES:
+        for clients in args.clients:
+            for mode, summary in sorted(
+                    results['routes'][path][str(clients)].items()):
+                print('{:18} {:>4} clients {:5} p50 {:>9} ms  p99 {:>9} ms'
+                      '  {:>8} req/s'.format(
+                          path, clients, mode, summary['p50_ms'],
+                          summary['p99_ms'], summary['throughput_rps']))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Query plans and latency of the category and quiz queries before and
+after the schema migrations (string category without indexes, then
+integer category with the (category, id) index).
+
+    python -m benchmarks.bench_category --questions 100000
+"""
+# third-party imports
+import argparse
+import random
+import time
+
+from sqlalchemy import text
+
+# local imports
+from benchmarks import (create_benchmark_app, sqlite_uri, summarize,
+                        write_results)
+from benchmarks.datagen import generate_questions
+from migrations import upgrade
+from models import db
+
+CATEGORIES = 6
+
+# schema of the questions table before the migrations
+LEGACY_SCHEMA = '''
+CREATE TABLE categories (id {id_type} PRIMARY KEY, type VARCHAR);
+CREATE TABLE questions (
+    id {id_type} PRIMARY KEY, question VARCHAR, answer VARCHAR,
+    category VARCHAR, difficulty INTEGER, rating INTEGER)
+'''
+
+# the statements run by GET /categories/<id>/questions and POST /quizzes
+QUERIES = {
+    'category_page': (
+        'SELECT id, question, answer, category, difficulty, rating '
+        'FROM questions WHERE category = :category ORDER BY id LIMIT 10'),
+    'category_count': (
+        'SELECT count(id) FROM questions WHERE category = :category'),
+    'quiz_pick': (
+        'SELECT id, question, answer, category, difficulty, rating '
+        'FROM questions WHERE category = :category '
+        'ORDER BY id LIMIT 1 OFFSET :offset'),
+}
+
+
+# method for creating the legacy schema and filling it
+def populate_legacy(connection, questions):
+    dialect = connection.dialect.name
+    id_type = 'SERIAL' if dialect == 'postgresql' else 'INTEGER'
+    connection.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+    connection.execute(text('DROP TABLE IF EXISTS questions'))
+    connection.execute(text('DROP TABLE IF EXISTS categories'))
+    for statement in LEGACY_SCHEMA.format(id_type=id_type).split(';'):
+        connection.execute(text(statement))
+    connection.execute(text(
+        'INSERT INTO categories (id, type) VALUES (:id, :type)'), [
+        {'id': category_id, 'type': 'Category {}'.format(category_id)}
+        for category_id in range(1, CATEGORIES + 1)])
+    rows = []
+    for row in generate_questions(questions, CATEGORIES):
+        row['category'] = str(row['category'])
+        rows.append(row)
+    connection.execute(text(
+        'INSERT INTO questions (question, answer, category, difficulty, '
+        'rating) VALUES (:question, :answer, :category, :difficulty, '
+        ':rating)'), rows)
+
+
+# method for the query plan of a statement
+def explain(connection, statement, params):
+    if connection.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+    return [' '.join(str(column) for column in row) for row in
+            connection.execute(text(prefix + statement), params)]
+
+
+# method for the plans and latency of every query
+def measure(connection, category, repeat):
+    total = connection.execute(text(QUERIES['category_count']),
+                               {'category': category}).scalar()
+    generator = random.Random(0)
+    results = {}
+    for name, statement in QUERIES.items():
+        samples = []
+        for _ in range(repeat):
+            params = {'category': category,
+                      'offset': generator.randrange(total)}
+            started = time.perf_counter()
+            connection.execute(text(statement), params).fetchall()
+            samples.append(time.perf_counter() - started)
+        results[name] = {
+            'plan': explain(connection, statement, params),
+            'latency': summarize(samples),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--questions', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--output', default='bench_category.json')
+    args = parser.parse_args()
+
+    database_uri = args.database_uri or sqlite_uri(
+        'category_{}'.format(args.questions))
+    app = create_benchmark_app(database_uri)
+    with app.app_context():
+        engine = db.engine
+        with engine.begin() as connection:
+            populate_legacy(connection, args.questions)
+        with engine.connect() as connection:
+            # the legacy column compares against a string
+            before = measure(connection, '3', args.repeat)
+        upgrade(engine)
+        with engine.connect() as connection:
+            after = measure(connection, 3, args.repeat)
+
+    results = {'questions': args.questions,
+               'before': before, 'after': after}
+    for name in QUERIES:
+        print(name)
+        for phase in ('before', 'after'):
+            print('  {:6} p50 {:>9} ms  {}'.format(
+                phase, results[phase][name]['latency']['p50_ms'],
+                ' | '.join(results[phase][name]['plan'])))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
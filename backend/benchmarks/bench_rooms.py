@@ -0,0 +1,238 @@
+"""
+Load test of the live rooms: one host and thousands of players streaming
+the events of a room from one worker.
+
+    python -m benchmarks.bench_rooms --clients 100 1000 5000
+
+By default the players stream from the ASGI application in-process. With
+--url they connect over TCP to a running server instead (raise the open
+files limit with `ulimit -n` first), e.g.:
+
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 1
+    python -m benchmarks.bench_rooms --clients 1000 \
+        --url http://127.0.0.1:8000
+
+For each number of players it reports the time from the request of the
+host to each player receiving the question, and in-process the SQL
+statements run for the whole room, which do not grow with the players.
+"""
+# third-party imports
+from urllib.parse import urlsplit
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+
+# local imports
+from benchmarks import sqlite_uri, summarize, write_results
+from benchmarks.datagen import populate
+
+
+# method for the (event, data) of the complete messages of a buffer
+def split_events(buffer):
+    *messages, rest = buffer.split(b'\n\n')
+    events = []
+    for message in messages:
+        fields = dict(line.split(': ', 1) for line in
+                      message.decode('utf-8').splitlines()
+                      if not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], json.loads(fields['data'])))
+    return events, rest
+
+
+class InProcessClient(object):
+    """Requests and streams sent to the ASGI application directly"""
+
+    def __init__(self, application):
+        self.application = application
+        self.stopped = asyncio.Event()
+
+    async def post(self, path, body):
+        content = json.dumps(body).encode('utf-8')
+        scope = {'type': 'http', 'method': 'POST', 'path': path,
+                 'query_string': b'', 'client': ('127.0.0.1', 0),
+                 'headers': [(b'content-type', b'application/json'),
+                             (b'content-length', str(len(content)).encode())]}
+        chunks = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': content}
+
+        async def send(message):
+            chunks.append(message.get('body', b''))
+
+        await self.application(scope, receive, send)
+        return json.loads(b''.join(chunks))
+
+    async def stream(self, path, on_event):
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'query_string': b'', 'client': ('127.0.0.1', 0),
+                 'headers': []}
+        buffer = [b'']
+
+        async def receive():
+            await self.stopped.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                on_event('open', None)
+            events, buffer[0] = split_events(
+                buffer[0] + message.get('body', b''))
+            for name, data in events:
+                on_event(name, data)
+
+        await self.application(scope, receive, send)
+
+
+class HttpClient(object):
+    """Requests and streams sent over TCP to a running server"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        parts = urlsplit(self.url)
+        self.host, self.port = parts.hostname, parts.port or 80
+
+    async def post(self, path, body):
+        request = urllib.request.Request(
+            self.url + path, data=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+
+        def send():
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())
+        return await asyncio.get_event_loop().run_in_executor(None, send)
+
+    async def stream(self, path, on_event):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write('GET {} HTTP/1.1\r\nHost: {}\r\n'
+                     'Accept: text/event-stream\r\n\r\n'.format(
+                         path, self.host).encode('latin-1'))
+        headers = (await reader.readuntil(b'\r\n\r\n')).lower()
+        chunked = b'transfer-encoding: chunked' in headers
+        on_event('open', None)
+        buffer = b''
+        try:
+            while True:
+                if chunked:
+                    size = int((await reader.readline()).strip(), 16)
+                    data = await reader.readexactly(size + 2)
+                    data = data[:-2]
+                    if not size:
+                        return
+                else:
+                    data = await reader.read(65536)
+                    if not data:
+                        return
+                events, buffer = split_events(buffer + data)
+                for name, data in events:
+                    on_event(name, data)
+        finally:
+            writer.close()
+
+
+# method for waiting until `done()`, raising after `timeout` seconds
+async def wait_until(done, error, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while not done():
+        if time.perf_counter() > deadline:
+            raise RuntimeError(error())
+        await asyncio.sleep(0.001)
+
+
+async def run_room(client, clients, questions, category_id):
+    room = await client.post('/rooms', {
+        'quiz_category': {'type': 'bench', 'id': category_id},
+        'questions': questions})
+    path = '/rooms/{}/events'.format(room['room_id'])
+    # question number -> arrival times at the players
+    arrivals = {}
+    opened = []
+
+    def on_event(name, data):
+        if name == 'open':
+            opened.append(True)
+        elif name == 'question':
+            arrivals.setdefault(data['number'], []).append(
+                time.perf_counter())
+
+    started = time.perf_counter()
+    streams = [asyncio.ensure_future(client.stream(path, on_event))
+               for _ in range(clients)]
+    await wait_until(lambda: len(opened) == clients,
+                     lambda: '{} of {} players connected'.format(
+                         len(opened), clients))
+    connected = time.perf_counter() - started
+
+    samples = []
+    for number in range(1, room['total_questions'] + 1):
+        sent = time.perf_counter()
+        await client.post('/rooms/{}/next'.format(room['room_id']),
+                          {'host_token': room['host_token']})
+        await wait_until(
+            lambda: len(arrivals.get(number, ())) == clients,
+            lambda: 'question {} reached {} of {} players'.format(
+                number, len(arrivals.get(number, ())), clients))
+        samples.extend(arrival - sent for arrival in arrivals[number])
+    # the last request ends the room and its streams
+    await client.post('/rooms/{}/next'.format(room['room_id']),
+                      {'host_token': room['host_token']})
+    await asyncio.wait_for(asyncio.gather(*streams), 30)
+    return {'connect_seconds': round(connected, 3),
+            'fan_out': summarize(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--clients', type=int, nargs='+',
+                        default=[100, 1000, 5000])
+    parser.add_argument('--room-questions', type=int, default=5)
+    parser.add_argument('--questions', type=int, default=10000,
+                        help='questions generated for the in-process run')
+    parser.add_argument('--url', default=None,
+                        help='server to load instead of the in-process app')
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--output', default='bench_rooms.json')
+    args = parser.parse_args()
+
+    statements = []
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        from flaskr.asgi import create_asgi_app
+        database_uri = args.database_uri or sqlite_uri(
+            'rooms_{}'.format(args.questions))
+        application = create_asgi_app('testing', {
+            'SQLALCHEMY_DATABASE_URI': database_uri,
+            'SQLALCHEMY_ECHO': False,
+            'INSTRUMENTATION_ENABLED': False,
+        })
+        populate(application.app, args.questions, 6)
+        event.listen(Engine, 'before_cursor_execute',
+                     lambda *arguments: statements.append(arguments[2]))
+
+    results = {}
+    for clients in args.clients:
+        del statements[:]
+        if not args.url:
+            client = InProcessClient(application)
+        results[str(clients)] = asyncio.run(run_room(
+            client, clients, args.room_questions, 1))
+        if not args.url:
+            results[str(clients)]['statements'] = len(statements)
+        fan_out = results[str(clients)]['fan_out']
+        print('{:>6} players  connected in {:>6} s  fan-out p50 {:>8} ms  '
+              'p99 {:>8} ms  {} statements'.format(
+                  clients, results[str(clients)]['connect_seconds'],
+                  fan_out['p50_ms'], fan_out['p99_ms'],
+                  results[str(clients)].get('statements', '-')))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Latency of POST /questions/search backends against the ILIKE scan.
+
+    python -m benchmarks.bench_search --sizes 10000 100000 1000000
+
+Each size gets its own sqlite database unless --database-uri is given
+(its tables are recreated for every size). On postgres the configured
+backend is the full-text index, elsewhere the in-process inverted index.
+"""
+# third-party imports
+import argparse
+import random
+import time
+
+# local imports
+from benchmarks import (create_benchmark_app, sqlite_uri, summarize,
+                        write_results)
+from benchmarks.datagen import WORDS, populate
+from flaskr.search import IlikeSearchBackend
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+# method for timing `repeat` searches of every term
+def time_searches(backend, terms, repeat, limit):
+    samples = []
+    for _ in range(repeat):
+        for term in terms:
+            started = time.perf_counter()
+            backend.search(term, 0, limit)
+            samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def run(size, database_uri, terms, repeat, limit):
+    app = create_benchmark_app(database_uri)
+    populate(app, size, 6)
+    backend = app.extensions['search_backend']
+    with app.app_context():
+        # the first search builds in-process indexes, report it apart
+        started = time.perf_counter()
+        backend.search(terms[0], 0, limit)
+        warmup = time.perf_counter() - started
+        return {
+            'ilike': time_searches(IlikeSearchBackend(), terms, repeat,
+                                   limit),
+            type(backend).__name__: time_searches(backend, terms, repeat,
+                                                  limit),
+            'warmup_ms': round(warmup * 1000, 3),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES))
+    parser.add_argument('--database-uri', default=None)
+    parser.add_argument('--terms', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--output', default='bench_search.json')
+    args = parser.parse_args()
+
+    terms = random.Random(1).sample(WORDS, args.terms)
+    results = {}
+    for size in args.sizes:
+        database_uri = args.database_uri or sqlite_uri(
+            'search_{}'.format(size))
+        results[str(size)] = run(size, database_uri, terms, args.repeat,
+                                 args.limit)
+        print(size, results[str(size)])
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Cold start of a worker and of the application of a test.
+
+    python -m benchmarks.bench_startup --runs 10
+
+A worker is timed in fresh python processes, like a gunicorn worker
+booting: importing flaskr, create_app and the first request, with and
+without DB_CREATE_ALL. The application of a test is created again in the
+same process, like the setUp of each test. The SQL statements run by
+create_app are counted too, the lazy startup runs none.
+"""
+# third-party imports
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# local imports
+from benchmarks import (create_benchmark_app, sqlite_uri, summarize,
+                        write_results)
+from benchmarks.datagen import populate
+
+# run in a fresh process, prints the timings of a worker start as JSON
+WORKER = '''
+import json, sys, time
+started = time.perf_counter()
+import flaskr
+imported = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute',
+             lambda *args: statements.append(args[2]))
+app = flaskr.create_app('testing', settings=json.loads(sys.argv[1]))
+created = time.perf_counter()
+create_statements = len(statements)
+app.test_client().get('/questions')
+answered = time.perf_counter()
+print(json.dumps({
+    'import': imported - started, 'create_app': created - imported,
+    'first_request': answered - created, 'total': answered - started,
+    'create_app_statements': create_statements}))
+'''
+
+
+def measure_worker(settings, runs):
+    samples = {}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', WORKER, json.dumps(settings)],
+            check=True, stdout=subprocess.PIPE).stdout
+        for name, value in json.loads(output.decode('utf-8')).items():
+            samples.setdefault(name, []).append(value)
+    statements = samples.pop('create_app_statements')
+    results = {name: summarize(values) for name, values in samples.items()}
+    results['create_app_statements'] = max(statements)
+    return results
+
+
+def measure_setup(settings, runs):
+    create_benchmark_app(**settings)
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        create_benchmark_app(**settings)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--questions', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=10,
+                        help='worker processes and test setups per mode')
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--output', default='bench_startup.json')
+    args = parser.parse_args()
+
+    database_uri = args.database_uri or sqlite_uri('startup')
+    populate(create_benchmark_app(database_uri), args.questions, 6)
+
+    results = {}
+    for mode, create_all in (('create_all', True), ('lazy', False)):
+        settings = {'SQLALCHEMY_DATABASE_URI': database_uri,
+                    'SQLALCHEMY_ECHO': False, 'DB_CREATE_ALL': create_all}
+        results[mode] = {
+            'worker': measure_worker(settings, args.runs),
+            'test_setup': measure_setup(
+                {'database_uri': database_uri, 'DB_CREATE_ALL': create_all},
+                args.runs),
+        }
+        worker = results[mode]['worker']
+        print('{:>10}  worker p50 {:>8} ms (import {} ms, create_app {} ms, '
+              'first request {} ms), {} statements in create_app, '
+              'test setup p50 {} ms'.format(
+                  mode, worker['total']['p50_ms'],
+                  worker['import']['p50_ms'], worker['create_app']['p50_ms'],
+                  worker['first_request']['p50_ms'],
+                  worker['create_app_statements'],
+                  results[mode]['test_setup']['p50_ms']))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Memory and latency of the columnar question store against the database.
+
+    python -m benchmarks.bench_store --sizes 10000 100000
+
+For each size it reports the python memory held by the question bank
+loaded as ORM Question objects, loaded in the columnar store, and mapped
+from a store snapshot (the mapped pages are shared by the workers and
+not counted), then the latency of the routes the store serves.
+"""
+# third-party imports
+import argparse
+import gc
+import os
+import random
+import time
+import tracemalloc
+
+# local imports
+from benchmarks import (BENCHMARK_DIR, create_benchmark_app, sqlite_uri,
+                        summarize, write_results)
+from benchmarks.datagen import WORDS, populate
+from flaskr.columnar import ColumnarStore
+from models import db, Question
+
+
+# method for the python memory allocated while building a value
+def allocated(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        value = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return value, size
+
+
+def measure_memory(app, snapshot):
+    with app.app_context():
+        results = {}
+        questions, results['orm_bytes'] = allocated(Question.query.all)
+        del questions
+        db.session.remove()
+        store, results['columnar_bytes'] = allocated(
+            ColumnarStore.from_database)
+        store.write_snapshot(snapshot)
+        results['columnar_nbytes'] = store.nbytes
+        del store
+        mapped, results['snapshot_private_bytes'] = allocated(
+            lambda: ColumnarStore.from_snapshot(snapshot))
+        results['snapshot_file_bytes'] = os.path.getsize(snapshot)
+        return results
+
+
+# method for the routes served by the store, with random arguments
+def requests(size, categories, generator):
+    return {
+        'GET /questions': lambda client: client.get(
+            '/questions?page={}'.format(generator.randint(1, size // 10))),
+        'GET /categories/<id>/questions': lambda client: client.get(
+            '/categories/{}/questions'.format(
+                generator.randint(1, categories))),
+        'POST /quizzes': lambda client: client.post('/quizzes', json={
+            'previous_questions': generator.sample(
+                range(1, size + 1), min(size, 20)),
+            'quiz_category': {'type': 'Category 1', 'id': 1}}),
+        'POST /questions/search': lambda client: client.post(
+            '/questions/search',
+            json={'searchTerm': generator.choice(WORDS)}),
+    }
+
+
+def measure_routes(app, size, categories, count):
+    client = app.test_client()
+    generator = random.Random(size)
+    results = {}
+    for name, send in requests(size, categories, generator).items():
+        send(client)
+        samples = []
+        for _ in range(count):
+            started = time.perf_counter()
+            send(client)
+            samples.append(time.perf_counter() - started)
+        results[name] = summarize(samples)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and size')
+    parser.add_argument('--database-uri', default=None,
+                        help='database to use, its tables are recreated')
+    parser.add_argument('--output', default='bench_store.json')
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        database_uri = args.database_uri or sqlite_uri(
+            'store_{}'.format(size))
+        settings = {'HTTP_CACHE_BACKEND': 'none', 'SEARCH_BACKEND': 'ilike'}
+        app = create_benchmark_app(database_uri, **settings)
+        populate(app, size, args.categories)
+        snapshot = os.path.join(BENCHMARK_DIR,
+                                'store_{}.snapshot'.format(size))
+        results[str(size)] = {
+            'memory': measure_memory(app, snapshot),
+            'database': measure_routes(app, size, args.categories,
+                                       args.requests),
+            'columnar': measure_routes(create_benchmark_app(
+                database_uri, QUESTION_STORE='columnar',
+                QUESTION_SNAPSHOT=snapshot, SEARCH_BACKEND='columnar',
+                HTTP_CACHE_BACKEND='none'),
+                size, args.categories, args.requests),
+        }
+
+        memory = results[str(size)]['memory']
+        print('{:>8} questions  ORM {:>12,} B  columnar {:>12,} B  '
+              'mapped snapshot {:>10,} B private'.format(
+                  size, memory['orm_bytes'], memory['columnar_bytes'],
+                  memory['snapshot_private_bytes']))
+        for route in results[str(size)]['database']:
+            print('{:>8} {:32} database p50 {:>8} ms  columnar p50 {:>8} ms'
+                  .format(size, route,
+                          results[str(size)]['database'][route]['p50_ms'],
+                          results[str(size)]['columnar'][route]['p50_ms']))
+    write_results(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
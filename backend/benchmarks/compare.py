@@ -0,0 +1,58 @@
+"""
+Compares two bench_api result files and reports the routes whose
+latency grew by more than a threshold, exits with status 1 if any did.
+
+    python -m benchmarks.compare base.json head.json --threshold 20
+"""
+# third-party imports
+import argparse
+import json
+import sys
+
+
+# method for loading the per size, per route summaries of a result file
+def load(path):
+    with open(path) as result_file:
+        return json.load(result_file)['sizes']
+
+
+'''
+regressions(base, head, metric, threshold)
+    yields (size, route, base value, head value, change in percent)
+    for every route slower than `threshold` percent in head
+'''
+
+
+def regressions(base, head, metric, threshold):
+    for size, routes in head.items():
+        for route, summary in routes.items():
+            before = base.get(size, {}).get(route, {}).get(metric)
+            after = summary.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before * 100
+            if change > threshold:
+                yield size, route, before, after, change
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--metric', default='p95_ms')
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help='allowed slowdown in percent')
+    args = parser.parse_args()
+
+    found = list(regressions(load(args.base), load(args.head), args.metric,
+                             args.threshold))
+    for size, route, before, after, change in found:
+        print('{:>8} {:34} {} {} -> {} ms (+{:.0f}%)'.format(
+            size, route, args.metric, before, after, change))
+    if not found:
+        print('no regression above {}%'.format(args.threshold))
+    sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
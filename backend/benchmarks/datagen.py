@@ -0,0 +1,102 @@
+"""
+Synthetic question bank generator.
+
+    python -m benchmarks.datagen --questions 100000 --categories 6 \
+        --database-uri sqlite:////tmp/trivia_bench/trivia.db
+"""
+# third-party imports
+import argparse
+import random
+
+# local imports
+from migrations import refresh_category_stats
+from models import db, Question, Category
+from benchmarks import create_benchmark_app, sqlite_uri
+
+WORDS = (
+    'ancient army art artist atom battle bird blood body book bridge '
+    'capital castle cell century champion city climate coast composer '
+    'country crown dance desert discovery dynasty earth element empire '
+    'energy engine explorer festival film first football forest formula '
+    'galaxy garden gold goal great harbor history island inventor king '
+    'lake language law league light machine mountain movie museum music '
+    'nation nobel novel ocean olympic opera painter paper peace planet '
+    'poet president queen race record republic revolution river rock '
+    'science sculpture ship singer soccer song space species sport star '
+    'state statue stone team temple theory title tower trade treaty tree '
+    'victory village volcano war water wave winner world writer year'
+).split()
+
+STARTERS = ('Which', 'What', 'Who', 'Where', 'When', 'How many')
+
+
+# method for generating one question text from the vocabulary
+def generate_text(generator, length):
+    words = [generator.choice(WORDS) for _ in range(length)]
+    return '{} {}?'.format(generator.choice(STARTERS), ' '.join(words))
+
+
+'''
+generate_questions(count, categories, seed)
+    yields `count` question rows spread across `categories` category ids
+'''
+
+
+def generate_questions(count, categories, seed=0):
+    generator = random.Random(seed)
+    for _ in range(count):
+        yield {
+            'question': generate_text(generator, generator.randint(5, 14)),
+            'answer': generate_text(generator, 2)[:-1],
+            'category': generator.randint(1, categories),
+            'difficulty': generator.randint(1, 5),
+            'rating': generator.randint(1, 5),
+        }
+
+
+'''
+populate(app, questions, categories)
+    recreates the tables of the app database and fills them with
+    a synthetic question bank, in batches of `batch_size` rows, and
+    the category statistics of GET /stats
+'''
+
+
+def populate(app, questions, categories, seed=0, batch_size=10000):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(Category.__table__.insert(), [
+            {'id': category_id, 'type': 'Category {}'.format(category_id)}
+            for category_id in range(1, categories + 1)])
+        batch = []
+        for row in generate_questions(questions, categories, seed):
+            batch.append(row)
+            if len(batch) == batch_size:
+                db.session.execute(Question.__table__.insert(), batch)
+                batch = []
+        if batch:
+            db.session.execute(Question.__table__.insert(), batch)
+        refresh_category_stats(db.session.connection())
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--questions', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-uri', default=None,
+                        help='database to fill, its tables are recreated')
+    args = parser.parse_args()
+
+    database_uri = args.database_uri or sqlite_uri(
+        'trivia_{}'.format(args.questions))
+    app = create_benchmark_app(database_uri)
+    populate(app, args.questions, args.categories, seed=args.seed)
+    print('{} questions in {} categories written to {}'.format(
+        args.questions, args.categories, database_uri))
+
+
+if __name__ == '__main__':
+    main()
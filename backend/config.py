@@ -8,6 +8,31 @@ basedir = path.abspath(path.dirname(__file__))
 load_dotenv(path.join(basedir, '.env'))
 
 
+def engine_options(database_uri):
+    """
+    SQLAlchemy engine and connection pool options, from the environment.
+    Each worker process opens at most DB_POOL_SIZE + DB_MAX_OVERFLOW
+    connections, see "Connection pool sizing" in the README.
+    """
+    options = {
+        'pool_size': int(environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        # seconds to wait for a free connection before failing
+        'pool_timeout': int(environ.get('DB_POOL_TIMEOUT', 30)),
+        # seconds after which a connection is replaced
+        'pool_recycle': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        # test connections on checkout, survives database restarts
+        'pool_pre_ping': environ.get(
+            'DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+    # milliseconds after which postgres cancels a statement
+    statement_timeout = int(environ.get('DB_STATEMENT_TIMEOUT', 0))
+    if statement_timeout and (database_uri or '').startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(statement_timeout)}
+    return options
+
+
 class Config(object):
     """
     Common configurations
@@ -19,7 +44,186 @@ class Config(object):
     """
     SECRET_KEY = environ.get('SECRET_KEY', 'dev')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    """
+        The workers connect to the database on their first query. Tables
+        are created by `flask create-db`, or on every start with
+        DB_CREATE_ALL, which needs the database when the app is created.
+    """
+    DB_CREATE_ALL = environ.get(
+        'DB_CREATE_ALL', 'false').lower() in ('1', 'true', 'yes')
     DEBUG = False
+    """
+        Quiz sessions are kept in an in-process LRU store by default,
+        any subclass of flaskr.sessions.QuizSessionStore can be used.
+        A session plays at most QUIZ_SESSION_MAX_QUESTIONS questions.
+    """
+    QUIZ_SESSION_STORE = environ.get(
+        'QUIZ_SESSION_STORE', 'flaskr.sessions.LRUSessionStore')
+    QUIZ_SESSION_MAX = int(environ.get('QUIZ_SESSION_MAX', 10000))
+    QUIZ_SESSION_MAX_QUESTIONS = int(environ.get(
+        'QUIZ_SESSION_MAX_QUESTIONS', 100))
+    """
+        Categories are cached in memory, other workers see a change
+        after at most CATEGORY_CACHE_TTL seconds.
+    """
+    CATEGORY_CACHE_TTL = int(environ.get('CATEGORY_CACHE_TTL', 300))
+    """
+        Search backend: `postgres` (full-text index), `memory`
+        (in-process inverted index), `ilike` or `auto`.
+    """
+    SEARCH_BACKEND = environ.get('SEARCH_BACKEND', 'auto')
+    SEARCH_MAX_RESULTS = int(environ.get('SEARCH_MAX_RESULTS', 50))
+    """
+        Cache of the GET /categories, /questions and
+        /categories/<id>/questions responses: `memory` (per worker,
+        cleared within CHANGE_SYNC_INTERVAL seconds of the writes of the
+        other workers), `filesystem` (shared by the workers of a host,
+        in the private directory HTTP_CACHE_DIR) or `none`. Entries live
+        at most HTTP_CACHE_TTL seconds, clients revalidate them with
+        ETags after HTTP_CACHE_MAX_AGE seconds.
+    """
+    HTTP_CACHE_BACKEND = environ.get('HTTP_CACHE_BACKEND', 'memory')
+    HTTP_CACHE_MAX_ENTRIES = int(environ.get('HTTP_CACHE_MAX_ENTRIES', 1024))
+    HTTP_CACHE_MAX_BYTES = int(environ.get(
+        'HTTP_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+    HTTP_CACHE_DIR = environ.get('HTTP_CACHE_DIR') or None
+    HTTP_CACHE_TTL = int(environ.get('HTTP_CACHE_TTL', 60))
+    HTTP_CACHE_MAX_AGE = int(environ.get('HTTP_CACHE_MAX_AGE', 0))
+    """
+        Rows inserted or exported per batch by the bulk endpoints,
+        and errors reported per import.
+    """
+    BULK_BATCH_SIZE = int(environ.get('BULK_BATCH_SIZE', 1000))
+    BULK_MAX_ERRORS = int(environ.get('BULK_MAX_ERRORS', 100))
+    """
+        Diagnostics endpoints, off by default and only answered to local
+        clients not relayed by a proxy.
+    """
+    DIAGNOSTICS_ENABLED = environ.get(
+        'DIAGNOSTICS_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+    """
+        Per route SQL statements, database, ORM loading and serialisation
+        time, sent as Server-Timing headers and served on GET /metrics.
+        Requests running more than QUERY_BUDGET statements, or the same
+        statement N_PLUS_ONE_THRESHOLD times, are logged as warnings.
+    """
+    INSTRUMENTATION_ENABLED = environ.get(
+        'INSTRUMENTATION_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    QUERY_BUDGET = int(environ.get('QUERY_BUDGET', 10))
+    N_PLUS_ONE_THRESHOLD = int(environ.get('N_PLUS_ONE_THRESHOLD', 5))
+    """
+        ASGI mode (flaskr.asgi): threads running the Flask application,
+        and database of the native async routes: `asyncpg`, `threads` or
+        `auto` (asyncpg on postgres when installed) with at most
+        ASYNC_DB_POOL_SIZE connections per worker.
+    """
+    ASGI_THREADS = int(environ.get('ASGI_THREADS', 16))
+    ASYNC_DATABASE = environ.get('ASYNC_DATABASE', 'auto')
+    ASYNC_DB_POOL_SIZE = int(environ.get('ASYNC_DB_POOL_SIZE', 10))
+    """
+        Rating updates are buffered per worker, coalesced by question and
+        written in one UPDATE every RATING_FLUSH_INTERVAL seconds (0:
+        written by the request) or once RATING_FLUSH_SIZE questions are
+        pending. With RATING_LOG_DIR set, buffered ratings are logged to
+        local files first and replayed on startup after a crash.
+    """
+    RATING_FLUSH_INTERVAL = float(environ.get('RATING_FLUSH_INTERVAL', 1.0))
+    RATING_FLUSH_SIZE = int(environ.get('RATING_FLUSH_SIZE', 500))
+    RATING_LOG_DIR = environ.get('RATING_LOG_DIR') or None
+    RATING_LOG_FSYNC = environ.get(
+        'RATING_LOG_FSYNC', 'false').lower() in ('1', 'true', 'yes')
+    RATING_BATCH_MAX = int(environ.get('RATING_BATCH_MAX', 1000))
+    """
+        Read replicas (DATABASE_REPLICA_URIS, comma separated): GET
+        requests, quizzes and searches read from a random replica, writes
+        go to the primary. A client reads from the primary for
+        REPLICA_READ_YOUR_WRITES seconds after its last write.
+    """
+    SQLALCHEMY_REPLICA_URIS = [
+        uri.strip() for uri in environ.get(
+            'DATABASE_REPLICA_URIS', '').split(',') if uri.strip()]
+    REPLICA_READ_YOUR_WRITES = int(environ.get('REPLICA_READ_YOUR_WRITES', 5))
+    """
+        Quiz decks: DECKS_PER_CATEGORY shuffled orders of the questions
+        of each category, served from memory. `flask build-decks` writes
+        them to DECK_FILE, memory-mapped by the workers of the host.
+    """
+    DECKS_PER_CATEGORY = int(environ.get('DECKS_PER_CATEGORY', 16))
+    DECK_FILE = environ.get('DECK_FILE') or None
+    """
+        Question store: `database`, or `columnar` to load the questions
+        into typed arrays at startup and serve the listings, category
+        pages, random quiz picks and searches from them. The columnar
+        store is memory-mapped from QUESTION_SNAPSHOT when it is set, so
+        the workers of a host share one copy.
+    """
+    QUESTION_STORE = environ.get('QUESTION_STORE', 'database')
+    QUESTION_SNAPSHOT = environ.get('QUESTION_SNAPSHOT') or None
+    """
+        State kept in memory by each worker (question store, search,
+        adaptive and suggestion indexes) follows the writes of the other
+        workers within CHANGE_SYNC_INTERVAL seconds, the interval at
+        which a worker reads the table versions.
+    """
+    CHANGE_SYNC_INTERVAL = float(environ.get('CHANGE_SYNC_INTERVAL', 1))
+    """
+        Live quiz rooms: at most ROOM_MAX open rooms per worker, of
+        ROOM_QUESTIONS questions by default and ROOM_MAX_QUESTIONS at
+        most, and ROOM_MAX_PLAYERS players. Closed rooms are dropped
+        ROOM_CLOSED_TTL seconds after their end. Idle event streams get
+        a comment every ROOM_HEARTBEAT seconds.
+    """
+    ROOM_MAX = int(environ.get('ROOM_MAX', 1000))
+    ROOM_MAX_PLAYERS = int(environ.get('ROOM_MAX_PLAYERS', 1000))
+    ROOM_CLOSED_TTL = float(environ.get('ROOM_CLOSED_TTL', 300))
+    ROOM_QUESTIONS = int(environ.get('ROOM_QUESTIONS', 10))
+    ROOM_MAX_QUESTIONS = int(environ.get('ROOM_MAX_QUESTIONS', 50))
+    ROOM_HEARTBEAT = float(environ.get('ROOM_HEARTBEAT', 15))
+    """
+        Request validation: JSON bodies over JSON_MAX_BYTES are refused
+        with 413 before they are read, quizzes take at most
+        QUIZ_MAX_PREVIOUS previous questions, search terms at most
+        SEARCH_TERM_MAX_LENGTH characters and questions and answers at
+        most QUESTION_MAX_LENGTH.
+    """
+    JSON_MAX_BYTES = int(environ.get('JSON_MAX_BYTES', 64 * 1024))
+    QUIZ_MAX_PREVIOUS = int(environ.get('QUIZ_MAX_PREVIOUS', 1000))
+    SEARCH_TERM_MAX_LENGTH = int(environ.get('SEARCH_TERM_MAX_LENGTH', 200))
+    QUESTION_MAX_LENGTH = int(environ.get('QUESTION_MAX_LENGTH', 1000))
+    """
+        Search-as-you-type suggestions: GET /questions/suggest returns
+        SUGGEST_LIMIT questions by default and SUGGEST_MAX_LIMIT at most,
+        with their text cut to SUGGEST_SNIPPET characters.
+    """
+    SUGGEST_LIMIT = int(environ.get('SUGGEST_LIMIT', 8))
+    SUGGEST_MAX_LIMIT = int(environ.get('SUGGEST_MAX_LIMIT', 20))
+    SUGGEST_SNIPPET = int(environ.get('SUGGEST_SNIPPET', 80))
+    """
+        Admission control of the expensive routes (search_questions,
+        play_quiz): RATE_LIMITS gives each client a token bucket per
+        route, "route=rate:burst" with rate in requests per second, kept
+        in RATE_LIMIT_STORE, any subclass of
+        flaskr.ratelimit.RateLimitStore. At most EXPENSIVE_MAX_CONCURRENT
+        of their requests run at once per worker, others wait up to
+        EXPENSIVE_QUEUE_TIMEOUT seconds for a slot. Behind
+        RATE_LIMIT_TRUSTED_PROXIES reverse proxies, each appending to
+        X-Forwarded-For, the clients are told apart by the address the
+        first proxy saw.
+    """
+    RATE_LIMIT_ENABLED = environ.get(
+        'RATE_LIMIT_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    RATE_LIMIT_STORE = environ.get(
+        'RATE_LIMIT_STORE', 'flaskr.ratelimit.MemoryRateLimitStore')
+    RATE_LIMIT_MAX_CLIENTS = int(environ.get('RATE_LIMIT_MAX_CLIENTS',
+                                             100000))
+    RATE_LIMITS = environ.get(
+        'RATE_LIMITS', 'search_questions=10:20,play_quiz=5:10')
+    RATE_LIMIT_TRUSTED_PROXIES = int(environ.get(
+        'RATE_LIMIT_TRUSTED_PROXIES', 0))
+    EXPENSIVE_MAX_CONCURRENT = int(environ.get('EXPENSIVE_MAX_CONCURRENT',
+                                               4))
+    EXPENSIVE_QUEUE_TIMEOUT = float(environ.get('EXPENSIVE_QUEUE_TIMEOUT',
+                                                0.1))
 
 
 class DevelopmentConfig(Config):
@@ -40,6 +244,7 @@ class ProductionConfig(Config):
     DEBUG = False
     TESTING = False
     SQLALCHEMY_DATABASE_URI = environ.get('DATABASE_URI')
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
 
 
 class TestingConfig(Config):
@@ -48,6 +253,14 @@ class TestingConfig(Config):
     """
     TESTING = True
     SQLALCHEMY_DATABASE_URI = environ.get('DATABASE_URI_TEST')
+    # ratings are read back right after they are sent
+    RATING_FLUSH_INTERVAL = 0
+    # each test application has its own cache
+    HTTP_CACHE_BACKEND = environ.get('HTTP_CACHE_BACKEND', 'memory')
+    # tests and benchmarks send bursts of requests from one client
+    RATE_LIMIT_ENABLED = False
+    # tests and benchmarks read the pool and the metrics
+    DIAGNOSTICS_ENABLED = True
 
 
 app_config = {
@@ -1,41 +1,149 @@
 # third-party imports
-from flask import Flask, request, abort, jsonify
+from flask import (Flask, Response, current_app, request, abort, jsonify,
+                   stream_with_context)
 from flask_cors import CORS
+from sqlalchemy import func
+import click
 import random
 
 # local imports
 from config import app_config
-from models import setup_db, Question, Category
+from models import (setup_db, check_tables, count_questions, get_categories,
+                    get_categories_json, pool_status, primary_reads, db,
+                    CategoryStats, Question)
+from .adaptive import create_adaptive_index, pick_adaptive_question
+from .bulk import (decode_lines, export_questions, import_questions,
+                   parse_csv, parse_ndjson, resolve_format, FORMATS)
+from .caching import create_response_cache
+from .columnar import create_question_store, ColumnarStore
+from .decks import create_deck_store, write_deck_file
+from .diagnostics import local_only
+from .instrumentation import Instrumentation
+from .quiz import pick_random_question, quiz_selection
+from .ratelimit import create_admission_control, retry_after_header
+from .ratings import create_rating_buffer, existing_questions
+from .replicas import create_replica_router, read_only
+from .rooms import create_room_store, last_event_id, room_stream
+from .search import create_search_backend
+from .serialization import (json_response, question_rows, questions_fragment,
+                            Fragment, QuestionRow)
+from .sessions import create_session_store, new_session_id
+from .suggest import create_suggestion_index, suggest_categories
+from .validation import compile_schemas, json_body, quiz_category_id
 
 QUESTIONS_PER_PAGE = 10
 
 
 # method for paginating questions
 def paginate_questions(selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    questions = [question.format() for question in selection]
-    current_question = questions[start:end]
-    return current_question
+    """
+        paginates a question query with LIMIT/OFFSET (`page`)
+        or with a keyset cursor (`after_id`) inside the database,
+        returns the question rows of the page
+    """
+    # keyset pagination needs a stable order on the primary key
+    selection = selection.order_by(None).order_by(Question.id)
+    after_id, page = requested_page()
+    if after_id is not None:
+        # cursor mode: deep pages cost the same as the first one
+        selection = selection.filter(Question.id > after_id)
+    else:
+        if page < 1:
+            return []
+        selection = selection.offset((page - 1) * QUESTIONS_PER_PAGE)
+    return question_rows(selection.limit(QUESTIONS_PER_PAGE))
+
+
+# method for the requested keyset cursor (`after_id`) and page number
+def requested_page():
+    return (request.args.get('after_id', None, type=int),
+            request.args.get('page', 1, type=int))
+
+
+# method for the requested page of the questions of a category
+def questions_page(category_id=None):
+    """
+        returns the question rows of the requested page of a category,
+        of all categories when None, from the columnar store if enabled
+    """
+    store = current_app.extensions.get('question_store')
+    if store is not None:
+        after_id, page = requested_page()
+        return store.page(category_id, page, after_id, QUESTIONS_PER_PAGE)
+    return paginate_questions(quiz_selection(category_id))
+
+
+# method for counting the questions of a category, None for all
+def questions_total(category_id=None):
+    store = current_app.extensions.get('question_store')
+    if store is not None:
+        return store.count(category_id)
+    return count_questions(quiz_selection(category_id))
+
+
+# method for the (limit, offset) of the page of a validated search body
+def search_window(body, max_results):
+    limit = min(body['limit'] or QUESTIONS_PER_PAGE, max_results)
+    return limit, (body['page'] - 1) * limit
+
+
+# method for the empty statistics of a category, or of all of them
+def new_statistics(category_id=None, name=None):
+    statistics = {'total_questions': 0, 'difficulties': {},
+                  'rating_sum': 0, 'rated': 0}
+    if category_id is not None:
+        statistics.update(id=category_id, type=name)
+    return statistics
 
 
-# method Check if any of elements in list is None
-def check_if_one_none(list_of_elem):
-    result = False
-    for elem in list_of_elem:
-        if elem is None or elem == "":
-            result = True
-            return result
-    return result
+# method for adding a category_stats row to statistics
+def add_statistics(statistics, stats):
+    statistics['total_questions'] += stats.questions
+    if stats.difficulty:
+        key = str(stats.difficulty)
+        statistics['difficulties'][key] = \
+            statistics['difficulties'].get(key, 0) + stats.questions
+    statistics['rating_sum'] += stats.rating_sum
+    statistics['rated'] += stats.rated
 
 
-def create_app(config='development'):
+# method for replacing the rating sums of statistics by their average
+def finish_statistics(statistics):
+    rating_sum, rated = statistics.pop('rating_sum'), statistics.pop('rated')
+    statistics['average_rating'] = round(rating_sum / rated, 2) \
+        if rated else None
+    return statistics
+
+
+# method for the random question sequence of a live room
+def room_questions(category_id, count):
+    """
+        returns `count` random questions of a category, of all categories
+        when None, formatted, in one query or from the columnar store
+    """
+    store = current_app.extensions.get('question_store')
+    if store is not None:
+        question_ids = store.question_ids(category_id)
+        return [store.get(question_id).format() for question_id in
+                random.sample(question_ids, min(count, len(question_ids)))]
+    return [QuestionRow(*row).format() for row in question_rows(
+        quiz_selection(category_id).order_by(func.random()).limit(count))]
+
+
+# method for checking if the client asked for a page of questions
+def page_requested():
+    return 'page' in request.args or 'after_id' in request.args
+
+
+def create_app(config='development', settings=None):
     # create and configure the app
     if config is not None:
         # load form config file.
         app = Flask(__name__)
         app.config.from_object(app_config[config])
+        # settings override the configuration profile (benchmarks, tests)
+        if settings is not None:
+            app.config.update(settings)
     else:
         raise EnvironmentError(
             'Please specify a valid configuration profile for the application.'
@@ -43,6 +151,68 @@ def create_app(config='development'):
     # binds a flask application and a SQLAlchemy service
     setup_db(app)
 
+    # the tables are checked on the first request, not on start
+    @app.before_first_request
+    def check_schema():
+        check_tables(app)
+
+    # questions in typed arrays, when QUESTION_STORE is columnar
+    question_store = create_question_store(app)
+    if question_store is not None:
+        app.extensions['question_store'] = question_store
+
+    # reads of GET and read-only requests sent to the read replicas
+    replica_router = create_replica_router(app)
+    if replica_router is not None:
+        app.extensions['replica_router'] = replica_router
+
+    # request body schemas, compiled once so that a malformed schema
+    # fails here and not on a request
+    schemas = compile_schemas(app.config)
+    app.extensions['request_schemas'] = schemas
+
+    # per client rate limits and concurrency of the expensive routes
+    admission_control = create_admission_control(app.config)
+    app.extensions['admission_control'] = admission_control
+
+    # server-side queues of the quiz sessions
+    quiz_sessions = create_session_store(app.config)
+    app.extensions['quiz_sessions'] = quiz_sessions
+
+    # questions weighted by rating per category and difficulty
+    adaptive_index = create_adaptive_index(app)
+    app.extensions['adaptive_index'] = adaptive_index
+
+    # shuffled decks of pre-serialised questions per category
+    deck_store = create_deck_store(app)
+    app.extensions['deck_store'] = deck_store
+
+    # live quiz rooms streaming their questions to the players
+    live_rooms = create_room_store(app.config)
+    app.extensions['live_rooms'] = live_rooms
+
+    # full-text search backend of the questions
+    search_backend = create_search_backend(app)
+    app.extensions['search_backend'] = search_backend
+
+    # prefix index of the question words for search-as-you-type
+    suggestion_index = create_suggestion_index(app)
+    app.extensions['suggestion_index'] = suggestion_index
+
+    # rating updates coalesced in memory and written in batches
+    rating_buffer = create_rating_buffer(app)
+    app.extensions['rating_buffer'] = rating_buffer
+
+    # cache of the GET responses, cleared by every write
+    response_cache = create_response_cache(app)
+    app.extensions['response_cache'] = response_cache
+
+    # per route SQL, loading and serialisation timings of the requests
+    instrumentation = None
+    if app.config['INSTRUMENTATION_ENABLED']:
+        instrumentation = Instrumentation(app)
+        app.extensions['instrumentation'] = instrumentation
+
     # set up Cross Origin Resource Sharing , allow all origins
     CORS(app, resources={r'/*': {'origins': '*'}})
 
@@ -61,26 +231,23 @@ def create_app(config='development'):
         handles GET requests to retrieve all categories
     """
     @app.route('/categories')
+    @response_cache.cached
     def retrieve_categories():
         try:
-            # get all available categories.
-            categories = Category.query.order_by(Category.id).all()
-
-            # add categories to current categories dictionaries
-            current_categories = {}
-            for category in categories:
-                current_categories[category.id] = category.type
+            # get all available categories from the cache
+            current_categories = get_categories()
             total_categories = len(current_categories)
 
             # abort 405 if method not allowed
             if len(current_categories) == 0:
                 abort(405)
 
-            # return success response in json format to view
-            return jsonify({
-                'success': True,
-                'categories': current_categories,
-                'total_categories': total_categories
+            # return success response in json format to view,
+            # the categories are already serialised by the cache
+            return json_response({
+                "success": True,
+                "categories": Fragment(get_categories_json()),
+                "total_categories": total_categories
             })
         except:
             abort(405)
@@ -89,28 +256,22 @@ def create_app(config='development'):
         handles GET requests to retrieve all questions
     """
     @app.route('/questions')
+    @response_cache.cached
     def retrieve_questions():
-        # get all questions and paginate 10 questions per page
-        selection = Question.query.order_by(Question.id).all()
-        total_questions = len(selection)
-        current_questions = paginate_questions(selection)
-
-        # get all categories and add to dictionary
-        categories = Category.query.order_by(Category.id).all()
-        current_categories = {}
-        for category in categories:
-            current_categories[category.id] = category.type
+        # paginate 10 questions per page inside the database
+        current_questions = questions_page()
+        total_questions = questions_total()
 
         # abort 404 if no questions found
         if len(current_questions) == 0:
             abort(404)
 
         # return success response in json format to view
-        return jsonify({
+        return json_response({
             "success": True,
-            "questions": current_questions,
+            "questions": questions_fragment(current_questions),
             "total_questions": total_questions,
-            "categories": current_categories
+            "categories": Fragment(get_categories_json())
         })
 
     """
@@ -128,15 +289,18 @@ def create_app(config='development'):
                 abort(404)
             # delete the question
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(selection)
-            total_questions = len(selection)
 
-            # return success response in json format to view
-            return jsonify({
+            # return success response in json format to view,
+            # with the requested page of the remaining questions if any
+            response = {
                 'success': True,
-                'deleted': question.id,
-            })
+                'deleted': question_id,
+                'total_questions': questions_total()
+            }
+            if page_requested():
+                response['questions'] = questions_fragment(
+                    questions_page())
+            return json_response(response)
         except:
             # abort unprocessable if there is problem in deleting question
             abort(422)
@@ -145,104 +309,177 @@ def create_app(config='development'):
         handles POST requests to create new question
     '''
     @app.route('/questions', methods=['POST'])
-    def create_question():
-        # get data from front end
-        body = request.get_json()
-        new_question = body.get('question', None)
-        new_answer = body.get('answer', None)
-        new_category = body.get('category', None)
-        new_difficulty = body.get('difficulty', None)
-        new_rating = body.get('rating', None)
-        list1 = [new_question, new_answer]
-        # Check if list contains only one element is None
-        result = check_if_one_none(list1)
-        if result:
-            # abort unprocessable if exception
+    @json_body(schemas['question'])
+    def create_question(body):
+        # abort unprocessable if the category does not exist
+        if body['category'] is not None and \
+                body['category'] not in get_categories():
             abort(422)
-        try:
-            question = Question(question=new_question,
-                                answer=new_answer,
-                                category=new_category,
-                                difficulty=new_difficulty,
-                                rating=new_rating)
-            question.insert()
-
-            # query the database for all questions
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(selection)
-            total_questions = len(selection)
-            if total_questions == 0:
-                # no questions were found, return a 404 error.
-                abort(404)
+        question = Question(question=body['question'],
+                            answer=body['answer'],
+                            category=body['category'],
+                            difficulty=body['difficulty'],
+                            rating=body['rating'])
+        question.insert()
+
+        # return success response in json format to view,
+        # with the requested page of questions if any
+        response = {
+            'success': True,
+            'created': question.id,
+            'question': question.question,
+            'total_questions': questions_total()
+        }
+        if page_requested():
+            response['questions'] = questions_fragment(questions_page())
+        return json_response(response)
 
-            # return success response in json format to view
-            return jsonify({
-                'success': True,
-                'created': question.id,
-                'question': question.question,
-                'questions': current_questions,
-                'total_questions': total_questions})
+    '''
+        handles POST requests to import questions in bulk,
+        the NDJSON or CSV request body is streamed and inserted in batches
+    '''
+    @app.route('/questions/bulk', methods=['POST'])
+    def import_questions_in_bulk():
+        # format from the query string or from the content type
+        import_format = resolve_format(
+            request.args.get('format') or request.mimetype)
+        if import_format is None:
+            abort(415)
+        parse = parse_csv if import_format == 'csv' else parse_ndjson
+
+        inserted, rejected, errors = import_questions(
+            parse(decode_lines(request.stream)), schemas['question'],
+            batch_size=app.config['BULK_BATCH_SIZE'],
+            max_errors=app.config['BULK_MAX_ERRORS'])
+
+        # return success response in json format to view,
+        # with the errors of the rejected rows
+        return jsonify({
+            'success': True,
+            'inserted': inserted,
+            'rejected': rejected,
+            'errors': errors
+        })
 
-        except:
-            # abort unprocessable if exception
-            abort(422)
+    '''
+        handles GET requests to export all questions
+        as a streamed NDJSON or CSV file
+    '''
+    @app.route('/questions/export')
+    def export_questions_in_bulk():
+        export_format = resolve_format(request.args.get('format', 'ndjson'))
+        if export_format is None:
+            abort(415)
+        response = Response(
+            stream_with_context(export_questions(
+                export_format, batch_size=app.config['BULK_BATCH_SIZE'])),
+            mimetype=FORMATS[export_format])
+        response.headers['Content-Disposition'] = \
+            'attachment; filename=questions.{}'.format(export_format)
+        return response
 
     '''
-        handles POST requests for searching
-        in questions by substring of question
+        handles POST requests for searching in questions,
+        results are ranked by the search backend and paginated
     '''
     @app.route('/questions/search', methods=['POST'])
-    def search_questions():
-        # load the request body
-        body = request.get_json()
-        search_term = body.get('searchTerm', None)
-
-        # if search term is present
-        if search_term:
-            # query the database using search term
-            search_result = Question.query.filter(
-                Question.question.ilike(f'%{search_term}%')).all()
-            total_search_result = len(search_result)
-            search_questions_result = [
-                question.format() for question in search_result]
-
-            # return success response in json format to view
-            return jsonify({
-                "success": True,
-                "questions": search_questions_result,
-                "total_questions": total_search_result,
-            })
-        # 404 if no results found
-        else:
+    @read_only
+    @admission_control.limited
+    @json_body(schemas['search'])
+    def search_questions(body):
+        # 404 if search term is not present
+        search_term = body['searchTerm']
+        if not search_term:
             abort(404)
 
+        # number of questions per page, bounded by the result limit
+        limit, offset = search_window(body, app.config['SEARCH_MAX_RESULTS'])
+
+        # query the search backend using search term
+        search_result, total_search_result = search_backend.search(
+            search_term, offset, limit)
+
+        # return success response in json format to view
+        return json_response({
+            "success": True,
+            "questions": questions_fragment(search_result),
+            "total_questions": total_search_result,
+        })
+
+    '''
+        handles GET requests for search-as-you-type suggestions, the
+        questions and categories with words starting like `q`, served
+        from the in-memory prefix index without querying the database
+    '''
+    @app.route('/questions/suggest')
+    def suggest_questions():
+        # 400 if the text typed so far is over the search term limit
+        query = request.args.get('q', '')
+        if len(query) > app.config['SEARCH_TERM_MAX_LENGTH']:
+            abort(400)
+        limit = request.args.get('limit', app.config['SUGGEST_LIMIT'],
+                                 type=int)
+        limit = max(1, min(limit, app.config['SUGGEST_MAX_LIMIT']))
+
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'questions': [{'id': question_id, 'snippet': text}
+                          for question_id, text
+                          in suggestion_index.suggest(query, limit)],
+            'categories': suggest_categories(query, limit),
+        })
+
+    '''
+        handles GET requests for the statistics of the questions per
+        category, read from the category_stats aggregates
+    '''
+    @app.route('/stats')
+    @response_cache.cached
+    def retrieve_stats():
+        current_categories = get_categories()
+        totals = new_statistics()
+        categories = {category_id: new_statistics(category_id, name)
+                      for category_id, name in current_categories.items()}
+        for stats in CategoryStats.query.filter(
+                CategoryStats.questions != 0):
+            targets = [totals]
+            if stats.category in categories:
+                targets.append(categories[stats.category])
+            for target in targets:
+                add_statistics(target, stats)
+
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'total_questions': totals['total_questions'],
+            'difficulties': totals['difficulties'],
+            'average_rating': finish_statistics(totals)['average_rating'],
+            'categories': [finish_statistics(categories[category_id])
+                           for category_id in sorted(categories)]
+        })
+
     '''
         handles GET requests to retrieve questions based on category.
     '''
     @app.route('/categories/<int:category_id>/questions')
+    @response_cache.cached
     def retrieve_questions_by_category(category_id):
         try:
-            # get the matching question
-            questions_by_category = Question.query.filter(
-                Question.category == category_id).all()
-            # paginate the selection
-            questions_result = paginate_questions(questions_by_category)
-            total_questions = len(questions_result)
+            # get the matching questions of the requested page
+            questions_result = questions_page(category_id)
+            # every question of the category, not only the page
+            total_questions = questions_total(category_id)
             # abort 404 if no questions found
             if len(questions_result) == 0:
                 abort(404)
-            # get all available categories.
-            categories = Category.query.order_by(Category.id).all()
-
-            # add categories to current categories dictionaries
-            current_categories = {}
-            for category in categories:
-                current_categories[category.id] = category.type
+            # get all available categories from the cache
+            current_categories = get_categories()
 
             # return success response in json format to view
-            return jsonify({
+            return json_response({
                 "success": True,
-                "questions": questions_result,
+                "questions": questions_fragment(questions_result),
                 "total_questions": total_questions,
                 "current_category": current_categories[category_id]
             })
@@ -252,81 +489,405 @@ def create_app(config='development'):
             abort(404)
 
     '''
-        handles POST requests for playing quiz.
+        handles POST requests for playing quiz,
+        in random or in adaptive mode
     '''
     @app.route('/quizzes', methods=['POST'])
-    def play_quiz():
-        try:
-            # load the request body
-            body = request.get_json()
+    @read_only
+    @admission_control.limited
+    @json_body(schemas['quiz'])
+    def play_quiz(body):
+        # get the category and the previous questions
+        category_id = quiz_category_id(body['quiz_category'])
+        previous_questions = body['previous_questions']
+
+        if body['mode'] == 'adaptive':
+            # picks a question weighted by rating at the difficulty
+            # matching the accuracy of the player
+            question = pick_adaptive_question(
+                adaptive_index, category_id, previous_questions,
+                body['correct_answers'])
+        elif question_store is not None:
+            # picks a random question of the columnar store
+            question = question_store.pick(category_id, previous_questions)
+        else:
+            # picks a random question that is not in previous list
+            # without loading all available questions
+            question = pick_random_question(
+                quiz_selection(category_id), previous_questions)
+        if question is not None:
+            new_question = question.format()
+        else:
+            new_question = None
 
-            # get the category
-            quiz_category = body.get('quiz_category')
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'question': new_question
+        })
 
-            # get the previous questions
-            previous_questions = body.get('previous_questions')
+    '''
+        handles POST requests for starting a quiz session.
+    '''
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @read_only
+    @json_body(schemas['quiz_category'])
+    def create_quiz_session(body):
+        category_id = quiz_category_id(body['quiz_category'])
+
+        # draw the ids of the questions once per session, in random order
+        if question_store is not None:
+            question_ids = question_store.question_ids(category_id)
+        else:
+            selection = quiz_selection(category_id)
+            question_ids = [
+                question_id for (question_id,) in
+                selection.with_entities(Question.id).all()]
+        question_ids = random.sample(question_ids, min(
+            len(question_ids), app.config['QUIZ_SESSION_MAX_QUESTIONS']))
 
-            # load questions all questions if "ALL" is selected
-            # if user click on all category type : click
-            if quiz_category.get('type') == "click":
-                # available question will be all questions form all categories
-                # except questions in previous list
-                available_questions = Question.query.filter(
-                    Question.id.notin_(previous_questions)).all()
+        session_id = new_session_id()
+        quiz_sessions.create(session_id, question_ids)
 
-            # if user click any one of categories
-            # will use filter on category type
-            else:
-                # available question will be all
-                # questions form selected category
-                # except questions in previous list
-                available_questions = Question.query.filter(
-                    (Question.category == quiz_category.get('id')),
-                    (Question.id.notin_(previous_questions))).all()
-            if len(available_questions) > 0:
-                # picks a random question
-                # get new random question using module
-                # random with method randrange
-                new_question = available_questions[
-                    random.randrange(0, len(available_questions))].format()
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'session_id': session_id,
+            'total_questions': len(question_ids)
+        })
+
+    '''
+        handles POST requests for the next question of a quiz session.
+    '''
+    @app.route('/quizzes/sessions/<session_id>/next', methods=['POST'])
+    @read_only
+    def next_quiz_session_question(session_id):
+        new_question = None
+        while True:
+            # pop the next question id of the session queue
+            try:
+                question_id = quiz_sessions.pop(session_id)
+            except KeyError:
+                abort(404)
+            if question_id is None:
+                break
+            # skip questions deleted since the session was created
+            if question_store is not None:
+                question = question_store.get(question_id)
             else:
-                new_question = None
+                question = Question.query.get(question_id)
+            if question is not None:
+                new_question = question.format()
+                break
 
-            # return success response in json format to view
-            return jsonify({
-                'success': True,
-                'question': new_question
-            })
-        except:
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'question': new_question
+        })
+
+    '''
+        handles DELETE requests for ending a quiz session.
+    '''
+    @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+    def delete_quiz_session(session_id):
+        try:
+            quiz_sessions.delete(session_id)
+        except KeyError:
+            abort(404)
+
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'deleted': session_id
+        })
+
+    '''
+        handles POST requests for assigning a random precomputed deck
+        of the quiz category to a player
+    '''
+    @app.route('/quizzes/decks', methods=['POST'])
+    @read_only
+    @json_body(schemas['quiz_category'])
+    def assign_quiz_deck(body):
+        category_id = quiz_category_id(body['quiz_category'])
+
+        # abort 404 if the category has no questions
+        deck_id, total_questions = deck_store.assign(category_id)
+        if deck_id is None:
+            abort(404)
+
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'deck_id': deck_id,
+            'total_questions': total_questions
+        })
+
+    '''
+        handles GET requests for the question at an offset of a deck,
+        a slice of the pre-serialised deck without any query
+    '''
+    @app.route('/quizzes/decks/<deck_id>/<int:offset>')
+    def retrieve_deck_question(deck_id, offset):
+        # abort 404 if the deck was rebuilt since it was assigned
+        try:
+            deck_set, order = deck_store.lookup(deck_id)
+        except KeyError:
+            abort(404)
+
+        # the question is null past the end of the deck
+        question = None
+        next_offset = None
+        if offset < len(order):
+            question = Fragment(deck_set.payload(order[offset]))
+            if offset + 1 < len(order):
+                next_offset = offset + 1
+
+        # return success response in json format to view
+        return json_response({
+            'success': True,
+            'deck_id': deck_id,
+            'question': question,
+            'next_offset': next_offset,
+            'total_questions': len(order)
+        })
+
+    '''
+        handles POST requests for opening a live quiz room,
+        its questions are picked once for every player
+    '''
+    @app.route('/rooms', methods=['POST'])
+    @read_only
+    @json_body(schemas['room'])
+    def create_room(body):
+        category_id = quiz_category_id(body['quiz_category'])
+        count = body['questions'] or app.config['ROOM_QUESTIONS']
+
+        # abort 404 if the category has no questions
+        questions = room_questions(category_id, count)
+        if not questions:
+            abort(404)
+        room = live_rooms.create(category_id, questions)
+
+        # the host token moves the room through its questions
+        return jsonify({
+            'success': True,
+            'room_id': room.id,
+            'host_token': room.host_token,
+            'total_questions': len(questions)
+        })
+
+    '''
+        handles POST requests for joining a live quiz room.
+    '''
+    @app.route('/rooms/<room_id>/players', methods=['POST'])
+    @json_body(schemas['player'])
+    def join_room(body, room_id):
+        room = live_rooms.get(room_id)
+        if room is None:
+            abort(404)
+        name = body['name'].strip()
+        if not name:
             abort(400)
 
+        # abort 422 if the room already ended or is full
+        player_id = room.join(name)
+        if player_id is None:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'player_id': player_id
+        })
+
     '''
-        handles PATCH request to update question rating
+        handles POST requests of the host for the results of the current
+        question of a room and the next question, the end after the last
     '''
-    @app.route('/questions/<int:question_id>', methods=['PATCH'])
-    def update_question(question_id):
-        # load the request body
-        body = request.get_json()
+    @app.route('/rooms/<room_id>/next', methods=['POST'])
+    @json_body(schemas['host'])
+    def advance_room(body, room_id):
+        room = live_rooms.get(room_id)
+        if room is None:
+            abort(404)
+        if not room.is_host(body['host_token']):
+            abort(403)
+        if not room.advance():
+            abort(422)
+        return jsonify({
+            'success': True,
+            'question_number': room.current + 1,
+            'finished': room.closed
+        })
+
+    '''
+        handles POST requests for answering the current question of a
+        room, only the first answer of a player counts
+    '''
+    @app.route('/rooms/<room_id>/answers', methods=['POST'])
+    @json_body(schemas['answer'])
+    def answer_room_question(body, room_id):
+        room = live_rooms.get(room_id)
+        if room is None:
+            abort(404)
         try:
-            # get the matching question
-            question = Question.query.filter(
-                Question.id == question_id).one_or_none()
-            if question is None:
-                abort(404)
-            # update model question rating by value from client request
-            if 'rating' in body:
-                question.rating = int(body.get('rating'))
+            accepted = room.answer(body['player_id'], body['answer'])
+        except KeyError:
+            abort(404)
+        return jsonify({
+            'success': True,
+            'accepted': accepted
+        })
 
-            question.update()
+    '''
+        handles GET requests for the Server-Sent Events of a room: the
+        questions and the results since the Last-Event-ID of the client.
+        Each stream holds a thread, the ASGI mode serves them natively.
+    '''
+    @app.route('/rooms/<room_id>/events')
+    def stream_room_events(room_id):
+        room = live_rooms.get(room_id)
+        if room is None:
+            abort(404)
+        return Response(
+            room_stream(room, last_event_id(
+                request.headers.get('Last-Event-ID')),
+                app.config['ROOM_HEARTBEAT']),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache',
+                     'X-Accel-Buffering': 'no'})
 
-            # return success response in json format to view
-            return jsonify({
-                'id': question_id,
-                'success': True,
-            })
+    '''
+        handles PATCH request to update question rating,
+        the rating is buffered and written with the next batch
+    '''
+    @app.route('/questions/<int:question_id>', methods=['PATCH'])
+    @json_body(schemas['rating'])
+    def update_question(body, question_id):
+        # check the question exists, without loading it
+        if not existing_questions([question_id]):
+            abort(404)
+        # queue model question rating by value from client request
+        if body['rating'] is not None:
+            rating_buffer.submit({question_id: body['rating']})
 
-        except:
+        # return success response in json format to view
+        return jsonify({
+            'id': question_id,
+            'success': True,
+        })
+
+    '''
+        handles PATCH request to update the ratings of many questions,
+        {"ratings": [{"id": 5, "rating": 4}, ...]}, unknown ids are
+        reported and skipped
+    '''
+    @app.route('/questions', methods=['PATCH'])
+    @json_body(schemas['ratings'])
+    def update_question_ratings(body):
+        # the last rating of an id wins
+        ratings = {update['id']: update['rating']
+                   for update in body['ratings']}
+
+        # the ids that exist, read without loading the questions
+        found = existing_questions(ratings)
+        if found:
+            rating_buffer.submit({question_id: rating for question_id, rating
+                                  in ratings.items() if question_id in found})
+
+        # return success response in json format to view
+        return jsonify({
+            'success': True,
+            'updated': sorted(found),
+            'not_found': sorted(set(ratings) - found),
+        })
+
+    '''
+        handles GET requests for the connection pool statistics
+        of the worker, local clients only
+    '''
+    @app.route('/diagnostics/pool')
+    @local_only
+    def diagnostics_pool():
+        return jsonify({
+            'success': True,
+            'pool': pool_status(db.engine)
+        })
+
+    '''
+        handles GET requests for the request metrics of the worker
+        in the Prometheus text format, local clients only
+    '''
+    @app.route('/metrics')
+    @local_only
+    def diagnostics_metrics():
+        if instrumentation is None:
             abort(404)
+        return app.response_class(instrumentation.render(),
+                                  mimetype='text/plain; version=0.0.4')
+
+    '''
+        command line: `flask migrate` applies the pending schema migrations
+    '''
+    @app.cli.command('migrate')
+    def migrate():
+        # the migrations are only loaded by the command line
+        from migrations import upgrade
+        upgraded = upgrade(db.engine)
+        for version, name in upgraded:
+            click.echo('applied migration {:04d} {}'.format(version, name))
+        if not upgraded:
+            click.echo('database schema is up to date')
+
+    '''
+        command line: `flask create-db` creates the missing tables, then
+        applies the migrations, recorded without changes on new tables
+    '''
+    @app.cli.command('create-db')
+    def create_database():
+        from migrations import upgrade
+        db.create_all()
+        upgrade(db.engine)
+        click.echo('database tables created')
+
+    '''
+        builds the quiz decks into DECK_FILE,
+        the workers map it on their first deck request
+    '''
+    @app.cli.command('build-decks')
+    def build_decks():
+        if not app.config['DECK_FILE']:
+            raise click.UsageError('DECK_FILE is not set')
+        deck_set = deck_store.build()
+        write_deck_file(deck_set, app.config['DECK_FILE'])
+        click.echo('decks {} written to {}'.format(
+            deck_set.generation, app.config['DECK_FILE']))
+
+    '''
+        command line: `flask refresh-stats` recomputes the category
+        statistics, after changing questions outside of the app
+    '''
+    @app.cli.command('refresh-stats')
+    def refresh_stats():
+        from migrations import refresh_category_stats
+        with db.engine.begin() as connection:
+            refresh_category_stats(connection)
+        response_cache.invalidate()
+        click.echo('category statistics refreshed')
+
+    '''
+        loads the questions in the columnar layout and writes them to
+        QUESTION_SNAPSHOT, the workers map it on start
+    '''
+    @app.cli.command('snapshot-questions')
+    def snapshot_questions():
+        if not app.config['QUESTION_SNAPSHOT']:
+            raise click.UsageError('QUESTION_SNAPSHOT is not set')
+        with primary_reads():
+            store = ColumnarStore.from_database()
+        store.write_snapshot(app.config['QUESTION_SNAPSHOT'])
+        click.echo('{} questions written to {}'.format(
+            store.count(), app.config['QUESTION_SNAPSHOT']))
 
     '''
         error handlers for 400
@@ -339,6 +900,17 @@ def create_app(config='development'):
             "message": "Bad Request"
         }), 400
 
+    '''
+        error handlers for 403
+    '''
+    @app.errorhandler(403)
+    def forbidden(error):
+        return jsonify({
+            "success": False,
+            "error": 403,
+            "message": "Forbidden"
+        }), 403
+
     '''
         error handlers for 404
     '''
@@ -361,6 +933,54 @@ def create_app(config='development'):
             "message": "Unprocessable Entity"
         }), 422
 
+    '''
+        error handlers for 413
+    '''
+    @app.errorhandler(413)
+    def request_entity_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "Request Entity Too Large"
+        }), 413
+
+    '''
+        error handlers for 429, with the seconds to wait before retrying
+    '''
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        response = jsonify({
+            "success": False,
+            "error": 429,
+            "message": "Too Many Requests"
+        })
+        response.headers['Retry-After'] = retry_after_header(error)
+        return response, 429
+
+    '''
+        error handlers for 503, with the seconds to wait before retrying
+    '''
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "Service Unavailable"
+        })
+        response.headers['Retry-After'] = retry_after_header(error)
+        return response, 503
+
+    '''
+        error handlers for 415
+    '''
+    @app.errorhandler(415)
+    def unsupported_media_type(error):
+        return jsonify({
+            "success": False,
+            "error": 415,
+            "message": "Unsupported Media Type"
+        }), 415
+
     '''
         error handlers for 405
     '''
@@ -372,4 +992,7 @@ def create_app(config='development'):
             "message": "Method Not Allowed"
         }), 405
 
+    # clients over their rate are answered in front of the application
+    admission_control.install(app)
+
     return app
@@ -0,0 +1,331 @@
+# third-party imports
+from threading import Lock
+import random
+
+# local imports
+from models import (listen_for_changes, primary_reads, db, Question,
+                    QUESTION_RATINGS)
+
+# rating and difficulty of the questions that have none
+DEFAULT_RATING = 3
+DEFAULT_DIFFICULTY = 3
+
+# draws tried before giving up on questions deleted by another worker
+# since the last sync of the index
+ADAPTIVE_PICK_RETRIES = 3
+
+
+# method for the sampling weight of a question, higher rated comes first
+def question_weight(rating):
+    if rating is None:
+        rating = DEFAULT_RATING
+    return max(int(rating), 1)
+
+
+'''
+target_difficulty(correct_answers, answered, lowest, highest)
+    difficulty matching the running accuracy of a player, from `lowest`
+    at 0% to `highest` at 100%. The accuracy is smoothed towards 50% so
+    that a new player starts in the middle and one answer does not jump
+    to an extreme.
+'''
+
+
+def target_difficulty(correct_answers, answered, lowest, highest):
+    accuracy = (correct_answers + 1.0) / (answered + 2.0)
+    return lowest + accuracy * (highest - lowest)
+
+
+class FenwickTree(object):
+    """
+    Binary indexed tree of integer weights: prefix sums, updates and
+    weighted draws in O(log n)
+    """
+
+    def __init__(self, weights=()):
+        self.weights = list(weights)
+        self.tree = [0] * (len(self.weights) + 1)
+        # linear construction, each node pushes its sum to its parent
+        for index, weight in enumerate(self.weights, start=1):
+            self.tree[index] += weight
+            parent = index + (index & -index)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[index]
+
+    def __len__(self):
+        return len(self.weights)
+
+    def prefix(self, count):
+        """Returns the sum of the first `count` weights"""
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    @property
+    def total(self):
+        return self.prefix(len(self.weights))
+
+    def add(self, position, delta):
+        self.weights[position] += delta
+        index = position + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def set(self, position, weight):
+        self.add(position, weight - self.weights[position])
+
+    def append(self, weight):
+        index = len(self.tree)
+        # the new node covers its own weight and the lowbit range before it
+        self.tree.append(weight + self.prefix(index - 1)
+                         - self.prefix(index - (index & -index)))
+        self.weights.append(weight)
+
+    def find(self, target):
+        """Returns the position whose cumulative range holds `target`"""
+        position = 0
+        step = 1 << (len(self.weights).bit_length())
+        while step:
+            index = position + step
+            if index < len(self.tree) and self.tree[index] <= target:
+                position = index
+                target -= self.tree[index]
+            step >>= 1
+        return position
+
+
+'''
+WeightedBucket
+    questions of one category and difficulty with their weights, deleted
+    questions leave a zero weight slot reused by the next insert
+'''
+
+
+class WeightedBucket(object):
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self.free = []
+        self.tree = FenwickTree()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, question_id, weight):
+        position = self.positions.get(question_id)
+        if position is not None:
+            self.tree.set(position, weight)
+            return
+        if self.free:
+            position = self.free.pop()
+            self.ids[position] = question_id
+            self.tree.set(position, weight)
+        else:
+            position = len(self.ids)
+            self.ids.append(question_id)
+            self.tree.append(weight)
+        self.positions[question_id] = position
+
+    def remove(self, question_id):
+        position = self.positions.pop(question_id, None)
+        if position is not None:
+            self.tree.set(position, 0)
+            self.ids[position] = None
+            self.free.append(position)
+
+    def draw(self, generator, excluded=()):
+        """Returns a question id drawn by weight, not in `excluded`"""
+        # played questions weigh nothing during the draw
+        hidden = [(position, self.tree.weights[position]) for position in
+                  (self.positions.get(question_id)
+                   for question_id in excluded) if position is not None]
+        for position, _ in hidden:
+            self.tree.set(position, 0)
+        try:
+            total = self.tree.total
+            if total <= 0:
+                return None
+            return self.ids[self.tree.find(generator.randrange(total))]
+        finally:
+            for position, weight in hidden:
+                self.tree.set(position, weight)
+
+
+'''
+AdaptiveQuizIndex
+    weighted buckets of the questions by category and difficulty, plus
+    buckets of all categories by difficulty, built on first use and
+    kept up to date from the committed question changes. `changes`, a
+    ChangeWatcher, reloads it after the writes of the other workers.
+'''
+
+
+class AdaptiveQuizIndex(object):
+
+    def __init__(self, generator=None, changes=None):
+        self.lock = Lock()
+        self.generator = generator or random.Random()
+        self.changes = changes
+        # (category id or None, difficulty) -> WeightedBucket
+        self.buckets = None
+        # question id -> (category, difficulty)
+        self.placements = None
+        # only the weights are read again on next use
+        self.ratings_stale = False
+
+    def build(self):
+        self.buckets = {}
+        self.placements = {}
+        self.ratings_stale = False
+        with primary_reads():
+            rows = db.session.query(Question.id, Question.category,
+                                    Question.difficulty, Question.rating).all()
+        for question_id, category, difficulty, rating in rows:
+            self.place(question_id, category, difficulty, rating)
+
+    def reweigh(self):
+        """Reads the ratings again, the questions stay in their buckets"""
+        self.ratings_stale = False
+        with primary_reads():
+            rows = db.session.query(Question.id, Question.rating).all()
+        for question_id, rating in rows:
+            self.rate(question_id, rating)
+
+    def rate(self, question_id, rating):
+        placement = self.placements.get(question_id)
+        if placement is not None:
+            self.place(question_id, placement[0], placement[1], rating)
+
+    def place(self, question_id, category, difficulty, rating):
+        if difficulty is None:
+            difficulty = DEFAULT_DIFFICULTY
+        weight = question_weight(rating)
+        self.placements[question_id] = (category, difficulty)
+        for key in ((category, difficulty), (None, difficulty)):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = WeightedBucket()
+            bucket.add(question_id, weight)
+
+    def displace(self, question_id):
+        placement = self.placements.pop(question_id, None)
+        if placement is None:
+            return
+        category, difficulty = placement
+        for key in ((category, difficulty), (None, difficulty)):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.remove(question_id)
+
+    def on_change(self, operation, record):
+        with self.lock:
+            if self.buckets is None:
+                return
+            if operation == 'reload':
+                self.buckets = None
+                self.placements = None
+                return
+            question_id = record['id']
+            if operation == 'delete':
+                self.displace(question_id)
+                return
+            # a new rating only changes a weight, a new category or
+            # difficulty moves the question to another bucket
+            difficulty = record['difficulty']
+            if difficulty is None:
+                difficulty = DEFAULT_DIFFICULTY
+            if self.placements.get(question_id) != (record['category'],
+                                                    difficulty):
+                self.displace(question_id)
+            self.place(question_id, record['category'], difficulty,
+                       record['rating'])
+
+    def on_rating_change(self, operation, record):
+        with self.lock:
+            if self.buckets is None:
+                return
+            if operation == 'reload':
+                self.ratings_stale = True
+            else:
+                self.rate(record['id'], record['rating'])
+
+    def forget(self, question_id):
+        """Removes a question found deleted before the index synced"""
+        with self.lock:
+            if self.buckets is not None:
+                self.displace(question_id)
+
+    def draw(self, category_id, excluded, correct_answers, answered):
+        """
+        Returns the id of a question of `category_id` (None for all
+        categories) not in `excluded`, drawn by rating at the difficulty
+        nearest to the accuracy of the player, None when none is left
+        """
+        if self.changes is not None:
+            self.changes.sync()
+        with self.lock:
+            if self.buckets is None:
+                self.build()
+            elif self.ratings_stale:
+                self.reweigh()
+            difficulties = sorted({difficulty for category, difficulty
+                                   in self.buckets if category is None})
+            if not difficulties:
+                return None
+            target = target_difficulty(correct_answers, answered,
+                                       difficulties[0], difficulties[-1])
+            for difficulty in sorted(
+                    difficulties,
+                    key=lambda difficulty: (abs(difficulty - target),
+                                            difficulty)):
+                bucket = self.buckets.get((category_id, difficulty))
+                if bucket is None:
+                    continue
+                question_id = bucket.draw(self.generator, excluded)
+                if question_id is not None:
+                    return question_id
+            return None
+
+
+'''
+pick_adaptive_question(index, category_id, previous_questions,
+                       correct_answers)
+    picks a question weighted by rating at the difficulty matching the
+    running accuracy of the player, None when every question was played
+'''
+
+
+def pick_adaptive_question(index, category_id, previous_questions,
+                           correct_answers):
+    excluded = set(previous_questions)
+    for _ in range(ADAPTIVE_PICK_RETRIES):
+        question_id = index.draw(category_id, excluded, correct_answers,
+                                 len(previous_questions))
+        if question_id is None:
+            return None
+        question = Question.query.get(question_id)
+        if question is not None:
+            return question
+        # deleted by another worker since the last sync, drop its weight
+        index.forget(question_id)
+        excluded.add(question_id)
+    return None
+
+
+'''
+create_adaptive_index(app)
+    creates the adaptive quiz index of the application, updated after
+    each committed write of questions and reloaded after the writes of
+    the other workers, whose ratings only change the weights
+'''
+
+
+def create_adaptive_index(app):
+    index = AdaptiveQuizIndex(changes=app.extensions['change_watcher'])
+    listen_for_changes(app, Question.__tablename__, index.on_change)
+    listen_for_changes(app, QUESTION_RATINGS, index.on_rating_change)
+    return index
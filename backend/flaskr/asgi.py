@@ -0,0 +1,649 @@
+"""
+ASGI entry point of the trivia API.
+
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+
+POST /quizzes, and POST /questions/search with the postgres search
+backend, are served natively on the event loop: their queries go
+through asyncpg so a worker keeps serving other requests while postgres
+answers. The event streams of the live rooms wait on the event loop
+too, so a worker holds thousands of them. Every other route runs the
+Flask application in a thread pool.
+Both paths share the request validation, the quiz pick and search
+queries, the rate limits and the serialisation of the Flask views. The
+native routes skip the hooks of the Flask application: they always read
+from the primary, and are not instrumented.
+"""
+# third-party imports
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from werkzeug.http import HTTP_STATUS_CODES
+import asyncio
+import importlib.util
+import io
+import json
+import os
+import re
+import sys
+import weakref
+
+# local imports
+from models import db, Question
+from . import create_app, search_window
+from .adaptive import pick_adaptive_question
+from .columnar import StaleStore
+from .quiz import category_criteria, random_pick
+from .ratelimit import client_address, retry_after_header, Overloaded
+from .rooms import last_event_id, KEEP_ALIVE
+from .search import PostgresSearchBackend
+from .serialization import QUESTION_COLUMNS, QuestionRow
+from .validation import quiz_category_id
+
+# event streams of the live rooms, served on the event loop
+ROOM_EVENTS_PATH = re.compile(r'^/rooms/([^/]+)/events$')
+
+# read_json results of the bodies over JSON_MAX_BYTES and of a
+# Content-Length that is not a number of bytes
+TOO_LARGE = object()
+BAD_LENGTH = object()
+
+# messages of the error handlers of create_app
+ERROR_MESSAGES = {
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Resource Not Found',
+    405: 'Method Not Allowed',
+    413: 'Request Entity Too Large',
+    415: 'Unsupported Media Type',
+    422: 'Unprocessable Entity',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable',
+}
+
+
+class AsyncDatabase(object):
+    """Interface of the databases of the native async routes"""
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def fetch(self, statement):
+        """Returns the rows of a SQLAlchemy core statement"""
+        raise NotImplementedError
+
+    async def scalar(self, statement):
+        rows = await self.fetch(statement)
+        return rows[0][0] if rows else None
+
+
+class AsyncpgDatabase(AsyncDatabase):
+    """
+    asyncpg connection pool, statements are compiled by the postgres
+    dialect with numbered parameters
+    """
+    dialect = postgresql.dialect(paramstyle='numeric')
+    parameter = re.compile(r'(?<![:\w]):(\d+)')
+
+    def __init__(self, database_uri, min_size=1, max_size=10):
+        url = make_url(database_uri)
+        url.drivername = 'postgresql'
+        self.dsn = str(url)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+
+    async def start(self):
+        import asyncpg
+        self.pool = await asyncpg.create_pool(
+            self.dsn, min_size=self.min_size, max_size=self.max_size)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    def compile(self, statement):
+        compiled = statement.compile(dialect=self.dialect)
+        params = [compiled.params[name] for name in compiled.positiontup]
+        return self.parameter.sub(r'$\1', compiled.string), params
+
+    async def fetch(self, statement):
+        sql, params = self.compile(statement)
+        async with self.pool.acquire() as connection:
+            return await connection.fetch(sql, *params)
+
+
+class ThreadedDatabase(AsyncDatabase):
+    """
+    Runs the statements on the SQLAlchemy engine in the thread pool,
+    for databases without an async driver such as sqlite
+    """
+
+    def __init__(self, app, executor):
+        self.app = app
+        self.executor = executor
+
+    def run(self, statement):
+        with db.get_engine(self.app).connect() as connection:
+            return connection.execute(statement).fetchall()
+
+    async def fetch(self, statement):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.run, statement)
+
+
+'''
+create_async_database(app, executor)
+    creates the database of `ASYNC_DATABASE`: 'asyncpg', 'threads' or
+    'auto' (asyncpg on postgres when it is installed, threads otherwise)
+'''
+
+
+def create_async_database(app, executor):
+    name = app.config.get('ASYNC_DATABASE', 'auto')
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    if name == 'auto':
+        name = 'threads'
+        if make_url(uri).get_backend_name() in ('postgres', 'postgresql'):
+            # found without importing it, asyncpg loads on the first query
+            if importlib.util.find_spec('asyncpg') is not None:
+                name = 'asyncpg'
+    if name == 'asyncpg':
+        return AsyncpgDatabase(uri, max_size=app.config['ASYNC_DB_POOL_SIZE'])
+    if name == 'threads':
+        return ThreadedDatabase(app, executor)
+    raise ValueError(f'Unknown async database {name!r}')
+
+
+class ReceiveStream(io.RawIOBase):
+    """wsgi.input of the thread pool, reads the ASGI request body"""
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = b''
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and self.more_body:
+            message = asyncio.run_coroutine_threadsafe(
+                self.receive(), self.loop).result()
+            self.pending = message.get('body', b'')
+            self.more_body = message.get('more_body', False)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+# method for the WSGI environ of an ASGI http scope
+def wsgi_environ(scope, stream):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    # chunked request bodies end with the last ASGI message
+    if 'CONTENT_LENGTH' not in environ:
+        environ['wsgi.input_terminated'] = True
+    return environ
+
+
+# method for the value of a request header of an ASGI http scope, the
+# repeated ones joined by commas
+def scope_header(scope, name):
+    values = [value.decode('latin-1') for key, value in scope['headers']
+              if key.lower() == name]
+    return ','.join(values) if values else None
+
+
+# method for waiting until the client of a response disconnects
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+'''
+TriviaASGI
+    ASGI application serving the native async routes on the event loop
+    and every other request with the Flask application in `executor`
+'''
+
+
+class TriviaASGI(object):
+
+    def __init__(self, app, executor, database):
+        self.app = app
+        self.executor = executor
+        self.database = database
+        self.started = None
+        self.schemas = app.extensions['request_schemas']
+        self.admission_control = app.extensions['admission_control']
+        # event loop -> slots of the native expensive routes
+        self.slots = weakref.WeakKeyDictionary()
+        self.routes = {('POST', '/quizzes'): self.play_quiz}
+        if isinstance(app.extensions['search_backend'],
+                      PostgresSearchBackend):
+            self.routes[('POST', '/questions/search')] = \
+                self.search_questions
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope {}'.format(
+                scope['type']))
+        match = ROOM_EVENTS_PATH.match(scope['path'])
+        if match is not None and scope['method'] == 'GET':
+            await self.stream_room(scope, receive, send, match.group(1))
+            return
+        handler = self.routes.get((scope['method'], scope['path']))
+        if handler is None:
+            await self.run_wsgi(scope, receive, send)
+            return
+        # the native routes share the rate limits of the flask views
+        admission_control = self.admission_control
+        client = client_address(
+            (scope.get('client') or ('',))[0],
+            scope_header(scope, b'x-forwarded-for'),
+            admission_control.trusted_proxies)
+        rejection = admission_control.check_rate(handler.__name__, client)
+        slots = None
+        if rejection is None and admission_control.max_concurrent:
+            slots = self.loop_slots()
+            try:
+                # a free slot is taken at once, even without queueing
+                if slots.locked():
+                    await asyncio.wait_for(slots.acquire(),
+                                           admission_control.queue_timeout)
+                else:
+                    await slots.acquire()
+            except asyncio.TimeoutError:
+                slots, rejection = None, Overloaded(1)
+        headers = []
+        if rejection is not None:
+            status, payload = rejection.code, None
+            headers.append((b'retry-after',
+                            retry_after_header(rejection).encode('latin-1')))
+        else:
+            try:
+                status, payload = await self.handle(scope, receive, handler)
+            finally:
+                if slots is not None:
+                    slots.release()
+        if payload is None:
+            payload = {'success': False, 'error': status,
+                       'message': ERROR_MESSAGES.get(
+                           status, HTTP_STATUS_CODES.get(status, 'Error'))}
+        await self.respond(send, status, payload, headers)
+
+    def loop_slots(self):
+        """
+        Returns the semaphore bounding the native expensive routes of
+        the running event loop to EXPENSIVE_MAX_CONCURRENT requests
+        """
+        loop = asyncio.get_event_loop()
+        slots = self.slots.get(loop)
+        if slots is None:
+            slots = self.slots[loop] = asyncio.Semaphore(
+                self.admission_control.max_concurrent)
+        return slots
+
+    async def handle(self, scope, receive, handler):
+        """Returns the status and the payload of a native route"""
+        body = await self.read_json(scope, receive)
+        if body is TOO_LARGE:
+            return 413, None
+        if body is BAD_LENGTH:
+            return 400, None
+        try:
+            await self.start()
+            return await handler(body)
+        except Exception:
+            self.app.logger.exception('%s %s failed', scope['method'],
+                                      scope['path'])
+            return 500, None
+
+    async def start(self):
+        """Opens the database once, on startup or on first use"""
+        if self.started is None:
+            self.started = asyncio.ensure_future(self.database.start())
+        await asyncio.shield(self.started)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_json(self, scope, receive):
+        """
+        Returns the JSON request body, None like Flask's get_json,
+        TOO_LARGE without reading the rest of a body over JSON_MAX_BYTES,
+        with or without a Content-Length, and BAD_LENGTH for a malformed
+        Content-Length
+        """
+        max_bytes = self.app.config['JSON_MAX_BYTES']
+        headers = dict(scope['headers'])
+        length = headers.get(b'content-length', b'0').strip()
+        if not length.isdigit():
+            return BAD_LENGTH
+        if int(length) > max_bytes:
+            return TOO_LARGE
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get('body', b''))
+            size += len(chunks[-1])
+            if size > max_bytes:
+                return TOO_LARGE
+            more_body = message.get('more_body', False)
+        mimetype = headers.get(b'content-type', b'').split(b';')[0].strip()
+        if mimetype != b'application/json' and not (
+                mimetype.startswith(b'application/')
+                and mimetype.endswith(b'+json')):
+            return None
+        try:
+            return json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError:
+            return None
+
+    def encode(self, payload):
+        """Returns `payload` serialised as jsonify does"""
+        config = self.app.config
+        if config['JSONIFY_PRETTYPRINT_REGULAR'] or self.app.debug:
+            indent, separators = 2, (', ', ': ')
+        else:
+            indent, separators = None, (',', ':')
+        return (json.dumps(payload, cls=self.app.json_encoder,
+                           indent=indent, separators=separators,
+                           sort_keys=config['JSON_SORT_KEYS'],
+                           ensure_ascii=config['JSON_AS_ASCII'])
+                + '\n').encode('utf-8')
+
+    async def respond(self, send, status, payload, headers=()):
+        body = self.encode(payload)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', self.app.config[
+                    'JSONIFY_MIMETYPE'].encode('latin-1')),
+                (b'content-length', str(len(body)).encode('latin-1')),
+                (b'access-control-allow-origin', b'*'),
+                (b'access-control-allow-headers',
+                 b'Content-Type,Authorization,true'),
+                (b'access-control-allow-methods',
+                 b'GET,PUT,POST,DELETE,OPTIONS'),
+            ] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    '''
+        handles GET requests for the Server-Sent Events of a live room,
+        every stream of the worker waits on one future of the room
+    '''
+    async def stream_room(self, scope, receive, send, room_id):
+        room = self.app.extensions['live_rooms'].get(room_id)
+        if room is None:
+            await self.respond(send, 404, {
+                'success': False, 'error': 404,
+                'message': ERROR_MESSAGES[404]})
+            return
+        headers = dict(scope['headers'])
+        last_event = last_event_id(
+            headers.get(b'last-event-id', b'').decode('latin-1'))
+        heartbeat = self.app.config['ROOM_HEARTBEAT']
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*'),
+            ],
+        })
+
+        loop = asyncio.get_event_loop()
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            while True:
+                events, closed, changed = room.poll(last_event, loop)
+                if events:
+                    last_event += len(events)
+                    await send({'type': 'http.response.body',
+                                'body': b''.join(events), 'more_body': True})
+                    continue
+                if changed is None:
+                    break
+                done, pending = await asyncio.wait(
+                    {changed, disconnected}, timeout=heartbeat,
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    return
+                if not done:
+                    await send({'type': 'http.response.body',
+                                'body': KEEP_ALIVE, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+    async def run_wsgi(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.call_wsgi,
+                                   scope, receive, send, loop)
+
+    def call_wsgi(self, scope, receive, send, loop):
+        """Runs the Flask application in a worker thread"""
+        response = {}
+        started = []
+
+        def forward(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+
+        def start():
+            if not started:
+                forward({'type': 'http.response.start',
+                         'status': response['status'],
+                         'headers': response['headers']})
+                started.append(True)
+
+        stream = io.BufferedReader(ReceiveStream(receive, loop))
+        result = self.app.wsgi_app(wsgi_environ(scope, stream),
+                                   start_response)
+        try:
+            # streamed responses are forwarded chunk by chunk
+            for chunk in result:
+                if chunk:
+                    start()
+                    forward({'type': 'http.response.body', 'body': chunk,
+                             'more_body': True})
+            start()
+            forward({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    async def fetch_questions(self, statement):
+        return [QuestionRow(*row)
+                for row in await self.database.fetch(statement)]
+
+    async def run_pick_step(self, criteria, step):
+        """Runs a step of random_pick, see quiz.run_pick_step"""
+        criteria = list(criteria)
+        if step[1]:
+            criteria.append(Question.id.notin_(step[1]))
+        if step[0] == 'count':
+            statement = select([func.count(Question.id)])
+        else:
+            statement = select(QUESTION_COLUMNS).order_by(
+                Question.id).offset(step[2]).limit(1)
+        for criterion in criteria:
+            statement = statement.where(criterion)
+        if step[0] == 'count':
+            return await self.database.scalar(statement)
+        questions = await self.fetch_questions(statement)
+        return questions[0] if questions else None
+
+    def play_adaptive_quiz(self, category_id, previous_questions,
+                           correct_answers):
+        """Adaptive pick in a worker thread, the index loads in SQL"""
+        with self.app.app_context():
+            question = pick_adaptive_question(
+                self.app.extensions['adaptive_index'], category_id,
+                previous_questions, correct_answers)
+            return question.format() if question is not None else None
+
+    def pick_stored_question(self, category_id, previous_questions):
+        """Pick of the columnar store in a worker thread, the versions
+        are read or the store reloaded in SQL first"""
+        with self.app.app_context():
+            return self.app.extensions['question_store'].pick(
+                category_id, previous_questions)
+
+    '''
+        handles POST requests for playing quiz,
+        the adaptive mode and the reloads of the store run in the thread
+        pool
+    '''
+    async def play_quiz(self, body):
+        validator = self.schemas['quiz']
+        body, error = validator(body)
+        if error is not None:
+            return validator.status, None
+
+        # get the category and the previous questions
+        category_id = quiz_category_id(body['quiz_category'])
+        previous_questions = body['previous_questions']
+        if body['mode'] == 'adaptive':
+            loop = asyncio.get_event_loop()
+            return 200, {
+                'success': True,
+                'question': await loop.run_in_executor(
+                    self.executor, self.play_adaptive_quiz, category_id,
+                    previous_questions, body['correct_answers'])
+            }
+
+        store = self.app.extensions.get('question_store')
+        if store is not None:
+            try:
+                # served from memory, nothing to wait for
+                question = store.pick(category_id, previous_questions,
+                                      queries=False)
+            except StaleStore:
+                loop = asyncio.get_event_loop()
+                question = await loop.run_in_executor(
+                    self.executor, self.pick_stored_question, category_id,
+                    previous_questions)
+            return 200, {
+                'success': True,
+                'question': question.format()
+                if question is not None else None
+            }
+
+        # picks a random question that is not in previous list
+        steps = random_pick(previous_questions)
+        criteria = category_criteria(category_id)
+        try:
+            step = next(steps)
+            while True:
+                step = steps.send(await self.run_pick_step(criteria, step))
+        except StopIteration as stop:
+            question = stop.value
+
+        return 200, {
+            'success': True,
+            'question': question.format() if question is not None else None
+        }
+
+    '''
+        handles POST requests for searching in questions,
+        with the full-text index of the postgres search backend
+    '''
+    async def search_questions(self, body):
+        validator = self.schemas['search']
+        body, error = validator(body)
+        if error is not None:
+            return validator.status, None
+        search_term = body['searchTerm']
+        if not search_term:
+            return 404, None
+        limit, offset = search_window(
+            body, self.app.config['SEARCH_MAX_RESULTS'])
+
+        # the count and the page run concurrently
+        match, order = PostgresSearchBackend.criteria(search_term)
+        total, questions = await asyncio.gather(
+            self.database.scalar(
+                select([func.count(Question.id)]).where(match)),
+            self.fetch_questions(
+                select(QUESTION_COLUMNS).where(match).order_by(
+                    *order).offset(offset).limit(limit)))
+
+        return 200, {
+            'success': True,
+            'questions': [question.format() for question in questions],
+            'total_questions': total,
+        }
+
+
+'''
+create_asgi_app(config, settings)
+    creates the Flask application of `config` (default FLASK_CONFIG or
+    development) and returns it as an ASGI application
+'''
+
+
+def create_asgi_app(config=None, settings=None):
+    if config is None:
+        config = os.environ.get('FLASK_CONFIG', 'development')
+    app = create_app(config, settings)
+    executor = ThreadPoolExecutor(max_workers=app.config['ASGI_THREADS'],
+                                  thread_name_prefix='trivia-wsgi')
+    return TriviaASGI(app, executor, create_async_database(app, executor))
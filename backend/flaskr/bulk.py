@@ -0,0 +1,245 @@
+# third-party imports
+from sqlalchemy.exc import SQLAlchemyError
+import csv
+import io
+import json
+
+try:
+    from psycopg2 import Error as PsycopgError
+except ImportError:
+    PsycopgError = None
+
+# local imports
+from models import (apply_category_stats, bump_version, count_question,
+                    get_categories, notify_changes, notify_commit, db,
+                    Question)
+from .serialization import row_json, QUESTION_COLUMNS, QUESTION_FIELDS
+
+# columns of the imported questions
+IMPORT_FIELDS = QUESTION_FIELDS[1:]
+
+# errors of a batch refused by the database or the driver, COPY raises
+# the errors of psycopg2 itself
+BATCH_ERRORS = (SQLAlchemyError, OverflowError, ValueError) + (
+    (PsycopgError,) if PsycopgError is not None else ())
+
+# content types of the bulk formats
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+'''
+resolve_format(name)
+    returns the bulk format of a `format` argument or a content type,
+    None for unsupported formats
+'''
+
+
+def resolve_format(name):
+    if name in FORMATS:
+        return name
+    for bulk_format, mimetype in FORMATS.items():
+        if name == mimetype:
+            return bulk_format
+    return None
+
+
+# method for decoding the lines of a binary stream
+def decode_lines(stream):
+    for line in stream:
+        yield line.decode('utf-8', errors='replace')
+
+
+'''
+parse_ndjson(lines)
+    yields (line number, row or error message) for each non empty line
+    of a newline delimited JSON stream
+'''
+
+
+def parse_ndjson(lines):
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, 'invalid JSON'
+            continue
+        if not isinstance(row, dict):
+            yield number, 'expected a JSON object'
+            continue
+        yield number, row
+
+
+'''
+parse_csv(lines)
+    yields (line number, row) for each record of a CSV stream whose
+    first line is the header, e.g. question,answer,category,difficulty
+'''
+
+
+def parse_csv(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+'''
+validate_row(row, categories, validator)
+    applies the rules of POST /questions, its compiled `validator`, to
+    an imported row whose empty CSV fields are missing values, returns
+    (question mapping, None) or (None, error message)
+'''
+
+
+def validate_row(row, categories, validator):
+    mapping, message = validator({
+        field: None if row.get(field) == '' else row.get(field)
+        for field in IMPORT_FIELDS})
+    if mapping is None:
+        return None, message
+    if mapping['category'] is not None and \
+            mapping['category'] not in categories:
+        return None, 'unknown category {}'.format(mapping['category'])
+    return mapping, None
+
+
+# method for the error message of a row refused by the database
+def refused(error):
+    cause = getattr(error, 'orig', None) or error
+    return 'refused by the database ({})'.format(type(cause).__name__)
+
+
+# method for inserting a batch of rows with COPY on postgres
+def copy_rows(batch):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for mapping in batch:
+        writer.writerow([mapping[field] for field in IMPORT_FIELDS])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        'COPY questions ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            ', '.join(IMPORT_FIELDS)), buffer)
+
+
+# method for inserting and committing a batch of rows and their statistics
+def insert_batch(batch):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        copy_rows(batch)
+    else:
+        db.session.bulk_insert_mappings(Question, batch)
+    deltas = {}
+    for mapping in batch:
+        count_question(deltas, mapping['category'], mapping['difficulty'],
+                       mapping['rating'])
+    apply_category_stats(db.session.connection(), deltas)
+    bump_version(db.session, Question.__tablename__)
+    db.session.commit()
+
+
+'''
+import_questions(rows, validator, batch_size, max_errors)
+    validates parsed rows with the `validator` of POST /questions and
+    inserts the valid ones in batches, a batch refused by the database
+    is inserted again row by row. Returns the number of inserted rows,
+    the number of rejected rows and the first `max_errors` errors as
+    {'line', 'message'}.
+'''
+
+
+def import_questions(rows, validator, batch_size=1000, max_errors=100):
+    categories = get_categories()
+    inserted = 0
+    rejected = 0
+    errors = []
+    batch = []
+    lines = []
+
+    def reject(line, message):
+        if len(errors) < max_errors:
+            errors.append({'line': line, 'message': message})
+
+    def flush():
+        nonlocal inserted, rejected
+        try:
+            insert_batch(batch)
+            inserted += len(batch)
+            return
+        except BATCH_ERRORS:
+            db.session.rollback()
+        # the rows refused by the database are rejected, the others kept
+        for line, mapping in zip(lines, batch):
+            try:
+                insert_batch([mapping])
+                inserted += 1
+            except BATCH_ERRORS as error:
+                db.session.rollback()
+                rejected += 1
+                reject(line, refused(error))
+
+    try:
+        for line, row in rows:
+            if isinstance(row, str):
+                mapping, message = None, row
+            else:
+                mapping, message = validate_row(row, categories,
+                                                validator)
+            if mapping is None:
+                rejected += 1
+                reject(line, message)
+                continue
+            batch.append(mapping)
+            lines.append(line)
+            if len(batch) >= batch_size:
+                flush()
+                batch, lines = [], []
+        if batch:
+            flush()
+    finally:
+        # rows were inserted without the unit of work, listeners must
+        # reload, also when a later batch failed
+        if inserted:
+            notify_changes(Question.__tablename__, 'reload', None)
+            notify_commit({Question.__tablename__})
+    return inserted, rejected, errors
+
+
+'''
+export_questions(export_format, batch_size)
+    yields the questions ordered by id as NDJSON lines or CSV rows,
+    read through a server-side cursor `batch_size` rows at a time
+'''
+
+
+def export_questions(export_format, batch_size=1000):
+    rows = db.session.query(*QUESTION_COLUMNS).order_by(
+        Question.id).execution_options(stream_results=True).yield_per(
+        batch_size)
+
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(QUESTION_FIELDS)
+        for count, row in enumerate(rows, start=1):
+            writer.writerow(row)
+            if count % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    # each line is written like json.dumps(question.format(), sort_keys=True)
+    chunk = []
+    for row in rows:
+        chunk.append(row_json(row))
+        if len(chunk) == batch_size:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
@@ -0,0 +1,290 @@
+# third-party imports
+from collections import OrderedDict, namedtuple
+from flask import g, request, make_response
+from functools import wraps
+from threading import Lock
+import hashlib
+import json
+import os
+import secrets
+import tempfile
+import time
+
+# local imports
+from models import listen_for_commits, Category, Question, QUESTION_RATINGS
+
+# tables of the cached responses, a commit changing one clears the cache
+CACHED_TABLES = frozenset((Question.__tablename__, QUESTION_RATINGS,
+                           Category.__tablename__))
+
+# a cached response body with its strong validator
+CacheEntry = namedtuple('CacheEntry', 'etag body mimetype expires_at')
+
+
+class CacheBackend(object):
+    """Interface of the response cache backends"""
+
+    def get(self, key):
+        """Returns the entry of `key`, None if missing or expired"""
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def generation(self):
+        """
+        Returns the stamp of the last clear seen by every worker sharing
+        the backend, None when the backend belongs to one worker
+        """
+        return None
+
+
+class LRUCacheBackend(CacheBackend):
+    """
+    In-process backend bounded by a number of entries and a total
+    body size, evicts the least recently used entries first
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.time():
+                self.size -= len(self.entries.pop(key).body)
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        if len(entry.body) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while (len(self.entries) > self.max_entries
+                   or self.size > self.max_bytes):
+                self.size -= len(self.entries.popitem(last=False)[1].body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class FileSystemCacheBackend(CacheBackend):
+    """
+    Backend storing one file per entry in `directory`, shared by the
+    workers of a host: a write in any worker clears it for all of them.
+    Each clear writes a new stamp to the generation file and entries
+    filled under an older stamp are ignored, so a worker storing a
+    response it read before another worker's write cannot serve it.
+    The directory is created private to the user of the workers, an
+    existing one is refused when other users may write to it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.stamp_path = os.path.join(directory, 'generation')
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.stat(directory)
+        if status.st_uid != os.getuid() or status.st_mode & 0o077:
+            raise ValueError('{} must be a directory of the user of the '
+                             'workers, without access for other users'
+                             .format(directory))
+
+    def path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.cache')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as cache_file:
+                header = json.loads(cache_file.readline().decode('utf-8'))
+                body = cache_file.read()
+        except (OSError, ValueError):
+            return None
+        if header['expires_at'] <= time.time() or \
+                header.get('generation') != self.generation():
+            return None
+        return CacheEntry(header['etag'], body, header['mimetype'],
+                          header['expires_at'])
+
+    def set(self, key, entry):
+        header = json.dumps({'etag': entry.etag, 'mimetype': entry.mimetype,
+                             'expires_at': entry.expires_at,
+                             'generation': self.generation()})
+        # write then rename, readers never see a partial file
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, 'wb') as cache_file:
+            cache_file.write(header.encode('utf-8') + b'\n')
+            cache_file.write(entry.body)
+        os.replace(temporary, self.path(key))
+
+    def clear(self):
+        self.write_stamp(secrets.token_hex(8))
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def write_stamp(self, stamp):
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(descriptor, 'w') as stamp_file:
+            stamp_file.write(stamp)
+        os.replace(temporary, self.stamp_path)
+
+    def generation(self):
+        try:
+            with open(self.stamp_path) as stamp_file:
+                return stamp_file.read()
+        except OSError:
+            return None
+
+
+'''
+ResponseCache
+    caches the successful responses of GET views by path and query
+    string, with strong ETags: a request whose If-None-Match matches a
+    cached entry gets a 304 without running the view. A response is
+    only stored when no invalidation happened while its view ran,
+    locally or, for a shared backend, in another worker. `changes`, a
+    ChangeWatcher, clears it after the writes of the other workers, on
+    any host.
+'''
+
+
+class ResponseCache(object):
+
+    def __init__(self, backend, ttl=60, max_age=0, settle=0, changes=None):
+        self.backend = backend
+        self.changes = changes
+        self.ttl = ttl
+        self.max_age = max_age
+        # seconds after a write during which responses read from lagging
+        # replicas are not cached
+        self.settle = settle
+        self.invalidated_at = float('-inf')
+        # incremented by each invalidation, under the lock with the clear
+        self.generation = 0
+        self.lock = Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.invalidated_at = time.monotonic()
+            self.backend.clear()
+
+    def on_commit(self, tablenames):
+        """Clears the cache once per commit of the cached tables"""
+        if not CACHED_TABLES.isdisjoint(tablenames):
+            self.invalidate()
+
+    def current(self):
+        return self.generation, self.backend.generation()
+
+    def store(self, key, entry, generation):
+        """Stores `entry` unless the cache was invalidated since
+        `generation` was read"""
+        with self.lock:
+            if self.current() == generation:
+                self.backend.set(key, entry)
+
+    def finish(self, response, etag):
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = \
+            'public, max-age={}'.format(self.max_age)
+        return response
+
+    def not_modified(self, etag):
+        return self.finish(make_response('', 304), etag)
+
+    def cached(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # a client reading its own writes skips the cache
+            if g.get('recent_write'):
+                return view(*args, **kwargs)
+            if self.changes is not None:
+                self.changes.sync()
+            key = request.full_path
+            entry = self.backend.get(key)
+            if entry is None:
+                generation = self.current()
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                if time.monotonic() - self.invalidated_at < self.settle:
+                    return response
+                body = response.get_data()
+                entry = CacheEntry(hashlib.sha1(body).hexdigest(), body,
+                                   response.mimetype, time.time() + self.ttl)
+                self.store(key, entry, generation)
+            if request.if_none_match.contains(entry.etag):
+                return self.not_modified(entry.etag)
+            response = make_response(entry.body)
+            response.mimetype = entry.mimetype
+            return self.finish(response, entry.etag)
+        return wrapper
+
+
+class NoResponseCache(ResponseCache):
+    """Response cache that never caches, HTTP_CACHE_BACKEND = 'none'"""
+
+    def __init__(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+    def cached(self, view):
+        return view
+
+
+'''
+create_response_cache(app)
+    creates the response cache of `HTTP_CACHE_BACKEND`: 'memory',
+    'filesystem' or 'none', cleared once per committed write of
+    questions, ratings or categories, in any worker
+'''
+
+
+def create_response_cache(app):
+    name = app.config.get('HTTP_CACHE_BACKEND', 'memory')
+    if name == 'none':
+        return NoResponseCache()
+    if name == 'memory':
+        backend = LRUCacheBackend(
+            max_entries=app.config['HTTP_CACHE_MAX_ENTRIES'],
+            max_bytes=app.config['HTTP_CACHE_MAX_BYTES'])
+    elif name == 'filesystem':
+        if not app.config['HTTP_CACHE_DIR']:
+            raise ValueError('The filesystem response cache needs '
+                             'HTTP_CACHE_DIR')
+        backend = FileSystemCacheBackend(app.config['HTTP_CACHE_DIR'])
+    else:
+        raise ValueError(f'Unknown response cache backend {name!r}')
+    settle = 0
+    if app.config.get('SQLALCHEMY_REPLICA_URIS'):
+        settle = app.config['REPLICA_READ_YOUR_WRITES']
+    cache = ResponseCache(backend, ttl=app.config['HTTP_CACHE_TTL'],
+                          max_age=app.config['HTTP_CACHE_MAX_AGE'],
+                          settle=settle,
+                          changes=app.extensions['change_watcher'])
+    listen_for_commits(app, cache.on_commit)
+    return cache
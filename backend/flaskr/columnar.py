@@ -0,0 +1,517 @@
+# third-party imports
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from sqlalchemy import func
+from threading import RLock
+import os
+import re
+
+# local imports
+from models import (check_tables, listen_for_changes, primary_reads, db,
+                    Question, QUESTION_RATINGS)
+from .quiz import random_pick
+from .serialization import QuestionRow, QUESTION_COLUMNS, QUESTION_FIELDS
+from .snapshots import map_snapshot, write_snapshot
+
+# first bytes of a question snapshot file
+SNAPSHOT_MAGIC = b'TRIVCOLS'
+
+# stands for NULL in the integer columns
+NULL = -2 ** 31
+
+# typecode of each column, the integer columns first
+COLUMN_TYPES = (
+    ('id', 'Q'), ('category', 'i'), ('difficulty', 'i'), ('rating', 'i'),
+    # where the question, the answer and the lower case question used by
+    # the search start in the string table, and their lengths in bytes
+    ('question_start', 'Q'), ('question_length', 'I'),
+    ('answer_start', 'Q'), ('answer_length', 'I'),
+    ('search_start', 'Q'), ('search_length', 'I'),
+)
+INTEGER_COLUMNS = ('category', 'difficulty', 'rating')
+
+# rows fetched per round trip while loading the questions
+LOAD_BATCH_SIZE = 5000
+
+
+class Column(object):
+    """
+    Typed column: the rows loaded at startup in an array, or in the
+    memory-mapped snapshot, and the rows inserted since in a tail array
+    """
+    __slots__ = ('base', 'tail')
+
+    def __init__(self, base, typecode):
+        self.base = base
+        self.tail = array(typecode)
+
+    def __len__(self):
+        return len(self.base) + len(self.tail)
+
+    def __getitem__(self, position):
+        if position < len(self.base):
+            return self.base[position]
+        return self.tail[position - len(self.base)]
+
+    def __setitem__(self, position, value):
+        if position < len(self.base):
+            self.base[position] = value
+        else:
+            self.tail[position - len(self.base)] = value
+
+    def append(self, value):
+        self.tail.append(value)
+
+    @property
+    def nbytes(self):
+        return memoryview(self.base).nbytes + \
+            self.tail.itemsize * len(self.tail)
+
+
+# method for the NULL-coded value of an integer column
+def to_column(value):
+    return NULL if value is None else int(value)
+
+
+# method for the value of an integer column
+def from_column(value):
+    return None if value == NULL else value
+
+
+'''
+build_columns(rows)
+    column arrays, string table and fingerprint of question rows sorted
+    by id. The string table holds every question, then every answer,
+    then every lower case question, so that a search scans one region.
+'''
+
+
+def build_columns(rows):
+    columns = {name: array(typecode) for name, typecode in COLUMN_TYPES}
+    texts = {'question': [], 'answer': [], 'search': []}
+    fingerprint = [0] * 7
+    for row in rows:
+        record = dict(zip(QUESTION_FIELDS, row))
+        columns['id'].append(record['id'])
+        for name in INTEGER_COLUMNS:
+            columns[name].append(to_column(record[name]))
+        question = record['question'] or ''
+        answer = record['answer'] or ''
+        for name, text in (('question', question), ('answer', answer),
+                           ('search', question.lower())):
+            texts[name].append(text.encode('utf-8'))
+        fingerprint = add_fingerprint(fingerprint, record)
+
+    chunks = []
+    size = 0
+    for name in ('question', 'answer', 'search'):
+        for encoded in texts[name]:
+            columns[name + '_start'].append(size)
+            columns[name + '_length'].append(len(encoded))
+            chunks.append(encoded)
+            size += len(encoded)
+    return columns, b''.join(chunks), fingerprint
+
+
+# method for adding a question to a fingerprint, see question_fingerprint
+def add_fingerprint(fingerprint, record):
+    count, highest, questions, answers, categories, difficulties, \
+        ratings = fingerprint
+    return [count + 1, max(highest, record['id']),
+            questions + len(record['question'] or ''),
+            answers + len(record['answer'] or ''),
+            categories + (record['category'] or 0),
+            difficulties + (record['difficulty'] or 0),
+            ratings + (record['rating'] or 0)]
+
+
+'''
+question_fingerprint()
+    count, highest id and sums of text lengths and integer columns of the
+    questions table, in one aggregate query. A snapshot whose fingerprint
+    differs was taken before the questions changed.
+'''
+
+
+def question_fingerprint():
+    row = db.session.query(
+        func.count(Question.id), func.max(Question.id),
+        func.sum(func.length(Question.question)),
+        func.sum(func.length(Question.answer)),
+        func.sum(func.coalesce(Question.category, 0)),
+        func.sum(func.coalesce(Question.difficulty, 0)),
+        func.sum(func.coalesce(Question.rating, 0))).one()
+    return [int(value or 0) for value in row]
+
+
+# method for the question rows of the database, streamed in id order
+def database_rows():
+    return db.session.query(*QUESTION_COLUMNS).order_by(
+        Question.id).yield_per(LOAD_BATCH_SIZE)
+
+
+# method for the (id, rating) of the questions, streamed in id order
+def database_ratings():
+    return db.session.query(Question.id, Question.rating).order_by(
+        Question.id).yield_per(LOAD_BATCH_SIZE)
+
+
+class StaleStore(Exception):
+    """The store has to query the database before it answers"""
+
+
+'''
+ColumnarStore
+    the question bank of a worker in typed columns and a string table,
+    with per category indexes of the row positions in id order. Rows are
+    never removed: deleted rows leave the indexes, and new texts of
+    inserted or edited rows are kept aside in `overrides`.
+'''
+
+
+class ColumnarStore(object):
+
+    def __init__(self, columns, blob, fingerprint, changes=None):
+        self.lock = RLock()
+        # reloaded on next use, listeners cannot query after a commit
+        self.stale = False
+        # only the ratings are read again on next use
+        self.ratings_stale = False
+        # ChangeWatcher marking the store stale after the writes of the
+        # other workers
+        self.changes = changes
+        self.reset(columns, blob, fingerprint)
+
+    def reset(self, columns, blob, fingerprint):
+        self.columns = {name: Column(columns[name], typecode)
+                        for name, typecode in COLUMN_TYPES}
+        self.blob = blob
+        self.fingerprint = fingerprint
+        # position -> (question, answer) of the rows changed since
+        self.overrides = {}
+        self.deleted = set()
+        # row positions in id order, of all the rows and per category
+        self.live = array('I', range(len(self.columns['id'])))
+        self.categories = {}
+        for position, category in enumerate(columns['category']):
+            if category != NULL:
+                self.categories.setdefault(category,
+                                           array('I')).append(position)
+        search_starts = self.columns['search_start'].base
+        self.search_region = (search_starts[0] if len(search_starts)
+                              else len(blob), len(blob))
+
+    @classmethod
+    def from_database(cls):
+        with primary_reads():
+            return cls(*build_columns(database_rows()))
+
+    @classmethod
+    def from_snapshot(cls, path):
+        header, sections = map_snapshot(path, SNAPSHOT_MAGIC, writable=True)
+        return cls(sections, sections['blob'], header['fingerprint'])
+
+    def write_snapshot(self, path):
+        """Writes the rows loaded at startup to a snapshot file"""
+        write_snapshot(path, SNAPSHOT_MAGIC, {
+            'fingerprint': self.fingerprint,
+        }, [(name, self.columns[name].base) for name, _ in COLUMN_TYPES]
+            + [('blob', self.blob)])
+
+    @contextmanager
+    def synced(self, queries=True):
+        """
+        Holds the lock of the store, reloaded first when stale. Raises
+        StaleStore rather than querying the database unless `queries`.
+        """
+        if self.changes is not None:
+            if not queries and self.changes.due():
+                raise StaleStore()
+            self.changes.sync()
+        with self.lock:
+            if not queries and (self.stale or self.ratings_stale):
+                raise StaleStore()
+            if self.stale:
+                with primary_reads():
+                    self.reset(*build_columns(database_rows()))
+                self.stale = self.ratings_stale = False
+            elif self.ratings_stale:
+                with primary_reads():
+                    self.refresh_ratings(database_ratings())
+                self.ratings_stale = False
+            yield
+
+    @property
+    def nbytes(self):
+        """Bytes held by the columns, the string table and the indexes"""
+        return (sum(column.nbytes for column in self.columns.values())
+                + memoryview(self.blob).nbytes
+                + sum(len(question) + len(answer) for question, answer
+                      in self.overrides.values())
+                + self.live.itemsize * (len(self.live) + sum(
+                    len(index) for index in self.categories.values())))
+
+    def text(self, position, name):
+        start = self.columns[name + '_start'].base[position]
+        length = self.columns[name + '_length'].base[position]
+        return bytes(self.blob[start:start + length]).decode('utf-8')
+
+    def row(self, position):
+        question, answer = self.overrides.get(position) or (
+            self.text(position, 'question'), self.text(position, 'answer'))
+        columns = self.columns
+        return QuestionRow(
+            columns['id'][position], question, answer,
+            from_column(columns['category'][position]),
+            from_column(columns['difficulty'][position]),
+            from_column(columns['rating'][position]))
+
+    def index(self, category_id):
+        """Row positions of a category in id order, None for all"""
+        if category_id is None:
+            return self.live
+        return self.categories.get(category_id, ())
+
+    def locate(self, positions, question_id):
+        """Returns the index in `positions` of a question id, or None"""
+        ids = self.columns['id']
+        low, high = 0, len(positions)
+        while low < high:
+            middle = (low + high) // 2
+            if ids[positions[middle]] < question_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(positions) and ids[positions[low]] == question_id:
+            return low
+        return None
+
+    def bound(self, positions, question_id):
+        """Returns the index in `positions` of the first id above"""
+        ids = self.columns['id']
+        low, high = 0, len(positions)
+        while low < high:
+            middle = (low + high) // 2
+            if ids[positions[middle]] <= question_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def position(self, question_id):
+        index = self.locate(self.live, question_id)
+        return None if index is None else self.live[index]
+
+    def get(self, question_id):
+        with self.synced():
+            position = self.position(question_id)
+            return None if position is None else self.row(position)
+
+    def count(self, category_id=None):
+        with self.synced():
+            return len(self.index(category_id))
+
+    def page(self, category_id=None, page=1, after_id=None, per_page=10):
+        """Rows of a page, by number or after a question id"""
+        with self.synced():
+            positions = self.index(category_id)
+            if after_id is not None:
+                start = self.bound(positions, after_id)
+            elif page < 1:
+                return []
+            else:
+                start = (page - 1) * per_page
+            return [self.row(position)
+                    for position in positions[start:start + per_page]]
+
+    def question_ids(self, category_id=None):
+        with self.synced():
+            ids = self.columns['id']
+            return [ids[position] for position in self.index(category_id)]
+
+    def run_pick_step(self, category_id, step):
+        """Runs a step of random_pick, see quiz.run_pick_step"""
+        positions = self.index(category_id)
+        # indexes of the excluded questions in the category, ascending
+        skipped = sorted(
+            index for index in (self.locate(positions, question_id)
+                                for question_id in step[1])
+            if index is not None)
+        if step[0] == 'count':
+            return len(positions) - len(skipped)
+        index = step[2]
+        for skip in skipped:
+            if skip > index:
+                break
+            index += 1
+        if index >= len(positions):
+            return None
+        return self.row(positions[index])
+
+    def pick(self, category_id, previous_questions, queries=True):
+        """Random question of a category that is not in the previous,
+        see synced for `queries`"""
+        steps = random_pick(previous_questions)
+        with self.synced(queries):
+            try:
+                step = next(steps)
+                while True:
+                    step = steps.send(self.run_pick_step(category_id, step))
+            except StopIteration as stop:
+                return stop.value
+
+    def search(self, term, offset, limit):
+        """Case-insensitive substring search of the questions, id order"""
+        needle = term.lower()
+        pattern = re.compile(re.escape(needle.encode('utf-8')))
+        with self.synced():
+            matches = set()
+            starts = self.columns['search_start'].base
+            lengths = self.columns['search_length'].base
+            start, end = self.search_region
+            for found in pattern.finditer(self.blob, start, end):
+                # the row whose lower case question holds the match
+                position = bisect_right(starts, found.start()) - 1
+                if found.end() <= starts[position] + lengths[position]:
+                    matches.add(position)
+            # changed rows match on their new text only
+            matches -= self.overrides.keys() | self.deleted
+            matches.update(position for position, (question, answer)
+                           in self.overrides.items()
+                           if needle in question.lower())
+            positions = sorted(matches)
+            return ([self.row(position)
+                     for position in positions[offset:offset + limit]],
+                    len(positions))
+
+    def on_change(self, operation, record):
+        with self.lock:
+            if self.stale:
+                return
+            if operation == 'reload':
+                self.stale = True
+            elif operation == 'delete':
+                self.remove(record['id'])
+            elif operation == 'insert':
+                self.insert(record)
+            else:
+                self.update(record)
+
+    def on_rating_change(self, operation, record):
+        """Applies a new rating to the rating column in place"""
+        with self.lock:
+            if self.stale:
+                return
+            if operation == 'reload':
+                self.ratings_stale = True
+                return
+            position = self.position(record['id'])
+            if position is not None:
+                self.columns['rating'][position] = to_column(
+                    record['rating'])
+
+    def refresh_ratings(self, rows):
+        """Rewrites the rating column from (id, rating) rows in id
+        order"""
+        ids = self.columns['id']
+        ratings = self.columns['rating']
+        position = 0
+        for question_id, rating in rows:
+            position = bisect_left(ids, question_id, position)
+            if position == len(ids):
+                break
+            if ids[position] == question_id:
+                ratings[position] = to_column(rating)
+
+    def remove(self, question_id):
+        position = self.position(question_id)
+        if position is None:
+            return
+        self.unindex(self.live, position)
+        category = self.columns['category'][position]
+        if category != NULL:
+            self.unindex(self.categories[category], position)
+        self.deleted.add(position)
+        self.overrides.pop(position, None)
+
+    @staticmethod
+    def unindex(positions, position):
+        del positions[bisect_left(positions, position)]
+
+    def insert(self, record):
+        ids = self.columns['id']
+        if len(ids) and record['id'] <= ids[len(ids) - 1]:
+            # not after the last id, e.g. a reused id on sqlite
+            self.stale = True
+            return
+        position = len(ids)
+        ids.append(record['id'])
+        for name in INTEGER_COLUMNS:
+            self.columns[name].append(to_column(record[name]))
+        self.overrides[position] = (record['question'] or '',
+                                    record['answer'] or '')
+        self.live.append(position)
+        if record['category'] is not None:
+            self.categories.setdefault(record['category'],
+                                       array('I')).append(position)
+
+    def update(self, record):
+        position = self.position(record['id'])
+        if position is None:
+            self.stale = True
+            return
+        category = self.columns['category'][position]
+        if from_column(category) != record['category']:
+            if category != NULL:
+                self.unindex(self.categories[category], position)
+            if record['category'] is not None:
+                insort(self.categories.setdefault(record['category'],
+                                                  array('I')), position)
+        for name in INTEGER_COLUMNS:
+            self.columns[name][position] = to_column(record[name])
+        row = self.row(position)
+        if (row.question, row.answer) != (record['question'],
+                                          record['answer']):
+            self.overrides[position] = (record['question'] or '',
+                                        record['answer'] or '')
+
+
+'''
+create_question_store(app)
+    creates the columnar store of the questions when QUESTION_STORE is
+    'columnar', None otherwise. With QUESTION_SNAPSHOT set, the store
+    maps the snapshot file when it is up to date, or loads the database
+    and rewrites it for the next workers. The store applies the commits
+    of its worker and reloads once the others wrote, see ChangeWatcher,
+    but for their ratings, applied in place.
+'''
+
+
+def create_question_store(app):
+    if app.config['QUESTION_STORE'] == 'database':
+        return None
+    if app.config['QUESTION_STORE'] != 'columnar':
+        raise ValueError('Unknown question store {!r}'.format(
+            app.config['QUESTION_STORE']))
+    path = app.config['QUESTION_SNAPSHOT']
+    changes = app.extensions['change_watcher']
+    store = None
+    with app.app_context(), primary_reads():
+        check_tables(app)
+        # the versions the store starts from
+        changes.sync()
+        if path and os.path.exists(path):
+            store = ColumnarStore.from_snapshot(path)
+            if store.fingerprint != question_fingerprint():
+                app.logger.warning('%s is out of date, loading the '
+                                   'questions from the database', path)
+                store = None
+        if store is None:
+            store = ColumnarStore.from_database()
+            if path:
+                store.write_snapshot(path)
+    store.changes = changes
+    listen_for_changes(app, Question.__tablename__, store.on_change)
+    listen_for_changes(app, QUESTION_RATINGS, store.on_rating_change)
+    return store
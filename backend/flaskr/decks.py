@@ -0,0 +1,282 @@
+# third-party imports
+from array import array
+from bisect import bisect_left
+from json.encoder import encode_basestring, encode_basestring_ascii
+from threading import Lock
+import hashlib
+import json
+import os
+import random
+
+# local imports
+from models import listen_for_changes, primary_reads, Question
+from .serialization import (question_rows, row_json, COMPACT_ROW,
+                            QUESTION_FIELDS)
+from .snapshots import map_snapshot, write_snapshot
+
+# first bytes of a deck file
+DECK_FILE_MAGIC = b'TRIVDECK'
+
+# fields whose change reshuffles the decks, ratings change too often
+DECK_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+
+# method for the deck key of a category, None is all categories
+def deck_key(category_id):
+    return 'all' if category_id is None else str(category_id)
+
+
+'''
+DeckSet
+    one immutable generation of decks: the compact JSON of every question
+    in a single blob, and per category a few shuffled orders of the
+    positions of its questions. The generation is a digest of the
+    questions, so every worker builds the same decks from the same
+    questions and a deck id is valid in any of them. The version is the
+    change version of the questions they were built from, None when
+    unknown.
+'''
+
+
+class DeckSet(object):
+
+    def __init__(self, generation, ids, offsets, blob, decks, version=None):
+        self.generation = generation
+        self.version = version
+        # sorted question ids, and where the payload of each one starts
+        self.ids = ids
+        self.offsets = offsets
+        self.blob = blob
+        # deck key -> list of shuffled payload positions
+        self.decks = decks
+
+    def deck(self, key, number):
+        decks = self.decks.get(key)
+        if decks is None or not 0 <= number < len(decks):
+            return None
+        return decks[number]
+
+    def payload(self, position):
+        return bytes(self.blob[self.offsets[position]:
+                               self.offsets[position + 1]]).decode('utf-8')
+
+    def changed(self, record):
+        """Checks if a question update differs from its payload"""
+        position = bisect_left(self.ids, record['id'])
+        if position == len(self.ids) or self.ids[position] != record['id']:
+            return True
+        stored = json.loads(self.payload(position))
+        return any(stored[field] != record[field] for field in DECK_FIELDS)
+
+
+'''
+build_decks(rows, count, ensure_ascii, version)
+    DeckSet of question rows sorted by id with `count` decks for each
+    category and for all categories
+'''
+
+
+def build_decks(rows, count, ensure_ascii=True, version=None):
+    escape = encode_basestring_ascii if ensure_ascii else encode_basestring
+    digest = hashlib.sha1()
+    ids = array('Q')
+    offsets = array('Q', [0])
+    chunks = []
+    positions = {'all': []}
+    for position, row in enumerate(rows):
+        record = dict(zip(QUESTION_FIELDS, row))
+        digest.update(json.dumps([record[field] for field in DECK_FIELDS])
+                      .encode('utf-8'))
+        payload = row_json(row, COMPACT_ROW, escape).encode('utf-8')
+        chunks.append(payload)
+        ids.append(record['id'])
+        offsets.append(offsets[-1] + len(payload))
+        positions['all'].append(position)
+        if record['category'] is not None:
+            positions.setdefault(deck_key(record['category']),
+                                 []).append(position)
+    generation = digest.hexdigest()[:12]
+
+    decks = {}
+    for key, members in positions.items():
+        decks[key] = []
+        for number in range(count):
+            order = list(members)
+            # seeded by strings, the same shuffle in every process
+            random.Random('{}:{}:{}'.format(
+                generation, key, number)).shuffle(order)
+            decks[key].append(array('I', order))
+    return DeckSet(generation, ids, offsets, b''.join(chunks), decks,
+                   version)
+
+
+'''
+write_deck_file(deck_set, path)
+    writes a DeckSet to a snapshot file: the ids, the payload offsets,
+    the decks and the payload blob, with the version of the questions
+'''
+
+
+def write_deck_file(deck_set, path):
+    sections = [('ids', deck_set.ids), ('offsets', deck_set.offsets)]
+    decks = {}
+    for key, orders in sorted(deck_set.decks.items()):
+        decks[key] = []
+        for number, order in enumerate(orders):
+            name = 'deck:{}:{}'.format(key, number)
+            decks[key].append(name)
+            sections.append((name, order))
+    sections.append(('blob', deck_set.blob))
+    write_snapshot(path, DECK_FILE_MAGIC, {
+        'generation': deck_set.generation, 'version': deck_set.version,
+        'decks': decks}, sections)
+
+
+'''
+load_deck_file(path)
+    DeckSet reading the sections of a deck file from a read-only memory
+    map, shared by the workers of the host through the page cache
+'''
+
+
+def load_deck_file(path):
+    header, sections = map_snapshot(path, DECK_FILE_MAGIC)
+    decks = {key: [sections[name] for name in names]
+             for key, names in header['decks'].items()}
+    return DeckSet(header['generation'], sections['ids'],
+                   sections['offsets'], sections['blob'], decks,
+                   header.get('version'))
+
+
+'''
+DeckStore
+    the decks of a worker: built on first use, from DECK_FILE when it
+    was written at the current version of the questions, and rebuilt on
+    the next assignment after the questions of a deck change, in this
+    worker or in another one as seen by `changes`, a ChangeWatcher.
+    Players keep their deck through one rebuild.
+'''
+
+
+class DeckStore(object):
+
+    def __init__(self, app, changes=None):
+        self.app = app
+        self.changes = changes
+        self.count = app.config['DECKS_PER_CATEGORY']
+        self.path = app.config['DECK_FILE']
+        self.lock = Lock()
+        self.current = None
+        self.previous = None
+        self.stale = False
+
+    def build(self):
+        """Builds the decks of the current questions"""
+        version = None
+        if self.changes is not None:
+            # read first, a write meanwhile only makes the decks older
+            version = self.changes.read().get(Question.__tablename__, 0)
+        with primary_reads():
+            rows = question_rows(Question.query.order_by(Question.id))
+        return build_decks(rows, self.count,
+                           self.app.config['JSON_AS_ASCII'], version)
+
+    def load(self):
+        """Maps DECK_FILE, or builds the decks when the questions
+        changed since it was written"""
+        version = None
+        if self.changes is not None:
+            self.changes.sync(force=True)
+            version = self.changes.versions.get(Question.__tablename__, 0)
+        # set again by the changes committed while the file is mapped
+        self.stale = False
+        deck_set = load_deck_file(self.path)
+        if version is None or deck_set.version != version or self.stale:
+            self.app.logger.warning('%s is out of date, building the '
+                                    'decks from the database', self.path)
+            return self.build()
+        return deck_set
+
+    def replace(self, deck_set):
+        if self.current is None or \
+                self.current.generation != deck_set.generation:
+            self.previous = self.current
+        self.current = deck_set
+        self.stale = False
+
+    def decks(self):
+        """Returns the current DeckSet, building it when needed"""
+        if self.changes is not None:
+            self.changes.sync()
+        deck_set = self.current
+        if deck_set is not None and not self.stale:
+            return deck_set
+        with self.lock:
+            if self.current is None and self.path and \
+                    os.path.exists(self.path):
+                self.replace(self.load())
+            elif self.current is None or self.stale:
+                self.replace(self.build())
+            return self.current
+
+    def on_change(self, operation, record):
+        deck_set = self.current
+        if deck_set is None or operation != 'update' or \
+                deck_set.changed(record):
+            self.stale = True
+
+    def assign(self, category_id):
+        """Returns a random deck id of a category, None if it is empty"""
+        deck_set = self.decks()
+        key = deck_key(category_id)
+        if not deck_set.decks.get(key):
+            return None, 0
+        number = random.randrange(len(deck_set.decks[key]))
+        return ('{}.{}.{}'.format(deck_set.generation, key, number),
+                len(deck_set.decks[key][number]))
+
+    def find(self, generation, key, number):
+        for deck_set in (self.current, self.previous):
+            if deck_set is not None and deck_set.generation == generation:
+                order = deck_set.deck(key, number)
+                if order is not None:
+                    return deck_set, order
+        return None
+
+    def lookup(self, deck_id):
+        """
+        Returns the DeckSet and the positions of a deck id, without any
+        query for the decks of this worker. A deck of another generation
+        may come from a worker that saw newer questions: the decks are
+        rebuilt if the questions changed since they were built. Raises
+        KeyError when its generation is gone.
+        """
+        try:
+            generation, key, number = deck_id.split('.')
+            number = int(number)
+        except ValueError:
+            raise KeyError(deck_id)
+        found = self.find(generation, key, number)
+        if found is None:
+            if self.changes is not None:
+                self.changes.sync(force=True)
+            if self.current is None or self.stale:
+                self.decks()
+                found = self.find(generation, key, number)
+        if found is None:
+            raise KeyError(deck_id)
+        return found
+
+
+'''
+create_deck_store(app)
+    creates the deck store of the application, marked stale by the
+    committed changes of the questions it holds and the writes of the
+    other workers
+'''
+
+
+def create_deck_store(app):
+    store = DeckStore(app, changes=app.extensions['change_watcher'])
+    listen_for_changes(app, Question.__tablename__, store.on_change)
+    return store
@@ -0,0 +1,31 @@
+# third-party imports
+from flask import abort, current_app, request
+from functools import wraps
+
+# addresses allowed to read the diagnostics endpoints
+LOCAL_ADDRESSES = ('127.0.0.1', '::1', 'localhost')
+
+# headers of the requests relayed by a reverse proxy, whose remote
+# address is the proxy's and not the client's
+FORWARDING_HEADERS = ('X-Forwarded-For', 'Forwarded', 'X-Real-IP')
+
+
+'''
+local_only(view)
+    serves the view only when diagnostics are enabled and the client is
+    local, any other request gets a 404 as if the route did not exist.
+    Requests relayed by a reverse proxy on the same host are not local.
+'''
+
+
+def local_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_app.config.get('DIAGNOSTICS_ENABLED'):
+            abort(404)
+        if request.remote_addr not in LOCAL_ADDRESSES:
+            abort(404)
+        if any(header in request.headers for header in FORWARDING_HEADERS):
+            abort(404)
+        return view(*args, **kwargs)
+    return wrapper
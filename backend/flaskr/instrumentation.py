@@ -0,0 +1,241 @@
+# third-party imports
+from collections import Counter
+from contextlib import contextmanager
+from flask import g, has_app_context, request
+from flask.json import JSONEncoder
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Lock
+import os
+import time
+
+# local imports
+from models import phase_timers
+
+# phases reported in the Server-Timing header, with their description
+PHASES = (
+    ('db', 'database'),
+    ('load', 'ORM loading'),
+    ('serialize', 'format and jsonify'),
+)
+
+# counters of the per route statistics, in the /metrics order
+COUNTERS = (
+    ('requests', 'Requests served.'),
+    ('statements', 'SQL statements executed.'),
+    ('db_seconds', 'Time spent executing SQL statements.'),
+    ('load_seconds', 'Time spent loading ORM objects from results.'),
+    ('serialize_seconds', 'Time spent formatting and encoding responses.'),
+    ('request_seconds', 'Time spent handling requests.'),
+    ('response_bytes', 'Size of the response bodies.'),
+    ('over_query_budget', 'Requests that ran more statements than '
+                          'QUERY_BUDGET.'),
+    ('n_plus_one', 'Requests that ran the same statement '
+                   'N_PLUS_ONE_THRESHOLD times or more.'),
+)
+
+
+'''
+RequestMetrics
+    measurements of the request being handled, kept on flask.g
+'''
+
+
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = Counter()
+        self.seconds = dict.fromkeys(('db', 'load', 'serialize'), 0.0)
+        # phases are not nested, e.g. format() called while loading
+        self.measuring = False
+
+    @property
+    def statement_count(self):
+        return sum(self.statements.values())
+
+    def repeated_statement(self):
+        """Returns the most executed statement and its count"""
+        if not self.statements:
+            return None, 0
+        return self.statements.most_common(1)[0]
+
+
+# method for the metrics of the current request, None outside of requests
+def current_metrics():
+    if not has_app_context():
+        return None
+    return g.get('request_metrics')
+
+
+'''
+measure(phase)
+    context manager adding the time spent in its block to `phase` of the
+    current request, minus the time spent executing SQL meanwhile
+'''
+
+
+@contextmanager
+def measure(phase):
+    metrics = current_metrics()
+    if metrics is None or metrics.measuring:
+        yield
+        return
+    metrics.measuring = True
+    db_seconds = metrics.seconds['db']
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.seconds[phase] += elapsed - (metrics.seconds['db']
+                                             - db_seconds)
+        metrics.measuring = False
+
+
+# records the start of each statement of a connection
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info['statement_started'] = time.perf_counter()
+
+
+# adds each statement and its duration to the current request
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started = conn.info.pop('statement_started', None)
+    metrics = current_metrics()
+    if metrics is not None and started is not None:
+        metrics.seconds['db'] += time.perf_counter() - started
+        metrics.statements[statement] += 1
+
+
+'''
+install_timers()
+    listens to the statements of every engine and times the ORM loading
+    and the serialisation, once per process: requests of applications
+    without instrumentation are not measured
+'''
+
+
+def install_timers():
+    if not event.contains(Engine, 'before_cursor_execute',
+                          before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    phase_timers['load'] = lambda: measure('load')
+    phase_timers['serialize'] = lambda: measure('serialize')
+
+
+'''
+TimedJSONEncoder
+    JSON encoder of jsonify that adds its encoding time to the
+    'serialize' phase
+'''
+
+
+class TimedJSONEncoder(JSONEncoder):
+
+    def encode(self, o):
+        with measure('serialize'):
+            return super(TimedJSONEncoder, self).encode(o)
+
+
+'''
+Instrumentation
+    measures the SQL statements, database time, ORM loading time,
+    serialisation time and response size of every request, reports them
+    in a Server-Timing header and accumulates them per route for the
+    Prometheus text exposition of GET /metrics
+'''
+
+
+class Instrumentation(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.query_budget = app.config['QUERY_BUDGET']
+        self.n_plus_one_threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        self.lock = Lock()
+        self.routes = {}
+        install_timers()
+        app.json_encoder = TimedJSONEncoder
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.request_metrics = RequestMetrics()
+
+    # method for the route label of the current request
+    def route(self):
+        if request.url_rule is None:
+            return 'unmatched'
+        return '{} {}'.format(request.method, request.url_rule.rule)
+
+    def check(self, metrics, route):
+        """Returns the flags of a request, logged as warnings"""
+        flags = []
+        count = metrics.statement_count
+        if count > self.query_budget:
+            flags.append('over_query_budget')
+            self.app.logger.warning(
+                '%s ran %d SQL statements, the budget is %d',
+                route, count, self.query_budget)
+        statement, repeated = metrics.repeated_statement()
+        if repeated >= self.n_plus_one_threshold:
+            flags.append('n_plus_one')
+            self.app.logger.warning(
+                '%s ran %d times the statement %s, possible N+1 queries',
+                route, repeated, ' '.join(statement.split()))
+        return flags
+
+    def finish(self, response):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return response
+        elapsed = time.perf_counter() - metrics.started
+        route = self.route()
+        flags = self.check(metrics, route)
+        # streamed bodies are produced after the request, size unknown,
+        # calculate_content_length would read them into memory first
+        size = 0 if response.is_streamed else (
+            response.calculate_content_length() or 0)
+
+        timings = ['{};dur={:.3f};desc="{}"'.format(
+            phase, metrics.seconds[phase] * 1000, description)
+            for phase, description in PHASES]
+        timings.append('sql;desc="{} statements"'.format(
+            metrics.statement_count))
+        timings.append('total;dur={:.3f}'.format(elapsed * 1000))
+        response.headers.add('Server-Timing', ', '.join(timings))
+
+        with self.lock:
+            counters = self.routes.setdefault(
+                route, dict.fromkeys((name for name, _ in COUNTERS), 0))
+            for name, value in (
+                    ('requests', 1),
+                    ('statements', metrics.statement_count),
+                    ('db_seconds', metrics.seconds['db']),
+                    ('load_seconds', metrics.seconds['load']),
+                    ('serialize_seconds', metrics.seconds['serialize']),
+                    ('request_seconds', elapsed),
+                    ('response_bytes', size),
+                    ('over_query_budget', 'over_query_budget' in flags),
+                    ('n_plus_one', 'n_plus_one' in flags)):
+                counters[name] += value
+        return response
+
+    def render(self):
+        """Returns the per route counters in the Prometheus text format"""
+        with self.lock:
+            routes = {route: dict(counters)
+                      for route, counters in self.routes.items()}
+        lines = []
+        for name, description in COUNTERS:
+            metric = 'trivia_{}_total'.format(name)
+            lines.append('# HELP {} {}'.format(metric, description))
+            lines.append('# TYPE {} counter'.format(metric))
+            for route in sorted(routes):
+                lines.append('{}{{route="{}",pid="{}"}} {}'.format(
+                    metric, route.replace('"', '\\"'), os.getpid(),
+                    round(routes[route][name], 6)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,87 @@
+# third-party imports
+import random
+
+# local imports
+from models import count_questions, Question
+
+# how many random picks are tried before excluding played questions in SQL
+QUIZ_PICK_RETRIES = 5
+
+
+# method for the filters of the questions playable in a category
+def category_criteria(category_id):
+    # available question will be all questions form all categories
+    if category_id is None:
+        return []
+    # if user click any one of categories
+    # will use filter on category type
+    return [Question.category == category_id]
+
+
+# method for building the query of the questions playable in a category
+def quiz_selection(category_id):
+    return Question.query.filter(*category_criteria(category_id))
+
+
+'''
+random_pick(previous_questions, retries)
+    the steps of a random pick that never repeats `previous_questions`,
+    as a generator driven by the caller so that the sync and the async
+    application share it. It yields ('count', excluded) for the number
+    of candidates whose id is not in `excluded` and ('pick', excluded,
+    offset) for the candidate at `offset` in id order, None past the
+    end, and returns the picked question or None.
+'''
+
+
+def random_pick(previous_questions, retries=QUIZ_PICK_RETRIES):
+    previous_questions = set(previous_questions)
+    total = yield 'count', ()
+    if total == 0:
+        return None
+
+    # rejection sampling: pick a random row and retry when it was played.
+    # only worth it while most of the candidates are still unplayed
+    if len(previous_questions) * 2 < total:
+        for _ in range(retries):
+            question = yield 'pick', (), random.randrange(0, total)
+            if question is None:
+                # the table shrank since the count, start again in SQL
+                break
+            if question.id not in previous_questions:
+                return question
+
+    # fall back to excluding the played questions inside the database
+    excluded = tuple(sorted(previous_questions))
+    if excluded:
+        total = yield 'count', excluded
+    if total == 0:
+        return None
+    return (yield 'pick', excluded, random.randrange(0, total))
+
+
+# method for running a step of random_pick on a question query
+def run_pick_step(selection, step):
+    if step[1]:
+        selection = selection.filter(Question.id.notin_(step[1]))
+    if step[0] == 'count':
+        return count_questions(selection)
+    return selection.order_by(Question.id).offset(step[2]).limit(1).first()
+
+
+'''
+pick_random_question(selection, previous_questions)
+    picks a random question of `selection` that is not in
+    `previous_questions` without loading the candidates into python
+'''
+
+
+def pick_random_question(selection, previous_questions,
+                         retries=QUIZ_PICK_RETRIES):
+    steps = random_pick(previous_questions, retries)
+    try:
+        step = next(steps)
+        while True:
+            step = steps.send(run_pick_step(selection, step))
+    except StopIteration as stop:
+        return stop.value
@@ -0,0 +1,286 @@
+# third-party imports
+from collections import OrderedDict
+from flask import request
+from functools import wraps
+from threading import BoundedSemaphore, Lock
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+from werkzeug.utils import import_string
+import json
+import math
+import time
+
+
+class RateLimited(TooManyRequests):
+    """429 of a client over the rate of a route, retry in `retry_after`"""
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__()
+        self.retry_after = retry_after
+
+
+class Overloaded(ServiceUnavailable):
+    """503 of a request finding every slot of the expensive routes busy"""
+
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__()
+        self.retry_after = retry_after
+
+
+# body of the 429 answered by the middleware, as the error handler's
+RATE_LIMITED_BODY = json.dumps(
+    {'error': 429, 'message': 'Too Many Requests', 'success': False},
+    separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+
+
+# method for the Retry-After header of a rejection, in whole seconds
+def retry_after_header(error):
+    return str(max(1, int(math.ceil(getattr(error, 'retry_after', 1)))))
+
+
+'''
+client_address(remote_addr, forwarded_for, trusted_proxies)
+    returns the address of the client of a request, like werkzeug's
+    ProxyFix(x_for=trusted_proxies): the X-Forwarded-For entry added by
+    the first of the `trusted_proxies` proxies in front of the worker,
+    or the remote address when there are fewer entries
+'''
+
+
+def client_address(remote_addr, forwarded_for, trusted_proxies):
+    if trusted_proxies and forwarded_for:
+        addresses = forwarded_for.split(',')
+        if len(addresses) >= trusted_proxies:
+            return addresses[-trusted_proxies].strip()
+    return remote_addr
+
+
+class RateLimitStore(object):
+    """
+    Interface of the stores of the token buckets of the clients.
+    A shared backend (e.g. a Redis script updating a hash per bucket)
+    only has to implement `take` to limit the clients of every worker
+    together.
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket of `key`, refilled with `rate`
+        tokens per second up to `burst` tokens. Returns 0 when the
+        request is allowed, else the seconds until the next token.
+        """
+        raise NotImplementedError
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """
+    In-process store, one bucket per client and route. The least
+    recently used buckets are dropped past `max_clients`, their clients
+    start again with a full bucket.
+    """
+
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        # key -> (tokens, monotonic time of the last update)
+        self.buckets = OrderedDict()
+        self.lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(max_clients=config['RATE_LIMIT_MAX_CLIENTS'])
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.pop(key, None)
+            tokens = burst if bucket is None else min(
+                burst, bucket[0] + (now - bucket[1]) * rate)
+            if tokens >= 1:
+                tokens, wait = tokens - 1, 0
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+'''
+AdmissionControl
+    admits the requests of the expensive routes: each client gets a
+    token bucket per route, configured by RATE_LIMITS, and at most
+    `max_concurrent` requests of these routes run at once per worker.
+    A request over its rate gets a 429, one waiting more than
+    `queue_timeout` seconds for a slot gets a 503, both with a
+    Retry-After header, so the other routes keep their threads and
+    database connections. Once installed, the rates of the routes
+    without URL arguments are checked by a WSGI middleware, which
+    answers a 429 without dispatching the request to Flask: a flood of
+    rejected requests costs the worker as little as possible. Behind
+    `trusted_proxies` reverse proxies the clients are told apart by
+    their X-Forwarded-For address.
+'''
+
+
+class AdmissionControl(object):
+
+    def __init__(self, store, limits, max_concurrent, queue_timeout,
+                 trusted_proxies=0):
+        self.store = store
+        self.limits = limits
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.trusted_proxies = trusted_proxies
+        self.slots = BoundedSemaphore(max_concurrent)
+        # (method, path) -> route whose rate the middleware checks
+        self.paths = {}
+
+    def client(self, environ):
+        """Returns the address of the client of a WSGI environ"""
+        return client_address(environ.get('REMOTE_ADDR'),
+                              environ.get('HTTP_X_FORWARDED_FOR'),
+                              self.trusted_proxies)
+
+    def check_rate(self, route, client):
+        """
+        Returns None when `client` is within the rate of `route`, else
+        the exception to answer
+        """
+        limit = self.limits.get(route)
+        if limit is not None:
+            wait = self.store.take('{}:{}'.format(route, client), *limit)
+            if wait:
+                return RateLimited(wait)
+        return None
+
+    def enter(self, route, client, timeout):
+        """
+        Returns None when a request of `client` to `route` is admitted,
+        it must `leave` once answered, else the exception to answer
+        """
+        rejection = self.check_rate(route, client)
+        if rejection is not None:
+            return rejection
+        if not self.slots.acquire(timeout=timeout):
+            return Overloaded(1)
+        return None
+
+    def leave(self):
+        self.slots.release()
+
+    def limited(self, view):
+        """Decorator admitting the requests of a Flask view"""
+        route = view.__name__
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            rejection = None
+            if (request.method, request.path) not in self.paths:
+                rejection = self.check_rate(route,
+                                            self.client(request.environ))
+            if rejection is None and \
+                    not self.slots.acquire(timeout=self.queue_timeout):
+                rejection = Overloaded(1)
+            if rejection is not None:
+                raise rejection
+            try:
+                return view(*args, **kwargs)
+            finally:
+                self.leave()
+        return wrapper
+
+    def install(self, app):
+        """Checks the rates in front of `app` once its routes are set"""
+        for rule in app.url_map.iter_rules():
+            if rule.endpoint in self.limits and not rule.arguments:
+                # preflight requests of the browsers are not counted
+                for method in rule.methods - {'OPTIONS'}:
+                    self.paths[(method, rule.rule)] = rule.endpoint
+        app.wsgi_app = RateLimitMiddleware(app.wsgi_app, self)
+
+
+class RateLimitMiddleware(object):
+    """WSGI middleware answering the clients over their rate"""
+
+    def __init__(self, wsgi_app, admission_control):
+        self.wsgi_app = wsgi_app
+        self.admission_control = admission_control
+
+    def __call__(self, environ, start_response):
+        route = self.admission_control.paths.get(
+            (environ['REQUEST_METHOD'], environ.get('PATH_INFO')))
+        if route is not None:
+            rejection = self.admission_control.check_rate(
+                route, self.admission_control.client(environ))
+            if rejection is not None:
+                start_response('429 TOO MANY REQUESTS', [
+                    ('Content-Type', 'application/json'),
+                    ('Content-Length', str(len(RATE_LIMITED_BODY))),
+                    ('Retry-After', retry_after_header(rejection)),
+                    ('Access-Control-Allow-Origin', '*'),
+                ])
+                return [RATE_LIMITED_BODY]
+        return self.wsgi_app(environ, start_response)
+
+
+class NoAdmissionControl(AdmissionControl):
+    """Admits every request, RATE_LIMIT_ENABLED = False"""
+
+    def __init__(self):
+        self.max_concurrent = None
+        self.trusted_proxies = 0
+
+    def check_rate(self, route, client):
+        return None
+
+    def enter(self, route, client, timeout):
+        return None
+
+    def leave(self):
+        pass
+
+    def limited(self, view):
+        return view
+
+    def install(self, app):
+        pass
+
+
+# method for parsing RATE_LIMITS, "route=rate:burst,..." per second
+def parse_rate_limits(value):
+    limits = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        route, limit = item.split('=')
+        rate, burst = limit.split(':')
+        limits[route.strip()] = (float(rate), float(burst))
+    return limits
+
+
+'''
+create_admission_control(config)
+    creates the admission control of the expensive routes with the rate
+    limit store named by RATE_LIMIT_STORE, or one admitting everything
+    when RATE_LIMIT_ENABLED is false
+'''
+
+
+def create_admission_control(config):
+    if not config['RATE_LIMIT_ENABLED']:
+        return NoAdmissionControl()
+    store_class = import_string(config['RATE_LIMIT_STORE'])
+    limits = config['RATE_LIMITS']
+    if isinstance(limits, str):
+        limits = parse_rate_limits(limits)
+    return AdmissionControl(store_class.from_config(config), limits,
+                            max_concurrent=config['EXPENSIVE_MAX_CONCURRENT'],
+                            queue_timeout=config['EXPENSIVE_QUEUE_TIMEOUT'],
+                            trusted_proxies=config[
+                                'RATE_LIMIT_TRUSTED_PROXIES'])
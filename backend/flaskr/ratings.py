@@ -0,0 +1,317 @@
+# third-party imports
+from sqlalchemy import case
+from sqlalchemy.exc import OperationalError, TimeoutError
+from threading import Event, Lock, Thread
+import atexit
+import glob
+import json
+import os
+import secrets
+
+# local imports
+from models import (apply_category_stats, bump_version, count_question,
+                    log_rating_changes, notify_changes, notify_commit, db,
+                    Question, QUESTION_RATINGS)
+from .serialization import question_rows, QUESTION_FIELDS
+
+# ids per UPDATE, each one binds 3 parameters and sqlite allows 999
+RATING_UPDATE_CHUNK = 300
+
+# errors of a write worth retrying later, e.g. a lost connection, a
+# locked database or an exhausted pool; others come from the ratings
+TEMPORARY_ERRORS = (OperationalError, TimeoutError)
+
+
+'''
+write_ratings(ratings)
+    writes a {question id: rating} map with one batched UPDATE per chunk
+    of ids and the category statistics, logs the new ratings under a
+    version of QUESTION_RATINGS, commits and notifies its listeners with
+    the {id, rating} of the updated rows. Ids of deleted questions are
+    ignored.
+'''
+
+
+def write_ratings(ratings):
+    table = Question.__table__
+    ids = sorted(ratings)
+    records = []
+    deltas = {}
+    for start in range(0, len(ids), RATING_UPDATE_CHUNK):
+        chunk = ids[start:start + RATING_UPDATE_CHUNK]
+        # the rows before the update, for the category statistics
+        for row in question_rows(Question.query.filter(
+                Question.id.in_(chunk)).with_for_update()):
+            record = dict(zip(QUESTION_FIELDS, row))
+            count_question(deltas, record['category'], record['difficulty'],
+                           record['rating'], sign=-1)
+            record['rating'] = ratings[record['id']]
+            count_question(deltas, record['category'], record['difficulty'],
+                           record['rating'])
+            records.append(record)
+        db.session.execute(table.update().where(
+            table.c.id.in_(chunk)).values(rating=case(
+                {question_id: ratings[question_id] for question_id in chunk},
+                value=table.c.id)))
+    apply_category_stats(db.session.connection(), deltas)
+    if records:
+        version = bump_version(db.session, QUESTION_RATINGS)
+        log_rating_changes(db.session, version, {
+            record['id']: record['rating'] for record in records})
+    db.session.commit()
+
+    # rows were updated without the unit of work, report them
+    for record in records:
+        notify_changes(QUESTION_RATINGS, 'update',
+                       {'id': record['id'], 'rating': record['rating']})
+    if records:
+        notify_commit({QUESTION_RATINGS})
+
+
+# method for the ids of `ids` that belong to a question
+def existing_questions(ids):
+    ids = sorted(ids)
+    found = set()
+    for start in range(0, len(ids), RATING_UPDATE_CHUNK):
+        found.update(question_id for question_id, in db.session.query(
+            Question.id).filter(Question.id.in_(
+                ids[start:start + RATING_UPDATE_CHUNK])))
+    return found
+
+
+class RatingLog(object):
+    """
+    Append-only log of the buffered ratings of a worker, one JSON line
+    per update. The worker holds a lock on ratings-<pid>-<token>.lock
+    while it lives, a log whose lock is free belongs to a worker that
+    died before writing its buffer and is replayed by the next one. The
+    random token keeps a worker reusing the pid of a dead one, e.g.
+    after a container restart, from taking over its log.
+    """
+
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, 'ratings-{}-{}'.format(
+            os.getpid(), secrets.token_hex(4)))
+        self.path = name + '.log'
+        self.lock_file = self.acquire(name + '.lock')
+        if self.lock_file is None:
+            raise RuntimeError('{} is used by another rating buffer of the '
+                               'process'.format(self.path))
+        self.file = open(self.path, 'a')
+
+    @staticmethod
+    def acquire(path):
+        """Returns the open lock file of `path`, None if it is held"""
+        import fcntl
+        lock_file = open(path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def read(path):
+        """Returns the {question id: rating} map of a log, last one wins"""
+        ratings = {}
+        with open(path) as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                    ratings[int(entry['id'])] = int(entry['rating'])
+                except (ValueError, KeyError, TypeError):
+                    # a line cut by a crash
+                    continue
+        return ratings
+
+    def orphans(self):
+        """Yields (ratings, release) of the logs of dead workers"""
+        for path in glob.glob(os.path.join(self.directory, 'ratings-*.log')):
+            if path == self.path:
+                continue
+            lock_path = path[:-len('.log')] + '.lock'
+            lock_file = self.acquire(lock_path)
+            if lock_file is None:
+                # its worker is alive
+                continue
+
+            def release(path=path, lock_path=lock_path,
+                        lock_file=lock_file):
+                os.remove(path)
+                os.remove(lock_path)
+                lock_file.close()
+            yield self.read(path), release
+
+    def sync(self):
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def append(self, ratings):
+        for question_id, rating in ratings.items():
+            self.file.write(json.dumps({'id': question_id,
+                                        'rating': rating}) + '\n')
+        self.sync()
+
+    def rewrite(self, ratings):
+        """Replaces the log by the ratings still buffered"""
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as log_file:
+            for question_id, rating in ratings.items():
+                log_file.write(json.dumps({'id': question_id,
+                                           'rating': rating}) + '\n')
+            log_file.flush()
+            if self.fsync:
+                os.fsync(log_file.fileno())
+        self.file.close()
+        os.replace(temporary, self.path)
+        self.file = open(self.path, 'a')
+
+
+'''
+RatingBuffer
+    rating updates of a worker kept in memory, coalesced by question
+    (the last rating wins) and written by write_ratings every
+    `interval` seconds or once `max_pending` questions are waiting.
+    An interval of 0 writes every submission through. A batch failing
+    on a temporary error is kept for the next flush, one refused by the
+    database is written rating by rating and the refused ones dropped.
+'''
+
+
+class RatingBuffer(object):
+
+    def __init__(self, app, interval=1.0, max_pending=500, log=None):
+        self.app = app
+        self.interval = interval
+        self.max_pending = max_pending
+        self.log = log
+        self.lock = Lock()
+        # only one flush at a time, so batches are written in order
+        self.flush_lock = Lock()
+        self.pending = {}
+        self.stopped = Event()
+        self.thread = None
+
+    def submit(self, ratings):
+        with self.lock:
+            if self.log is not None:
+                self.log.append(ratings)
+            self.pending.update(ratings)
+            full = len(self.pending) >= self.max_pending
+            if self.interval > 0 and self.thread is None:
+                self.start()
+        if self.interval <= 0 or full:
+            self.flush()
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='trivia-ratings',
+                             daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('rating flush failed')
+
+    def write(self, ratings):
+        with self.app.app_context():
+            try:
+                write_ratings(ratings)
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def requeue(self, ratings):
+        """Keeps ratings unless a newer one of their question arrived"""
+        with self.lock:
+            for question_id, rating in ratings.items():
+                self.pending.setdefault(question_id, rating)
+
+    def write_each(self, ratings):
+        """
+        Writes ratings one by one, drops those the database refuses and
+        keeps the rest on a temporary error. Returns how many were
+        written.
+        """
+        written = 0
+        items = list(ratings.items())
+        for position, (question_id, rating) in enumerate(items):
+            try:
+                self.write({question_id: rating})
+                written += 1
+            except TEMPORARY_ERRORS:
+                self.requeue(dict(items[position:]))
+                raise
+            except Exception:
+                self.app.logger.exception(
+                    'rating %r of question %s dropped', rating, question_id)
+        return written
+
+    def flush(self):
+        """Writes the pending ratings, returns how many were written"""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            try:
+                self.write(batch)
+                written = len(batch)
+            except TEMPORARY_ERRORS:
+                self.requeue(batch)
+                raise
+            except Exception:
+                # retried as is, the batch would fail on every flush
+                written = self.write_each(batch)
+            if self.log is not None:
+                with self.lock:
+                    self.log.rewrite(self.pending)
+            return written
+
+    def replay(self):
+        """Writes the ratings logged by dead workers"""
+        if self.log is None:
+            return
+        for ratings, release in self.log.orphans():
+            if ratings:
+                try:
+                    self.write(ratings)
+                except TEMPORARY_ERRORS:
+                    raise
+                except Exception:
+                    self.write_each(ratings)
+            release()
+
+    def close(self):
+        self.stopped.set()
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception('rating flush failed on exit')
+
+
+'''
+create_rating_buffer(app)
+    creates the rating buffer of the application from RATING_FLUSH_*
+    and RATING_LOG_*, and replays the logs left by dead workers
+'''
+
+
+def create_rating_buffer(app):
+    log = None
+    if app.config['RATING_LOG_DIR']:
+        log = RatingLog(app.config['RATING_LOG_DIR'],
+                        fsync=app.config['RATING_LOG_FSYNC'])
+    buffer = RatingBuffer(app, interval=app.config['RATING_FLUSH_INTERVAL'],
+                          max_pending=app.config['RATING_FLUSH_SIZE'],
+                          log=log)
+    buffer.replay()
+    return buffer
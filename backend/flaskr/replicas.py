@@ -0,0 +1,94 @@
+# third-party imports
+from flask import g, request
+from threading import Lock
+import random
+import time
+
+# local imports
+from models import db
+
+# cookie holding the time of the last write of a client
+RECENT_WRITE_COOKIE = 'trivia_recent_write'
+
+# methods whose requests never write
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+# method for marking a view that only reads, e.g. a POST search
+def read_only(view):
+    view.read_only = True
+    return view
+
+
+# method for checking if the client wrote less than `window` seconds ago
+def wrote_recently(window):
+    try:
+        written_at = float(request.cookies.get(RECENT_WRITE_COOKIE, ''))
+    except ValueError:
+        return False
+    return 0 <= time.time() - written_at < window
+
+
+'''
+ReplicaRouter
+    sends the reads of GET and read_only requests to a random replica,
+    and everything else to the primary. A successful write sets a cookie
+    under which the client reads from the primary for `window` seconds,
+    the time replicas need to catch up with its write. The replica
+    engines are created by the first request.
+'''
+
+
+class ReplicaRouter(object):
+
+    def __init__(self, app, window=5):
+        self.app = app
+        self.window = window
+        self.lock = Lock()
+        self.replica_engines = None
+        app.before_request(self.route)
+        app.after_request(self.remember_write)
+        app.teardown_request(self.release)
+
+    @property
+    def engines(self):
+        if self.replica_engines is None:
+            with self.lock:
+                if self.replica_engines is None:
+                    self.replica_engines = db.create_replica_engines(
+                        self.app)
+        return self.replica_engines
+
+    def reads_only(self):
+        if request.method in READ_METHODS:
+            return True
+        view = self.app.view_functions.get(request.endpoint)
+        return getattr(view, 'read_only', False)
+
+    def route(self):
+        g.recent_write = wrote_recently(self.window)
+        if self.reads_only() and not g.recent_write:
+            db.session.info['replica'] = random.choice(self.engines)
+
+    def remember_write(self, response):
+        if not self.reads_only() and response.status_code < 400:
+            response.set_cookie(RECENT_WRITE_COOKIE, str(time.time()),
+                                max_age=self.window, httponly=True,
+                                samesite='Lax')
+        return response
+
+    def release(self, exception=None):
+        db.session.info.pop('replica', None)
+
+
+'''
+create_replica_router(app)
+    creates the router of the replicas of SQLALCHEMY_REPLICA_URIS, None
+    when there is none and every query goes to the primary
+'''
+
+
+def create_replica_router(app):
+    if not app.config.get('SQLALCHEMY_REPLICA_URIS'):
+        return None
+    return ReplicaRouter(app, window=app.config['REPLICA_READ_YOUR_WRITES'])
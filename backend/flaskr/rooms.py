@@ -0,0 +1,286 @@
+# third-party imports
+from collections import OrderedDict
+from threading import Condition, Lock
+import heapq
+import json
+import secrets
+import time
+
+# comment line sent to idle streams, keeps proxies from closing them
+KEEP_ALIVE = b': keep-alive\n\n'
+
+# players listed in the standings of a finished room
+STANDINGS_SIZE = 10
+
+
+# method for the Server-Sent Events message of an event
+def encode_event(event_id, name, payload):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event_id, name, json.dumps(payload, sort_keys=True,
+                                   separators=(',', ':'))).encode('utf-8')
+
+
+# method for comparing the answer of a player with the right one
+def normalize_answer(answer):
+    return ' '.join(answer.lower().split())
+
+
+# method for resolving a waiting future from another thread
+def wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+'''
+Room
+    a live quiz played by many players on one question sequence, picked
+    once when the room is created. The host moves through the questions,
+    every question and the answer statistics of every closed question
+    are encoded once as Server-Sent Events and appended to the events of
+    the room, which every stream sends from its last event id. Streams
+    wait on threads with the condition or on event loops with a future
+    shared by every stream of the loop. At most `max_players` players
+    join it.
+'''
+
+
+class Room(object):
+
+    def __init__(self, room_id, host_token, category_id, questions,
+                 max_players=1000):
+        self.id = room_id
+        self.host_token = host_token
+        self.category_id = category_id
+        self.questions = questions
+        self.max_players = max_players
+        # position of the question being played, -1 before the first
+        self.current = -1
+        # player id -> [name, score]
+        self.players = {}
+        # player id -> whether the answer to the current question is right
+        self.answers = {}
+        # encoded events, the id of an event is its position + 1
+        self.events = []
+        self.closed = False
+        # monotonic time the room closed at, None while it is open
+        self.closed_at = None
+        self.condition = Condition()
+        # event loop -> future resolved by the next event
+        self.waiters = {}
+
+    def is_host(self, token):
+        return isinstance(token, str) and secrets.compare_digest(
+            token, self.host_token)
+
+    def publish(self, name, payload):
+        """Appends an event and wakes the streams, holding the condition"""
+        self.events.append(encode_event(len(self.events) + 1, name, payload))
+        self.condition.notify_all()
+        waiters, self.waiters = self.waiters, {}
+        for loop, future in waiters.items():
+            loop.call_soon_threadsafe(wake, future)
+
+    def join(self, name):
+        """
+        Returns the id of a new player, None once the room is closed or
+        full
+        """
+        with self.condition:
+            if self.closed or len(self.players) >= self.max_players:
+                return None
+            player_id = secrets.token_urlsafe(8)
+            self.players[player_id] = [name, 0]
+            return player_id
+
+    def advance(self):
+        """
+        Publishes the results of the current question and the next
+        question, or the standings after the last one. Returns False
+        once the room is closed.
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            if self.current >= 0:
+                self.publish('results', self.results())
+            self.current += 1
+            self.answers = {}
+            if self.current < len(self.questions):
+                question = dict(self.questions[self.current])
+                del question['answer']
+                self.publish('question', {
+                    'number': self.current + 1,
+                    'total_questions': len(self.questions),
+                    'question': question})
+            else:
+                self.end()
+            return True
+
+    def answer(self, player_id, answer):
+        """
+        Records the first answer of a player to the current question,
+        returns False when there is none or the player already answered.
+        Raises KeyError if the player is not in the room.
+        """
+        with self.condition:
+            if player_id not in self.players:
+                raise KeyError(player_id)
+            if self.closed or self.current < 0 or player_id in self.answers:
+                return False
+            correct = normalize_answer(answer) == normalize_answer(
+                self.questions[self.current]['answer'])
+            self.answers[player_id] = correct
+            if correct:
+                self.players[player_id][1] += 1
+            return True
+
+    def results(self):
+        question = self.questions[self.current]
+        return {
+            'number': self.current + 1,
+            'answer': question['answer'],
+            'answered': len(self.answers),
+            'correct': sum(self.answers.values()),
+            'players': len(self.players),
+        }
+
+    def standings(self):
+        leaders = heapq.nlargest(STANDINGS_SIZE, self.players.values(),
+                                 key=lambda player: player[1])
+        return {
+            'players': len(self.players),
+            'leaders': [{'name': name, 'score': score}
+                        for name, score in leaders],
+        }
+
+    def end(self):
+        """Closes the room with the standings, holding the condition"""
+        self.closed = True
+        self.closed_at = time.monotonic()
+        self.publish('end', self.standings())
+
+    def close(self):
+        with self.condition:
+            if not self.closed:
+                self.end()
+
+    def expired(self, now, grace):
+        """Checks if the room closed more than `grace` seconds ago"""
+        closed_at = self.closed_at
+        return closed_at is not None and now - closed_at >= grace
+
+    def wait(self, last_event_id, timeout):
+        """
+        Returns the events after `last_event_id` and whether the room is
+        closed, waiting up to `timeout` seconds for one on this thread
+        """
+        with self.condition:
+            if len(self.events) <= last_event_id and not self.closed:
+                self.condition.wait(timeout)
+            return self.events[last_event_id:], self.closed
+
+    def poll(self, last_event_id, loop):
+        """
+        Returns the events after `last_event_id`, whether the room is
+        closed, and when there is no event and the room is open a future
+        of `loop` resolved by the next event
+        """
+        with self.condition:
+            events = self.events[last_event_id:]
+            if events or self.closed:
+                return events, self.closed, None
+            future = self.waiters.get(loop)
+            if future is None:
+                future = self.waiters[loop] = loop.create_future()
+            return events, self.closed, future
+
+
+class RoomStore(object):
+    """
+    In-process store of the live rooms, closes the least recently used
+    room when more than `maxsize` rooms are open and drops the rooms
+    closed for `grace` seconds, once their streams got the end. Every
+    request of a room has to reach the worker that created it.
+    """
+
+    def __init__(self, maxsize=1000, max_players=1000, grace=300):
+        self.maxsize = maxsize
+        self.max_players = max_players
+        self.grace = grace
+        self.rooms = OrderedDict()
+        self.lock = Lock()
+
+    def create(self, category_id, questions):
+        room = Room(secrets.token_urlsafe(8), secrets.token_urlsafe(16),
+                    category_id, questions, self.max_players)
+        evicted = []
+        now = time.monotonic()
+        with self.lock:
+            for expired in [room_id for room_id, other
+                            in self.rooms.items()
+                            if other.expired(now, self.grace)]:
+                del self.rooms[expired]
+            self.rooms[room.id] = room
+            while len(self.rooms) > self.maxsize:
+                evicted.append(self.rooms.popitem(last=False)[1])
+        for old_room in evicted:
+            old_room.close()
+        return room
+
+    def get(self, room_id):
+        with self.lock:
+            room = self.rooms.get(room_id)
+            if room is None:
+                return None
+            if room.expired(time.monotonic(), self.grace):
+                del self.rooms[room_id]
+                return None
+            self.rooms.move_to_end(room_id)
+            return room
+
+    def __len__(self):
+        return len(self.rooms)
+
+
+# method for the last event id a reconnecting stream received
+def last_event_id(value):
+    try:
+        return max(0, int(value or 0))
+    except ValueError:
+        return 0
+
+
+'''
+room_stream(room, last_event_id, heartbeat)
+    the Server-Sent Events of a room after `last_event_id` for a WSGI
+    response, holding a thread per stream. The ASGI application streams
+    rooms on its event loop instead.
+'''
+
+
+def room_stream(room, last_event_id, heartbeat):
+    # WSGI servers send the headers with the first chunk
+    yield KEEP_ALIVE
+    while True:
+        events, closed = room.wait(last_event_id, heartbeat)
+        if events:
+            last_event_id += len(events)
+            yield b''.join(events)
+        elif closed:
+            return
+        else:
+            yield KEEP_ALIVE
+
+
+'''
+create_room_store(config)
+    creates the live room store of the application, keeping at most
+    ROOM_MAX rooms of ROOM_MAX_PLAYERS players, ROOM_CLOSED_TTL seconds
+    after they close
+'''
+
+
+def create_room_store(config):
+    return RoomStore(maxsize=config['ROOM_MAX'],
+                     max_players=config['ROOM_MAX_PLAYERS'],
+                     grace=config['ROOM_CLOSED_TTL'])
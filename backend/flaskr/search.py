@@ -0,0 +1,217 @@
+# third-party imports
+from sqlalchemy import func, literal_column
+from sqlalchemy.engine.url import make_url
+from threading import Lock
+import heapq
+import re
+
+# local imports
+from models import (count_questions, listen_for_changes, primary_reads, db,
+                    Question)
+from .serialization import question_rows, QUESTION_COLUMNS
+
+# text search configuration of the full-text index on postgres
+SEARCH_LANGUAGE = 'english'
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+# method for splitting a text into lower case word tokens
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+class SearchBackend(object):
+    """
+    Interface of the question search backends.
+    search() returns the question rows (see serialization.question_rows)
+    of one page in rank order and the total number of matching questions.
+    """
+
+    def search(self, term, offset, limit):
+        raise NotImplementedError
+
+
+class IlikeSearchBackend(SearchBackend):
+    """Substring search with ILIKE, scans the whole table"""
+
+    def search(self, term, offset, limit):
+        selection = Question.query.filter(
+            Question.question.ilike(f'%{term}%'))
+        total = count_questions(selection)
+        questions = question_rows(selection.order_by(Question.id).offset(
+            offset).limit(limit))
+        return questions, total
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Full-text search on postgres, served by the GIN index
+    ix_questions_question_fts on to_tsvector('english', question)
+    """
+
+    @staticmethod
+    def criteria(term):
+        """Returns the match condition and the rank order of `term`"""
+        language = literal_column(f"'{SEARCH_LANGUAGE}'")
+        vector = func.to_tsvector(language, Question.question)
+        query = func.plainto_tsquery(language, term)
+        return (vector.op('@@')(query),
+                (func.ts_rank(vector, query).desc(), Question.id))
+
+    def search(self, term, offset, limit):
+        match, order = self.criteria(term)
+        selection = Question.query.filter(match)
+        total = count_questions(selection)
+        questions = question_rows(selection.order_by(*order).offset(
+            offset).limit(limit))
+        return questions, total
+
+
+class InvertedIndexSearchBackend(SearchBackend):
+    """
+    In-process inverted index of the question tokens, for databases
+    without full-text search such as sqlite. Questions match when
+    they contain every token of the term and rank by term frequency.
+    The index is built on first use and kept up to date from the
+    committed question changes, `changes` (a ChangeWatcher) reloads it
+    after the writes of the other workers. Ratings are not indexed, the
+    index does not follow QUESTION_RATINGS.
+    """
+
+    def __init__(self, changes=None):
+        self.lock = Lock()
+        self.changes = changes
+        # token -> {question id: occurrences}
+        self.postings = None
+        # question id -> tokens
+        self.documents = None
+
+    def build(self):
+        postings = {}
+        documents = {}
+        with primary_reads():
+            rows = db.session.query(Question.id, Question.question).all()
+        for question_id, text in rows:
+            self.add(postings, documents, question_id, text)
+        self.postings = postings
+        self.documents = documents
+
+    @staticmethod
+    def add(postings, documents, question_id, text):
+        tokens = tokenize(text)
+        documents[question_id] = tokens
+        for token in tokens:
+            posting = postings.setdefault(token, {})
+            posting[question_id] = posting.get(question_id, 0) + 1
+
+    @staticmethod
+    def remove(postings, documents, question_id):
+        for token in documents.pop(question_id, ()):
+            posting = postings.get(token)
+            if posting is not None:
+                posting.pop(question_id, None)
+                if not posting:
+                    del postings[token]
+
+    def on_change(self, operation, record):
+        with self.lock:
+            if self.postings is None:
+                return
+            if operation == 'reload':
+                self.postings = None
+                self.documents = None
+                return
+            # new categories or difficulties leave the tokens as they are
+            if operation == 'update' and self.documents.get(
+                    record['id']) == tokenize(record['question']):
+                return
+            if operation in ('update', 'delete'):
+                self.remove(self.postings, self.documents, record['id'])
+            if operation in ('insert', 'update'):
+                self.add(self.postings, self.documents, record['id'],
+                         record['question'])
+
+    def invalidate(self):
+        with self.lock:
+            self.postings = None
+            self.documents = None
+
+    def search(self, term, offset, limit):
+        tokens = set(tokenize(term))
+        if self.changes is not None:
+            self.changes.sync()
+        with self.lock:
+            if self.postings is None:
+                self.build()
+            scores = None
+            for token in tokens:
+                posting = self.postings.get(token, {})
+                if scores is None:
+                    scores = dict(posting)
+                else:
+                    # keep the questions matching every token
+                    scores = {question_id: score + posting[question_id]
+                              for question_id, score in scores.items()
+                              if question_id in posting}
+                if not scores:
+                    break
+        if not scores:
+            return [], 0
+
+        # best score first, then oldest question
+        def rank(question_id):
+            return -scores[question_id], question_id
+
+        # only the questions up to the requested page need ordering
+        ranked = heapq.nsmallest(offset + limit, scores, key=rank)
+        page_ids = ranked[offset:offset + limit]
+        questions = {
+            row[0]: row for row in db.session.query(
+                *QUESTION_COLUMNS).filter(Question.id.in_(page_ids))}
+        return ([questions[question_id] for question_id in page_ids
+                 if question_id in questions], len(scores))
+
+
+class ColumnarSearchBackend(SearchBackend):
+    """Substring search, like ILIKE, scanning the columnar store"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def search(self, term, offset, limit):
+        return self.store.search(term, offset, limit)
+
+
+'''
+create_search_backend(app)
+    creates the backend named by `SEARCH_BACKEND`: 'postgres', 'memory',
+    'ilike', 'columnar' or 'auto' (the columnar question store when it
+    is enabled, full-text search on postgres, memory otherwise)
+'''
+
+
+def create_search_backend(app):
+    name = app.config.get('SEARCH_BACKEND', 'auto')
+    store = app.extensions.get('question_store')
+    if name == 'auto' and store is not None:
+        name = 'columnar'
+    if name == 'auto':
+        uri = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        name = 'postgres' if uri.get_backend_name() in (
+            'postgres', 'postgresql') else 'memory'
+    if name == 'postgres':
+        return PostgresSearchBackend()
+    if name == 'ilike':
+        return IlikeSearchBackend()
+    if name == 'columnar':
+        if store is None:
+            raise ValueError('The columnar search backend needs '
+                             'QUESTION_STORE = columnar')
+        return ColumnarSearchBackend(store)
+    if name == 'memory':
+        backend = InvertedIndexSearchBackend(
+            changes=app.extensions['change_watcher'])
+        listen_for_changes(app, Question.__tablename__, backend.on_change)
+        return backend
+    raise ValueError(f'Unknown search backend {name!r}')
@@ -0,0 +1,203 @@
+# third-party imports
+from collections import namedtuple
+from flask import current_app, jsonify
+from functools import lru_cache
+from json.encoder import encode_basestring, encode_basestring_ascii
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# local imports
+from models import timed_serializer, Question
+
+# columns of the serialised questions, in the order rows are selected
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty',
+                   'rating')
+QUESTION_COLUMNS = [getattr(Question, field) for field in QUESTION_FIELDS]
+
+# position of each field of a row, in the order jsonify sorts the keys
+SORTED_POSITIONS = sorted(range(len(QUESTION_FIELDS)),
+                          key=QUESTION_FIELDS.__getitem__)
+
+# characters escaped by the json module with ensure_ascii only
+NON_ASCII = re.compile('[\x7f-\U0010ffff]')
+
+# orjson writes datetimes, dataclasses and subclasses of the builtin
+# types its own way, they go through the json module instead
+if orjson is not None:
+    ORJSON_OPTIONS = (orjson.OPT_PASSTHROUGH_DATETIME
+                      | orjson.OPT_PASSTHROUGH_DATACLASS
+                      | orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+
+class QuestionRow(namedtuple('QuestionRow', QUESTION_FIELDS)):
+    """A question read without the ORM, serialised like the model"""
+    __slots__ = ()
+
+    format = Question.format
+
+
+class Fragment(object):
+    """JSON text encoded once and inserted verbatim into responses"""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+# method for the \\uXXXX escape of a character, as ensure_ascii writes it
+def escape_non_ascii(match):
+    code = ord(match.group())
+    if code < 0x10000:
+        return '\\u{:04x}'.format(code)
+    code -= 0x10000
+    return '\\u{:04x}\\u{:04x}'.format(0xd800 | (code >> 10),
+                                       0xdc00 | (code & 0x3ff))
+
+
+'''
+dumps(value)
+    compact JSON of `value` exactly as jsonify writes it outside of debug
+    mode, with orjson when it is installed. orjson writes floats in
+    another notation, responses hold integers and strings only.
+'''
+
+
+def dumps(value):
+    config = current_app.config
+    if orjson is not None:
+        options = ORJSON_OPTIONS
+        if config['JSON_SORT_KEYS']:
+            options |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(value, option=options)
+        except TypeError:
+            # unsupported types, integer keys, 64-bit overflows
+            pass
+        else:
+            text = data.decode('utf-8')
+            if not config['JSON_AS_ASCII'] or (
+                    data.isascii() and b'\x7f' not in data):
+                return text
+            return NON_ASCII.sub(escape_non_ascii, text)
+    return json.dumps(value, cls=current_app.json_encoder,
+                      sort_keys=config['JSON_SORT_KEYS'],
+                      ensure_ascii=config['JSON_AS_ASCII'],
+                      separators=(',', ':'))
+
+
+# method for the JSON text of an object key
+@lru_cache(maxsize=256)
+def encode_key(key, ensure_ascii=True):
+    escape = encode_basestring_ascii if ensure_ascii else encode_basestring
+    return escape(key)
+
+
+'''
+compose(payload)
+    compact JSON of a response object whose values may be Fragments,
+    the other values are encoded with dumps
+'''
+
+
+def compose(payload):
+    config = current_app.config
+    items = payload.items()
+    if config['JSON_SORT_KEYS']:
+        items = sorted(items)
+    return '{%s}' % ','.join(
+        '%s:%s' % (encode_key(key, config['JSON_AS_ASCII']),
+                   value.text if isinstance(value, Fragment)
+                   else dumps(value))
+        for key, value in items)
+
+
+'''
+json_response(payload, status)
+    response of `payload` with the same body as jsonify(payload), the
+    Fragments are not encoded again. Debug and pretty printed responses
+    are indented by jsonify.
+'''
+
+
+@timed_serializer
+def json_response(payload, status=200):
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+            current_app.debug:
+        response = jsonify({
+            key: json.loads(value.text) if isinstance(value, Fragment)
+            else value for key, value in payload.items()})
+        response.status_code = status
+        return response
+    return current_app.response_class(
+        compose(payload) + '\n', status=status,
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+'''
+question_rows(selection)
+    (id, question, answer, category, difficulty, rating) tuples of a
+    question query, read without building ORM objects
+'''
+
+
+def question_rows(selection):
+    return selection.with_entities(*QUESTION_COLUMNS).all()
+
+
+# method for the JSON text of a scalar column value
+def encode_value(value, escape=encode_basestring_ascii):
+    if value is None:
+        return 'null'
+    if type(value) is str:
+        return escape(value)
+    if type(value) is int:
+        return int.__repr__(value)
+    return json.dumps(value)
+
+
+# method for the %-template of a question object with sorted keys
+def row_template(item_separator, key_separator):
+    return '{%s}' % item_separator.join(
+        '"%s"%s%%s' % (QUESTION_FIELDS[position], key_separator)
+        for position in SORTED_POSITIONS)
+
+
+# a question object as jsonify writes it and as json.dumps writes it
+COMPACT_ROW = row_template(',', ':')
+SPACED_ROW = row_template(', ', ': ')
+
+
+'''
+row_json(row, template, escape)
+    JSON text of a question row with the keys of Question.format,
+    without building the dict
+'''
+
+
+def row_json(row, template=SPACED_ROW, escape=encode_basestring_ascii):
+    return template % tuple(encode_value(row[position], escape)
+                            for position in SORTED_POSITIONS)
+
+
+'''
+questions_fragment(rows)
+    Fragment of the list of formatted questions of question rows,
+    encoded by orjson when it is installed
+'''
+
+
+@timed_serializer
+def questions_fragment(rows):
+    config = current_app.config
+    if orjson is not None or not config['JSON_SORT_KEYS']:
+        return Fragment(dumps([dict(zip(QUESTION_FIELDS, row))
+                               for row in rows]))
+    escape = encode_basestring_ascii if config['JSON_AS_ASCII'] \
+        else encode_basestring
+    return Fragment('[%s]' % ','.join(
+        row_json(row, COMPACT_ROW, escape) for row in rows))
@@ -0,0 +1,95 @@
+# third-party imports
+from array import array
+from collections import OrderedDict
+from threading import Lock
+from werkzeug.utils import import_string
+import secrets
+
+
+class QuizSessionStore(object):
+    """
+    Interface of the stores keeping the question queue of quiz sessions.
+    A shared backend (e.g. a Redis list per session) only has to
+    implement these methods to replace the in-process store.
+    """
+
+    @classmethod
+    def from_config(cls, config):
+        return cls()
+
+    def create(self, session_id, question_ids):
+        """Stores the ordered queue of question ids of a new session"""
+        raise NotImplementedError
+
+    def pop(self, session_id):
+        """
+        Removes and returns the next question id of the session,
+        None when the queue is empty.
+        Raises KeyError if the session does not exist.
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """
+        Removes the session.
+        Raises KeyError if the session does not exist.
+        """
+        raise NotImplementedError
+
+
+class LRUSessionStore(QuizSessionStore):
+    """
+    In-process store, evicts the least recently used session
+    when more than `maxsize` sessions are stored. Each session keeps
+    its ids in a packed array, 8 bytes per question, and the position
+    of its next question.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(maxsize=config['QUIZ_SESSION_MAX'])
+
+    def create(self, session_id, question_ids):
+        with self.lock:
+            self.sessions[session_id] = [array('Q', question_ids), 0]
+            # evict the least recently used sessions
+            while len(self.sessions) > self.maxsize:
+                self.sessions.popitem(last=False)
+
+    def pop(self, session_id):
+        with self.lock:
+            session = self.sessions[session_id]
+            self.sessions.move_to_end(session_id)
+            question_ids, position = session
+            if position < len(question_ids):
+                session[1] = position + 1
+                return question_ids[position]
+            return None
+
+    def delete(self, session_id):
+        with self.lock:
+            del self.sessions[session_id]
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+'''
+create_session_store(config)
+    creates the quiz session store named by `QUIZ_SESSION_STORE`
+'''
+
+
+def create_session_store(config):
+    store_class = import_string(config['QUIZ_SESSION_STORE'])
+    return store_class.from_config(config)
+
+
+# method for generating a new unguessable session id
+def new_session_id():
+    return secrets.token_urlsafe(16)
@@ -0,0 +1,64 @@
+# third-party imports
+import json
+import mmap
+import os
+import struct
+
+# length of the JSON header following the magic of a snapshot file
+HEADER_LENGTH = struct.Struct('<Q')
+
+
+'''
+write_snapshot(path, magic, header, sections)
+    writes `magic`, the length of a JSON header, the header and the
+    (name, buffer) sections to `path` atomically. The header gets the
+    position, size and typecode of each section, relative to its end.
+'''
+
+
+def write_snapshot(path, magic, header, sections):
+    layout = {}
+    position = 0
+    for name, data in sections:
+        size = memoryview(data).nbytes
+        layout[name] = [position, size, getattr(data, 'typecode', 'B')]
+        position += size
+    header = json.dumps(dict(header, sections=layout)).encode('utf-8')
+
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(magic)
+        snapshot_file.write(HEADER_LENGTH.pack(len(header)))
+        snapshot_file.write(header)
+        for name, data in sections:
+            snapshot_file.write(memoryview(data).cast('B'))
+    os.replace(temporary, path)
+
+
+'''
+map_snapshot(path, magic, writable)
+    memory-maps a snapshot file, returns its header and a dict of its
+    sections as memoryviews of their typecode. Pages are shared by the
+    processes mapping the file, a `writable` map copies the pages it
+    writes to and never changes the file.
+'''
+
+
+def map_snapshot(path, magic, writable=False):
+    with open(path, 'rb') as snapshot_file:
+        mapped = mmap.mmap(snapshot_file.fileno(), 0, access=(
+            mmap.ACCESS_COPY if writable else mmap.ACCESS_READ))
+    if mapped[:len(magic)] != magic:
+        raise ValueError('{} is not a {} file'.format(path, magic))
+    start = len(magic)
+    length, = HEADER_LENGTH.unpack_from(mapped, start)
+    start += HEADER_LENGTH.size
+    header = json.loads(mapped[start:start + length].decode('utf-8'))
+    start += length
+
+    view = memoryview(mapped)
+    sections = {}
+    for name, (position, size, typecode) in header['sections'].items():
+        data = view[start + position:start + position + size]
+        sections[name] = data if typecode == 'B' else data.cast(typecode)
+    return header, sections
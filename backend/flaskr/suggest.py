@@ -0,0 +1,218 @@
+# third-party imports
+from bisect import bisect_left, insort
+from threading import Lock
+
+# local imports
+from models import (get_categories, listen_for_changes, primary_reads, db,
+                    Question)
+from .search import tokenize
+
+# postings entries read at most per suggestion, bounds the latency of
+# short prefixes matching most questions
+SUGGEST_MAX_SCAN = 1000
+
+
+# method for the snippet of a question text, cut on a word boundary
+def snippet(text, length):
+    text = ' '.join((text or '').split())
+    if len(text) <= length:
+        return text
+    cut = text.rfind(' ', 0, length)
+    return text[:cut if cut > 0 else length].rstrip(' ,;:') + '...'
+
+
+'''
+SuggestionIndex
+    prefix index of the question tokens for search-as-you-type. The
+    distinct tokens are kept in one sorted list, the completions of a
+    prefix are the consecutive tokens found with bisect, and each token
+    keeps the sorted ids of its questions. The index is built on first
+    use and kept up to date from the committed question changes: new
+    ids are appended to their postings and only tokens appearing or
+    disappearing move the sorted list. `changes`, a ChangeWatcher,
+    reloads it after the writes of the other workers.
+'''
+
+
+class SuggestionIndex(object):
+
+    def __init__(self, snippet_length=80, changes=None):
+        self.snippet_length = snippet_length
+        self.changes = changes
+        self.lock = Lock()
+        # one build at a time, run without holding the lock
+        self.build_lock = Lock()
+        # sorted distinct tokens
+        self.tokens = None
+        # token -> sorted question ids
+        self.postings = None
+        # question id -> (tokens, snippet)
+        self.documents = None
+        # changes committed while a build runs, applied once it is done
+        self.backlog = None
+
+    def load(self):
+        """Returns the tokens, postings and documents of the database"""
+        with primary_reads():
+            rows = db.session.query(Question.id, Question.question).order_by(
+                Question.id).all()
+        postings = {}
+        documents = {}
+        for question_id, text in rows:
+            documents[question_id] = (frozenset(tokenize(text)),
+                                      snippet(text, self.snippet_length))
+            for token in documents[question_id][0]:
+                # ids arrive in order, the postings stay sorted
+                postings.setdefault(token, []).append(question_id)
+        return sorted(postings), postings, documents
+
+    def build(self):
+        """
+        Loads the index while suggestions and commits go on, then swaps
+        it in with the changes committed meanwhile
+        """
+        with self.build_lock:
+            if self.tokens is not None:
+                return
+            with self.lock:
+                self.backlog = []
+            try:
+                index = self.load()
+            except Exception:
+                with self.lock:
+                    self.backlog = None
+                raise
+            with self.lock:
+                self.tokens, self.postings, self.documents = index
+                backlog, self.backlog = self.backlog, None
+                for operation, record in backlog:
+                    self.apply(operation, record)
+
+    def add(self, question_id, text):
+        tokens = frozenset(tokenize(text))
+        self.documents[question_id] = (tokens,
+                                       snippet(text, self.snippet_length))
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                self.postings[token] = [question_id]
+                insort(self.tokens, token)
+            elif posting[-1] < question_id:
+                posting.append(question_id)
+            else:
+                insort(posting, question_id)
+
+    def remove(self, question_id):
+        tokens, _ = self.documents.pop(question_id, ((), None))
+        for token in tokens:
+            posting = self.postings[token]
+            del posting[bisect_left(posting, question_id)]
+            if not posting:
+                del self.postings[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def on_change(self, operation, record):
+        with self.lock:
+            if self.tokens is not None:
+                self.apply(operation, record)
+            elif self.backlog is not None:
+                self.backlog.append((operation, record))
+
+    def apply(self, operation, record):
+        """Applies a change to the built index, holding the lock"""
+        if self.tokens is None:
+            return
+        if operation == 'reload':
+            self.tokens = self.postings = self.documents = None
+            return
+        question_id = record['id']
+        if operation == 'update':
+            # new categories or difficulties leave the tokens as they are
+            document = self.documents.get(question_id)
+            if document is not None and document[0] == frozenset(
+                    tokenize(record['question'])):
+                return
+        # a change replayed after a build may already be loaded
+        self.remove(question_id)
+        if operation in ('insert', 'update'):
+            self.add(question_id, record['question'])
+
+    def suggest(self, query, limit):
+        """
+        Returns the [(id, snippet)] of the first `limit` questions
+        containing every complete word of `query` and a token starting
+        with its last word, closest completions and oldest first
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        prefix, required = words[-1], frozenset(words[:-1])
+        if self.changes is not None:
+            self.changes.sync()
+        if self.tokens is None:
+            self.build()
+        with self.lock:
+            if self.tokens is None:
+                # reloaded since the build
+                return []
+            if any(word not in self.postings for word in required):
+                return []
+            found = []
+            seen = set()
+            scanned = 0
+            position = bisect_left(self.tokens, prefix)
+            while position < len(self.tokens) and \
+                    len(found) < limit and scanned < SUGGEST_MAX_SCAN:
+                token = self.tokens[position]
+                if not token.startswith(prefix):
+                    break
+                for question_id in self.postings[token]:
+                    scanned += 1
+                    if question_id in seen:
+                        continue
+                    tokens, text = self.documents[question_id]
+                    if required <= tokens:
+                        seen.add(question_id)
+                        found.append((question_id, text))
+                        if len(found) == limit:
+                            break
+                    if scanned >= SUGGEST_MAX_SCAN:
+                        break
+                position += 1
+        return found
+
+    def __len__(self):
+        return len(self.tokens or ())
+
+
+# method for the categories whose name has a word starting with each
+# word of `query`, from the cached categories
+def suggest_categories(query, limit):
+    words = tokenize(query)
+    if not words:
+        return []
+    suggestions = []
+    for category_id, name in sorted(get_categories().items()):
+        tokens = tokenize(name)
+        if all(any(token.startswith(word) for token in tokens)
+               for word in words):
+            suggestions.append({'id': category_id, 'type': name})
+            if len(suggestions) == limit:
+                break
+    return suggestions
+
+
+'''
+create_suggestion_index(app)
+    creates the prefix index of GET /questions/suggest, updated after
+    each committed change of the questions and reloaded after the writes
+    of the other workers. Ratings are written under QUESTION_RATINGS,
+    which the index does not follow.
+'''
+
+
+def create_suggestion_index(app):
+    index = SuggestionIndex(snippet_length=app.config['SUGGEST_SNIPPET'],
+                            changes=app.extensions['change_watcher'])
+    listen_for_changes(app, Question.__tablename__, index.on_change)
+    return index
@@ -0,0 +1,368 @@
+# third-party imports
+from functools import wraps
+import re
+
+from flask import abort, json, request
+
+# integers may be sent as strings, e.g. the category ids of the frontend
+INTEGER = re.compile(r'^-?[0-9]+$')
+
+# kinds of the values of a request body
+KINDS = ('int', 'str', 'list', 'object')
+
+# ratings are stars, from 1 to 5
+RATING_MIN = 1
+RATING_MAX = 5
+
+# integer columns of the questions hold 32-bit values on postgres
+INTEGER_MIN = -2 ** 31
+INTEGER_MAX = 2 ** 31 - 1
+
+
+# method Check if any of elements in list is None
+def check_if_one_none(list_of_elem):
+    result = False
+    for elem in list_of_elem:
+        if elem is None or elem == "":
+            result = True
+            return result
+    return result
+
+
+'''
+Field(kind, required, default, minimum, maximum, min_length, max_length,
+      choices, items, fields)
+    declarative rule of a value of a JSON request body: an int, integer
+    strings are converted, a str, a list of `items` fields or an object
+    of `fields`. A missing or null value is an error when `required`,
+    `default` otherwise. The limits are numbers or the name of a config
+    key, read once when the schema is compiled.
+'''
+
+
+class Field(object):
+
+    def __init__(self, kind, required=False, default=None, minimum=None,
+                 maximum=None, min_length=None, max_length=None,
+                 choices=None, items=None, fields=None):
+        self.kind = kind
+        self.required = required
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.min_length = min_length
+        self.max_length = max_length
+        self.choices = choices
+        self.items = items
+        self.fields = fields
+
+
+'''
+Schema(fields, status, check)
+    the {name: Field} of a JSON object request body. `check(values)`
+    validates the values together and returns an error message or None.
+    Invalid bodies are answered with `status`.
+'''
+
+
+class Schema(object):
+
+    def __init__(self, fields, status=400, check=None):
+        self.fields = fields
+        self.status = status
+        self.check = check
+
+
+# method for a limit of a field, read from the config when it is a name
+def resolve_limit(limit, config, name):
+    if not isinstance(limit, str):
+        return limit
+    if limit not in config:
+        raise ValueError('field {} is limited by the unknown config key '
+                         '{}'.format(name, limit))
+    return config[limit]
+
+
+'''
+compile_field(name, field, config)
+    returns the validator of a field, value -> (value, None) or
+    (None, error message), with its limits and nested fields resolved.
+    Raises ValueError when the field is malformed, at startup.
+'''
+
+
+def compile_field(name, field, config):
+    if field.kind not in KINDS:
+        raise ValueError('field {} has the unknown kind {}'.format(
+            name, field.kind))
+    if field.items is not None and field.kind != 'list':
+        raise ValueError('only lists have items, field {}'.format(name))
+    if field.kind == 'object' and field.fields is None:
+        raise ValueError('object field {} has no fields'.format(name))
+    kind, required, default = field.kind, field.required, field.default
+    choices = field.choices
+    minimum = resolve_limit(field.minimum, config, name)
+    maximum = resolve_limit(field.maximum, config, name)
+    min_length = resolve_limit(field.min_length, config, name)
+    max_length = resolve_limit(field.max_length, config, name)
+    items = compile_field(name + ' items', field.items, config) \
+        if field.items is not None else None
+    members = compile_fields(field.fields, config, name) \
+        if field.fields is not None else None
+
+    def validate(value):
+        if value is None:
+            if required:
+                return None, '{} is required'.format(name)
+            return default, None
+
+        if kind == 'int':
+            if type(value) is not int:
+                if not isinstance(value, str) or \
+                        INTEGER.match(value) is None:
+                    return None, '{} must be an integer'.format(name)
+                value = int(value)
+            if minimum is not None and value < minimum:
+                return None, '{} must be at least {}'.format(name, minimum)
+            if maximum is not None and value > maximum:
+                return None, '{} must be at most {}'.format(name, maximum)
+        elif kind == 'object':
+            return members(value)
+        else:
+            if not isinstance(value, str if kind == 'str' else list):
+                return None, '{} must be a {}'.format(name, kind)
+            # lengths first, long lists are rejected before their items
+            if min_length is not None and len(value) < min_length:
+                return None, '{} is too short'.format(name)
+            if max_length is not None and len(value) > max_length:
+                return None, '{} is too long'.format(name)
+            if items is not None:
+                values = []
+                for item in value:
+                    item, error = items(item)
+                    if error is not None:
+                        return None, error
+                    values.append(item)
+                value = values
+
+        if choices is not None and value not in choices:
+            return None, '{} must be one of {}'.format(
+                name, ', '.join(map(str, choices)))
+        return value, None
+
+    return validate
+
+
+# method for the validator of the {name: Field} of an object
+def compile_fields(fields, config, name='body'):
+    members = [(member, compile_field(member, field, config))
+               for member, field in fields.items()]
+
+    def validate(value):
+        if not isinstance(value, dict):
+            return None, '{} must be a JSON object'.format(name)
+        values = {}
+        for member, validate_member in members:
+            values[member], error = validate_member(value.get(member))
+            if error is not None:
+                return None, error
+        return values, None
+
+    return validate
+
+
+class Validator(object):
+    """
+    Compiled schema of a request body, body -> (values, None) or
+    (None, error message). Bodies over `max_bytes` are not read.
+    """
+
+    def __init__(self, schema, config):
+        self.status = schema.status
+        self.check = schema.check
+        self.max_bytes = config['JSON_MAX_BYTES']
+        self.fields = compile_fields(schema.fields, config)
+
+    def __call__(self, body):
+        values, error = self.fields(body)
+        if error is None and self.check is not None:
+            error = self.check(values)
+        if error is not None:
+            return None, error
+        return values, None
+
+
+# method for the category id of a validated quiz_category, None for all
+def quiz_category_id(quiz_category):
+    if quiz_category['type'] == 'click':
+        return None
+    return quiz_category['id']
+
+
+# method for checking the quiz_category of a body has an id or is all
+def check_quiz_category(values):
+    quiz_category = values['quiz_category']
+    if quiz_category['type'] != 'click' and quiz_category['id'] is None:
+        return 'quiz_category id must be an integer'
+    return None
+
+
+# method for checking a quiz body, its category and the answers count
+def check_quiz(values):
+    if values['correct_answers'] > len(values['previous_questions']):
+        return ('correct_answers must be between 0 and the number of '
+                'previous questions')
+    return check_quiz_category(values)
+
+
+# quiz category of the quiz requests, the user clicked on all categories
+# with the type click
+QUIZ_CATEGORY = Field('object', required=True, fields={
+    'type': Field('str', max_length=100),
+    'id': Field('int'),
+})
+
+'''
+REQUEST_SCHEMAS
+    the schemas of the JSON request bodies, compiled by compile_schemas
+    when the application is created
+'''
+
+REQUEST_SCHEMAS = {
+    # POST /questions, and each row of POST /questions/bulk
+    'question': Schema({
+        'question': Field('str', required=True, min_length=1,
+                          max_length='QUESTION_MAX_LENGTH'),
+        'answer': Field('str', required=True, min_length=1,
+                        max_length='QUESTION_MAX_LENGTH'),
+        'category': Field('int', minimum=INTEGER_MIN, maximum=INTEGER_MAX),
+        'difficulty': Field('int', minimum=INTEGER_MIN,
+                            maximum=INTEGER_MAX),
+        'rating': Field('int', minimum=RATING_MIN, maximum=RATING_MAX),
+    }, status=422),
+    # PATCH /questions/<question_id>
+    'rating': Schema({
+        'rating': Field('int', minimum=RATING_MIN, maximum=RATING_MAX),
+    }),
+    # PATCH /questions, {"ratings": [{"id": 5, "rating": 4}, ...]}
+    'ratings': Schema({
+        'ratings': Field('list', required=True, min_length=1,
+                         max_length='RATING_BATCH_MAX',
+                         items=Field('object', required=True, fields={
+                             'id': Field('int', required=True),
+                             'rating': Field('int', required=True,
+                                             minimum=RATING_MIN,
+                                             maximum=RATING_MAX),
+                         })),
+    }),
+    # POST /questions/search
+    'search': Schema({
+        'searchTerm': Field('str', max_length='SEARCH_TERM_MAX_LENGTH'),
+        'page': Field('int', default=1, minimum=1),
+        'limit': Field('int', minimum=1),
+    }),
+    # POST /quizzes, in random or in adaptive mode
+    'quiz': Schema({
+        'quiz_category': QUIZ_CATEGORY,
+        'previous_questions': Field('list', required=True,
+                                    max_length='QUIZ_MAX_PREVIOUS',
+                                    items=Field('int', required=True)),
+        'mode': Field('str', default='random',
+                      choices=('random', 'adaptive')),
+        'correct_answers': Field('int', default=0, minimum=0),
+    }, check=check_quiz),
+    # POST /quizzes/sessions and POST /quizzes/decks
+    'quiz_category': Schema({
+        'quiz_category': QUIZ_CATEGORY,
+    }, check=check_quiz_category),
+    # POST /rooms
+    'room': Schema({
+        'quiz_category': QUIZ_CATEGORY,
+        'questions': Field('int', minimum=1, maximum='ROOM_MAX_QUESTIONS'),
+    }, check=check_quiz_category),
+    # POST /rooms/<room_id>/players
+    'player': Schema({
+        'name': Field('str', required=True, max_length=50),
+    }),
+    # POST /rooms/<room_id>/next, only the host moves the room on
+    'host': Schema({
+        'host_token': Field('str', required=True, max_length=100),
+    }, status=403),
+    # POST /rooms/<room_id>/answers
+    'answer': Schema({
+        'player_id': Field('str', required=True, max_length=100),
+        'answer': Field('str', required=True,
+                        max_length='QUESTION_MAX_LENGTH'),
+    }),
+}
+
+
+'''
+compile_schemas(config)
+    returns the {name: Validator} of REQUEST_SCHEMAS with the limits of
+    `config`, raises ValueError when a schema is malformed so that the
+    application fails when it starts rather than on a request
+'''
+
+
+def compile_schemas(config):
+    return {name: Validator(schema, config)
+            for name, schema in REQUEST_SCHEMAS.items()}
+
+
+'''
+read_body(limit)
+    returns the request body, reading at most `limit` + 1 bytes of it so
+    that chunked bodies without a Content-Length are limited too, None
+    when it is larger than `limit`
+'''
+
+
+def read_body(limit):
+    if (request.content_length or 0) > limit:
+        return None
+    chunks = []
+    size = 0
+    while size <= limit:
+        chunk = request.stream.read(limit + 1 - size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    if size > limit:
+        return None
+    return b''.join(chunks)
+
+
+# method for the JSON value of a body, None when it is not JSON
+def parse_json(body):
+    if not request.is_json:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+'''
+json_body(validator)
+    decorator validating the JSON request body of a view before it runs,
+    the view gets the values as first argument. Bodies over the size
+    limit, with or without a Content-Length, are aborted with 413,
+    malformed ones with the status of the schema.
+'''
+
+
+def json_body(validator):
+    def decorator(view):
+        @wraps(view)
+        def validated_view(*args, **kwargs):
+            body = read_body(validator.max_bytes)
+            if body is None:
+                abort(413)
+            values, error = validator(parse_json(body))
+            if error is not None:
+                abort(validator.status)
+            return view(values, *args, **kwargs)
+        return validated_view
+    return decorator
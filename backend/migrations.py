@@ -0,0 +1,224 @@
+# third-party imports
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+                        func, inspect, select, text)
+
+'''
+Schema migrations
+
+    ordered, idempotent upgrade steps of the database schema. The applied
+    versions are recorded in the schema_migrations table, so each step
+    runs once per database, and every step checks the current schema so
+    it is safe on a database created by db.create_all() or restored from
+    trivia.psql. Run them with `flask migrate`.
+'''
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False,
+           server_default=func.current_timestamp()))
+
+
+# method for checking if a column of a table has an integer type
+def column_is_integer(connection, table, column):
+    for info in inspect(connection).get_columns(table):
+        if info['name'] == column:
+            return isinstance(info['type'], Integer)
+    return False
+
+
+# method for checking if a column of a table references another table
+def has_foreign_key(connection, table, column, referred_table):
+    for info in inspect(connection).get_foreign_keys(table):
+        if (info['referred_table'] == referred_table
+                and info['constrained_columns'] == [column]):
+            return True
+    return False
+
+
+'''
+0001 category integer foreign key
+    converts questions.category from a string to an integer referencing
+    categories.id. Values that are not the id of a category become NULL.
+'''
+
+
+def category_integer_foreign_key(connection):
+    if connection.dialect.name == 'postgresql':
+        if not column_is_integer(connection, 'questions', 'category'):
+            connection.execute(text(
+                "ALTER TABLE questions ALTER COLUMN category TYPE integer "
+                "USING CASE WHEN category ~ '^\\s*[0-9]+\\s*$' "
+                "THEN trim(category)::integer END"))
+        connection.execute(text(
+            "UPDATE questions SET category = NULL "
+            "WHERE category NOT IN (SELECT id FROM categories)"))
+        if not has_foreign_key(connection, 'questions', 'category',
+                               'categories'):
+            connection.execute(text(
+                "ALTER TABLE questions ADD CONSTRAINT "
+                "questions_category_fkey FOREIGN KEY (category) "
+                "REFERENCES categories (id) "
+                "ON UPDATE CASCADE ON DELETE SET NULL"))
+        return
+
+    # sqlite can not change the type of a column, rebuild the table
+    if column_is_integer(connection, 'questions', 'category'):
+        return
+    connection.execute(text(
+        "CREATE TABLE questions_migrated ("
+        "id INTEGER NOT NULL PRIMARY KEY, "
+        "question VARCHAR, answer VARCHAR, "
+        "category INTEGER REFERENCES categories (id) "
+        "ON UPDATE CASCADE ON DELETE SET NULL, "
+        "difficulty INTEGER, rating INTEGER)"))
+    connection.execute(text(
+        "INSERT INTO questions_migrated "
+        "(id, question, answer, category, difficulty, rating) "
+        "SELECT id, question, answer, "
+        "CASE WHEN CAST(category AS INTEGER) IN (SELECT id FROM categories) "
+        "THEN CAST(category AS INTEGER) END, difficulty, rating "
+        "FROM questions"))
+    connection.execute(text("DROP TABLE questions"))
+    connection.execute(text(
+        "ALTER TABLE questions_migrated RENAME TO questions"))
+
+
+'''
+0002 category and difficulty indexes
+    serves the category listings and quiz picks, which filter on
+    category and order by id, and the difficulty filters
+'''
+
+
+def category_and_difficulty_indexes(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_id "
+        "ON questions (category, id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_difficulty "
+        "ON questions (difficulty)"))
+
+
+'''
+0003 question full-text index
+    GIN index of the postgres search backend
+'''
+
+
+def question_full_text_index(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_question_fts "
+        "ON questions USING gin (to_tsvector('english', question))"))
+
+
+'''
+refresh_category_stats(connection)
+    recomputes the category statistics from the questions, when they
+    are created and after the questions were changed outside of the app
+'''
+
+
+def refresh_category_stats(connection):
+    if connection.dialect.name == 'postgresql':
+        # writers wait until the statistics match the questions again
+        connection.execute(text("LOCK TABLE questions IN SHARE MODE"))
+    connection.execute(text("DELETE FROM category_stats"))
+    connection.execute(text(
+        "INSERT INTO category_stats "
+        "(category, difficulty, questions, rating_sum, rated) "
+        "SELECT COALESCE(category, 0), COALESCE(difficulty, 0), COUNT(*), "
+        "COALESCE(SUM(rating), 0), COUNT(rating) FROM questions "
+        "GROUP BY COALESCE(category, 0), COALESCE(difficulty, 0)"))
+
+
+'''
+0004 category statistics
+    aggregate table of GET /stats, updated by every write of the
+    questions, filled from the current questions
+'''
+
+
+def category_statistics(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS category_stats ("
+        "category INTEGER NOT NULL, difficulty INTEGER NOT NULL, "
+        "questions INTEGER NOT NULL, rating_sum BIGINT NOT NULL, "
+        "rated INTEGER NOT NULL, PRIMARY KEY (category, difficulty))"))
+    refresh_category_stats(connection)
+
+
+'''
+0005 change versions
+    version of each table bumped by every write, read by the workers to
+    reload what they keep in memory after the writes of the others
+'''
+
+
+def change_versions(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS change_versions ("
+        "name VARCHAR(64) NOT NULL PRIMARY KEY, version BIGINT NOT NULL)"))
+
+
+'''
+0006 rating changes
+    ratings written by each version of the question ratings, applied in
+    place by the other workers
+'''
+
+
+def rating_changes(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS rating_changes ("
+        "version BIGINT NOT NULL, question_id INTEGER NOT NULL, "
+        "rating INTEGER, PRIMARY KEY (version, question_id))"))
+
+
+MIGRATIONS = (
+    (1, 'category integer foreign key', category_integer_foreign_key),
+    (2, 'category and difficulty indexes', category_and_difficulty_indexes),
+    (3, 'question full-text index', question_full_text_index),
+    (4, 'category statistics', category_statistics),
+    (5, 'change versions', change_versions),
+    (6, 'rating changes', rating_changes),
+)
+
+
+'''
+applied_versions(engine)
+    returns the set of versions already applied to the database
+'''
+
+
+def applied_versions(engine):
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        return {version for (version,) in connection.execute(
+            select([schema_migrations.c.version]))}
+
+
+'''
+upgrade(engine)
+    applies the pending migrations in order, each one in its own
+    transaction, and returns the (version, name) of the applied ones
+'''
+
+
+def upgrade(engine):
+    applied = applied_versions(engine)
+    upgraded = []
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=version, name=name))
+        upgraded.append((version, name))
+    return upgraded
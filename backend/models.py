@@ -1,13 +1,157 @@
 # third-party imports
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (BigInteger, Column, String, Integer, ForeignKey,
+                        Index, DDL, event, func, inspect, select, text)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from flask import current_app
+from flask_sqlalchemy import BaseQuery, SignallingSession, SQLAlchemy
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from weakref import WeakKeyDictionary
+import json
+import os
+import time
 
 
-db = SQLAlchemy()
+'''
+phase_timers
+    context manager factories of the request instrumentation by phase:
+    'load' times the loading of query results and 'serialize' the
+    formatting of rows, phases without a timer are not measured
+'''
+phase_timers = {}
+
+
+# method for timing a serialisation function with the 'serialize' timer
+def timed_serializer(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        timer = phase_timers.get('serialize')
+        if timer is None:
+            return function(*args, **kwargs)
+        with timer():
+            return function(*args, **kwargs)
+    return wrapper
+
+
+class TimedQuery(BaseQuery):
+    """Query whose result loading is measured by the 'load' timer"""
+
+    def __iter__(self):
+        timer = phase_timers.get('load')
+        # streamed results are not materialised to be measured
+        if timer is None or self._yield_per:
+            return super(TimedQuery, self).__iter__()
+        with timer():
+            return iter(list(super(TimedQuery, self).__iter__()))
+
+
+'''
+PoolStatistics
+    counters of a connection pool, kept per worker process
+'''
+
+
+class PoolStatistics(object):
+
+    def __init__(self, pool):
+        self.lock = Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        event.listen(pool, 'connect', self.on_connect)
+        event.listen(pool, 'checkout', self.on_checkout)
+        event.listen(pool, 'checkin', self.on_checkin)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record,
+                    connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out,
+                                        self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checked_out = max(0, self.checked_out - 1)
+
+
+pool_statistics = WeakKeyDictionary()
+
+
+'''
+RoutingSession
+    session reading from the replica engine put in its info by the
+    request, if any. Flushes, DML statements and every statement after
+    the first flush go to the primary.
+'''
+
+
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing and \
+                not isinstance(clause, UpdateBase):
+            return replica
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class TriviaSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy service recording the statistics of its connection pools,
+    with sessions routing reads to the read replicas
+    """
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(TriviaSQLAlchemy, self).create_engine(
+            sa_url, engine_opts)
+        pool_statistics[engine.pool] = PoolStatistics(engine.pool)
+        return engine
+
+    def create_replica_engines(self, app):
+        """Returns the engines of SQLALCHEMY_REPLICA_URIS"""
+        return [self.create_engine(make_url(uri), dict(
+                    app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}))
+                for uri in app.config.get('SQLALCHEMY_REPLICA_URIS') or ()]
+
+
+db = TriviaSQLAlchemy(query_class=TimedQuery)
+
+
+'''
+primary_reads()
+    routes the reads of the block to the primary, for the state kept by
+    a worker until its next local write, which a lagging replica would
+    leave stale
+'''
+
+
+@contextmanager
+def primary_reads():
+    replica = db.session.info.pop('replica', None)
+    try:
+        yield
+    finally:
+        if replica is not None:
+            db.session.info['replica'] = replica
+
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. The engine is
+    created and connected on the first query, tables are only created
+    here with DB_CREATE_ALL, otherwise by `flask create-db`.
 '''
 
 
@@ -15,8 +159,397 @@ def setup_db(app):
     db.app = app
     # initializing application extentions
     db.init_app(app)
-    # create all tables in the database
-    db.create_all()
+    if app.config.get('DB_CREATE_ALL'):
+        db.create_all()
+    # process-wide cache of the categories, dropped when they change
+    if 'category_cache' not in app.extensions:
+        cache = CategoryCache(ttl=app.config.get('CATEGORY_CACHE_TTL', 300))
+        app.extensions['category_cache'] = cache
+        listen_for_changes(
+            app, Category.__tablename__,
+            lambda operation, record: cache.invalidate())
+    # versions of the tables, tell the writes of the other workers
+    if 'change_watcher' not in app.extensions:
+        app.extensions['change_watcher'] = ChangeWatcher(
+            app, interval=app.config.get('CHANGE_SYNC_INTERVAL', 1.0))
+
+
+class SchemaError(RuntimeError):
+    """The database misses tables of the models, migrations are pending"""
+
+
+'''
+check_tables(app)
+    raises SchemaError naming the tables of the models missing from the
+    primary database, on which the writes of the questions would fail
+'''
+
+
+def check_tables(app):
+    missing = sorted(set(db.metadata.tables) -
+                     set(db.get_engine(app).table_names()))
+    if missing:
+        raise SchemaError(
+            'the database has no {} table{}: run `flask migrate`, or '
+            '`flask create-db` on an empty database'.format(
+                ', '.join(missing), 's' if len(missing) > 1 else ''))
+
+
+'''
+listen_for_changes(app, tablename, callback)
+    registers `callback(operation, record)` to be called after each commit
+    that inserted, updated or deleted a row of `tablename`.
+    `operation` is 'insert', 'update' or 'delete' and `record` is the
+    formatted row as it was flushed. Bulk writes report 'reload' with no
+    record, listeners then rebuild whatever they derived from the table.
+    The ratings of the questions are reported on their own under
+    QUESTION_RATINGS: 'update' with the {id, rating} of a question, or
+    'reload' when only the ratings have to be read again.
+'''
+
+
+def listen_for_changes(app, tablename, callback):
+    listeners = app.extensions.setdefault('change_listeners', {})
+    listeners.setdefault(tablename, []).append(callback)
+
+
+'''
+notify_changes(tablename, operation, record)
+    calls the listeners of `tablename` of the current application,
+    writes that bypass the ORM unit of work report themselves through it
+'''
+
+
+def notify_changes(tablename, operation, record):
+    call_listeners(db.get_app(), tablename, operation, record)
+
+
+# method for calling the change listeners of `tablename` of `app`
+def call_listeners(app, tablename, operation, record):
+    listeners = app.extensions.get('change_listeners', {})
+    for callback in listeners.get(tablename, ()):
+        callback(operation, record)
+
+
+'''
+listen_for_commits(app, callback)
+    registers `callback(tablenames)` to be called once per commit, after
+    the listeners of its rows, with the set of the changed tables, for
+    listeners that drop what they keep rather than apply each row
+'''
+
+
+def listen_for_commits(app, callback):
+    app.extensions.setdefault('commit_listeners', []).append(callback)
+
+
+'''
+notify_commit(tablenames)
+    calls the commit listeners of the current application, writes that
+    bypass the ORM unit of work report their commit through it
+'''
+
+
+def notify_commit(tablenames):
+    call_commit_listeners(db.get_app(), tablenames)
+
+
+# method for calling the commit listeners of `app`
+def call_commit_listeners(app, tablenames):
+    for callback in app.extensions.get('commit_listeners', ()):
+        callback(tablenames)
+
+
+# collects the rows changed by a flush until the transaction ends
+@event.listens_for(db.session, 'after_flush')
+def collect_changes(session, flush_context):
+    changes = session.info.setdefault('changes', [])
+    for operation, instances in (('insert', session.new),
+                                 ('update', session.dirty),
+                                 ('delete', session.deleted)):
+        for instance in instances:
+            if operation == 'update' and not session.is_modified(instance):
+                continue
+            if hasattr(instance, 'format'):
+                changes.append((instance.__tablename__, operation,
+                                instance.format()))
+
+
+# reads after a write see it, they stay on the primary
+@event.listens_for(db.session, 'after_flush')
+def stick_to_primary(session, flush_context):
+    session.info.pop('replica', None)
+
+
+# notifies the listeners once the changes are committed
+@event.listens_for(db.session, 'after_commit')
+def dispatch_changes(session):
+    changes = session.info.pop('changes', [])
+    versions = session.info.pop('versions', None)
+    # the writes of the other workers committed before this one first
+    if versions:
+        watcher = db.get_app().extensions.get('change_watcher')
+        if watcher is not None:
+            watcher.committed(versions)
+    for tablename, operation, record in changes:
+        notify_changes(tablename, operation, record)
+    if changes:
+        notify_commit({tablename for tablename, _, _ in changes})
+
+
+# forgets the changes of a rolled back transaction
+@event.listens_for(db.session, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('changes', None)
+    session.info.pop('versions', None)
+
+
+'''
+ChangeVersion
+    number of committed transactions that changed the rows of a table.
+    Every write bumps it in its own transaction, so that a worker can
+    tell when other workers changed the rows it keeps in memory.
+'''
+
+
+class ChangeVersion(db.Model):
+    __tablename__ = 'change_versions'
+
+    name = Column(String(64), primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+# bumps the version of a table on both sqlite and postgres, a table
+# without a version yet starts at 1
+UPSERT_CHANGE_VERSION = text(
+    "INSERT INTO change_versions (name, version) VALUES (:name, 1) "
+    "ON CONFLICT (name) DO UPDATE SET "
+    "version = change_versions.version + 1")
+
+
+# version name of the ratings of the questions, written apart from
+# their texts, categories and difficulties
+QUESTION_RATINGS = 'question_ratings'
+
+# rating versions kept in rating_changes, a worker further behind reads
+# the ratings again
+RATING_CHANGES_KEPT = 1000
+
+
+'''
+RatingChange
+    new ratings written by a version of QUESTION_RATINGS, so that the
+    other workers apply them in place rather than reloading the questions
+'''
+
+
+class RatingChange(db.Model):
+    __tablename__ = 'rating_changes'
+
+    version = Column(BigInteger, primary_key=True, autoincrement=False)
+    question_id = Column(Integer, primary_key=True, autoincrement=False)
+    rating = Column(Integer)
+
+
+'''
+bump_version(session, tablename)
+    bumps the version of `tablename` once per transaction of `session`
+    and keeps the new version until the commit, writes that bypass the
+    unit of work call it themselves. Returns the new version.
+'''
+
+
+def bump_version(session, tablename):
+    versions = session.info.setdefault('versions', {})
+    if tablename in versions:
+        return versions[tablename]
+    connection = session.connection()
+    connection.execute(UPSERT_CHANGE_VERSION, name=tablename)
+    table = ChangeVersion.__table__
+    versions[tablename] = connection.execute(select(
+        [table.c.version]).where(table.c.name == tablename)).scalar()
+    return versions[tablename]
+
+
+'''
+log_rating_changes(session, version, ratings)
+    records the {id: rating} written by a version of QUESTION_RATINGS and
+    forgets the versions older than RATING_CHANGES_KEPT
+'''
+
+
+def log_rating_changes(session, version, ratings):
+    table = RatingChange.__table__
+    connection = session.connection()
+    connection.execute(table.insert(), [
+        {'version': version, 'question_id': question_id, 'rating': rating}
+        for question_id, rating in sorted(ratings.items())])
+    connection.execute(table.delete().where(
+        table.c.version <= version - RATING_CHANGES_KEPT))
+
+
+# bumps the versions of the tables whose rows are being flushed
+@event.listens_for(db.session, 'before_flush')
+def bump_change_versions(session, flush_context, instances):
+    tablenames = set()
+    for instances, modified_only in ((session.new, False),
+                                     (session.deleted, False),
+                                     (session.dirty, True)):
+        for instance in instances:
+            if not hasattr(instance, 'format'):
+                continue
+            if modified_only and not session.is_modified(instance):
+                continue
+            tablenames.add(instance.__tablename__)
+    for tablename in sorted(tablenames):
+        bump_version(session, tablename)
+
+
+'''
+ChangeWatcher
+    versions of the tables last seen by a worker. The worker's own
+    commits move them on, its listeners already applied the changes.
+    sync() reads the versions at most every `interval` seconds and
+    sends 'reload' to the listeners of the tables other workers
+    changed, so the state kept in memory follows their writes too. The
+    ratings they wrote are sent as 'update' of QUESTION_RATINGS, read
+    from rating_changes.
+'''
+
+
+class ChangeWatcher(object):
+
+    def __init__(self, app, interval=1.0):
+        self.app = app
+        self.interval = interval
+        self.lock = Lock()
+        # held while sending changes, so that they arrive in order
+        self.sending = Lock()
+        # tablename -> version, 0 for the tables never written
+        self.versions = {}
+        self.checked_at = float('-inf')
+
+    def read(self):
+        """Returns the committed versions, from the primary"""
+        table = ChangeVersion.__table__
+        with db.get_engine(self.app).connect() as connection:
+            return dict(connection.execute(select(
+                [table.c.name, table.c.version])).fetchall())
+
+    def due(self):
+        return time.monotonic() - self.checked_at >= self.interval
+
+    def sync(self, force=False):
+        """
+        Reloads the listeners of the tables changed elsewhere, reading
+        the versions at most every `interval` seconds unless `force`
+        """
+        if not force and not self.due():
+            return
+        checked_at = time.monotonic()
+        versions = self.read()
+        with self.sending:
+            changed = []
+            with self.lock:
+                # the changes before the first read are unknown
+                first = self.checked_at == float('-inf')
+                self.checked_at = checked_at
+                for tablename, version in versions.items():
+                    # versions only grow, a read older than a local
+                    # commit is not a change
+                    known = self.versions.get(tablename, 0)
+                    if version > known:
+                        self.versions[tablename] = version
+                        changed.append((tablename, None if first
+                                        else known, version))
+            for tablename, known, version in changed:
+                self.send(tablename, known, version)
+
+    def committed(self, versions):
+        """
+        Records the versions of a local commit, the tables whose version
+        skipped one were also changed by another worker
+        """
+        with self.sending:
+            changed = []
+            with self.lock:
+                first = self.checked_at == float('-inf')
+                for tablename, version in versions.items():
+                    known = self.versions.get(tablename, 0)
+                    if version > known + 1:
+                        changed.append((tablename, None if first
+                                        else known, version - 1))
+                    self.versions[tablename] = max(known, version)
+            for tablename, known, version in changed:
+                self.send(tablename, known, version)
+
+    def send(self, tablename, known, version):
+        """Sends the changes of the versions after `known` up to
+        `version` of a table to its listeners, `known` is None before
+        the first read"""
+        ratings = None
+        if tablename == QUESTION_RATINGS:
+            ratings = self.read_ratings(known, version)
+        if ratings is None:
+            call_listeners(self.app, tablename, 'reload', None)
+        else:
+            for question_id, rating in sorted(ratings.items()):
+                call_listeners(self.app, tablename, 'update',
+                               {'id': question_id, 'rating': rating})
+        call_commit_listeners(self.app, {tablename})
+
+    def read_ratings(self, known, version):
+        """
+        Returns the {id: rating} written by the rating versions after
+        `known` up to `version`, None when they are no longer all logged
+        """
+        if known is None or version - known > RATING_CHANGES_KEPT:
+            return None
+        table = RatingChange.__table__
+        with db.get_engine(self.app).connect() as connection:
+            rows = connection.execute(select(
+                [table.c.version, table.c.question_id, table.c.rating]).where(
+                    (table.c.version > known) & (table.c.version <= version))
+                .order_by(table.c.version)).fetchall()
+        if len({row[0] for row in rows}) != version - known:
+            return None
+        # the last rating of a question wins
+        return {question_id: rating for _, question_id, rating in rows}
+
+
+'''
+pool_status(engine)
+    current state and counters of the connection pool of an engine
+'''
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pid': os.getpid(), 'pool': type(pool).__name__}
+    # queue pools report their size, other pools have no such limits
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        method = getattr(pool, name, None)
+        if method is not None:
+            status[name] = method()
+    if hasattr(pool, '_max_overflow'):
+        status['max_overflow'] = pool._max_overflow
+    statistics = pool_statistics.get(pool)
+    if statistics is not None:
+        status['connects'] = statistics.connects
+        status['checkouts'] = statistics.checkouts
+        status['peak_checked_out'] = statistics.peak_checked_out
+    return status
+
+
+'''
+count_questions(selection)
+    counts the questions of a query with a COUNT query
+'''
+
+
+def count_questions(selection):
+    return selection.order_by(None).with_entities(
+        func.count(Question.id)).scalar()
 
 
 '''
@@ -27,11 +560,17 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        # category listings and quiz picks filter on category, order by id
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
     rating = Column(Integer)
 
@@ -53,6 +592,7 @@ class Question(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    @timed_serializer
     def format(self):
         return {
             'id': self.id,
@@ -64,6 +604,104 @@ class Question(db.Model):
         }
 
 
+# full-text index of the question text used by the postgres search backend
+event.listen(
+    Question.__table__, 'after_create',
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_question_fts "
+        "ON questions USING gin (to_tsvector('english', question))"
+        ).execute_if(dialect='postgresql'))
+
+
+'''
+CategoryStats
+    number of questions, sum of their ratings and number of rated
+    questions per category and difficulty, 0 standing for none. Every
+    write of the questions updates it in its own transaction, so the
+    statistics are read without scanning the questions.
+'''
+
+
+class CategoryStats(db.Model):
+    __tablename__ = 'category_stats'
+
+    category = Column(Integer, primary_key=True, autoincrement=False)
+    difficulty = Column(Integer, primary_key=True, autoincrement=False)
+    questions = Column(Integer, nullable=False, default=0)
+    rating_sum = Column(BigInteger, nullable=False, default=0)
+    rated = Column(Integer, nullable=False, default=0)
+
+
+# adds the statistics changed by the questions upserted on both sqlite
+# and postgres, counters of a new category and difficulty start at 0
+UPSERT_CATEGORY_STATS = text(
+    "INSERT INTO category_stats "
+    "(category, difficulty, questions, rating_sum, rated) "
+    "VALUES (:category, :difficulty, :questions, :rating_sum, :rated) "
+    "ON CONFLICT (category, difficulty) DO UPDATE SET "
+    "questions = category_stats.questions + excluded.questions, "
+    "rating_sum = category_stats.rating_sum + excluded.rating_sum, "
+    "rated = category_stats.rated + excluded.rated")
+
+
+# method for adding a question to statistics deltas, -1 removes it
+def count_question(deltas, category, difficulty, rating, sign=1):
+    delta = deltas.setdefault((category or 0, difficulty or 0), [0, 0, 0])
+    delta[0] += sign
+    if rating is not None:
+        delta[1] += sign * rating
+        delta[2] += sign
+
+
+'''
+apply_category_stats(connection, deltas)
+    adds {(category, difficulty): [questions, rating_sum, rated]} deltas
+    to the category statistics, in key order so that concurrent writers
+    lock the rows in the same order
+'''
+
+
+def apply_category_stats(connection, deltas):
+    parameters = [
+        {'category': category, 'difficulty': difficulty,
+         'questions': questions, 'rating_sum': rating_sum, 'rated': rated}
+        for (category, difficulty), (questions, rating_sum, rated)
+        in sorted(deltas.items()) if questions or rating_sum or rated]
+    if parameters:
+        connection.execute(UPSERT_CATEGORY_STATS, parameters)
+
+
+# method for the (category, difficulty, rating) a question had when loaded
+def committed_stats(question):
+    attributes = inspect(question).attrs
+    values = []
+    for name in ('category', 'difficulty', 'rating'):
+        history = attributes[name].history
+        loaded = history.deleted or history.unchanged
+        values.append(loaded[0] if loaded else getattr(question, name))
+    return tuple(values)
+
+
+# updates the category statistics with the questions being flushed
+@event.listens_for(db.session, 'before_flush')
+def update_category_stats(session, flush_context, instances):
+    deltas = {}
+    for question in session.new:
+        if isinstance(question, Question):
+            count_question(deltas, question.category, question.difficulty,
+                           question.rating)
+    for question in session.deleted:
+        if isinstance(question, Question):
+            count_question(deltas, *committed_stats(question), sign=-1)
+    for question in session.dirty:
+        if isinstance(question, Question) and session.is_modified(question):
+            before = committed_stats(question)
+            after = (question.category, question.difficulty, question.rating)
+            if before != after:
+                count_question(deltas, *before, sign=-1)
+                count_question(deltas, *after)
+    apply_category_stats(session.connection(), deltas)
+
+
 '''
 Category
 
@@ -79,8 +717,83 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    @timed_serializer
     def format(self):
         return {
             'id': self.id,
             'type': self.type
         }
+
+
+'''
+CategoryCache
+    id -> type map of the categories kept in memory for `ttl` seconds,
+    along with its pre-serialised JSON
+'''
+
+
+class CategoryCache(object):
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        # (categories, fragment, expires_at), replaced as a whole
+        self.entry = None
+
+    def invalidate(self):
+        self.entry = None
+
+    def load(self):
+        with primary_reads():
+            categories = Category.query.order_by(Category.id).all()
+        current_categories = {}
+        for category in categories:
+            current_categories[category.id] = category.type
+        fragment = json.dumps(current_categories, sort_keys=True,
+                              separators=(',', ':'))
+        self.entry = (current_categories, fragment,
+                      time.monotonic() + self.ttl)
+        return self.entry
+
+    def current(self):
+        entry = self.entry
+        if entry is None or time.monotonic() >= entry[2]:
+            entry = self.load()
+        return entry
+
+    def get(self):
+        return self.current()[0]
+
+    def json(self):
+        return self.current()[1]
+
+
+'''
+get_categories()
+    returns the cached id -> type map of the categories
+    of the current application
+'''
+
+
+def get_categories():
+    return current_app.extensions['category_cache'].get()
+
+
+'''
+get_categories_json()
+    returns the pre-serialised JSON of the cached categories
+'''
+
+
+def get_categories_json():
+    return current_app.extensions['category_cache'].json()
+
+
+'''
+invalidate_categories()
+    drops the cached categories of the current application, e.g. after
+    changing the categories table outside of the ORM
+'''
+
+
+def invalidate_categories():
+    current_app.extensions['category_cache'].invalidate()
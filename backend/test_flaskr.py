@@ -1,11 +1,63 @@
 # third-party imports
+import asyncio
+import io
+import os
+import tempfile
+import threading
 import unittest
 import json
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from werkzeug.exceptions import default_exceptions
 
 # local imports
-from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import bulk, create_app
+from flaskr.asgi import create_asgi_app, ERROR_MESSAGES
+from flaskr.caching import FileSystemCacheBackend, ResponseCache
+from flaskr.ratings import RatingLog
+from flaskr.suggest import SuggestionIndex
+from flaskr.validation import (compile_schemas, Field, Schema, Validator,
+                               REQUEST_SCHEMAS)
+from models import setup_db, db, Question, Category, SchemaError
+
+
+# method for sending a request to an ASGI application on the running loop
+async def asgi_call(application, method, path, body=None, headers=()):
+    messages = []
+    content = json.dumps(body).encode('utf-8') if body is not None else b''
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': b'', 'client': ('127.0.0.1', 5000),
+             'headers': [(b'content-type', b'application/json'),
+                         (b'content-length', str(len(content)).encode())
+                         ] + list(headers)}
+
+    async def receive():
+        return {'type': 'http.request', 'body': content}
+
+    async def send(message):
+        messages.append(message)
+
+    await application(scope, receive, send)
+    body = b''.join(message.get('body', b'') for message in messages)
+    return messages[0]['status'], json.loads(body)
+
+
+# method for sending a request to an ASGI application on a new loop
+def asgi_request(application, method, path, body=None, headers=()):
+    return asyncio.run(asgi_call(application, method, path, body, headers))
+
+
+# method for the (id, event, data) of a Server-Sent Events body
+def parse_events(body):
+    events = []
+    for message in body.decode('utf-8').split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in message.splitlines()
+                      if not line.startswith(':'))
+        if fields:
+            events.append((int(fields['id']), fields['event'],
+                           json.loads(fields['data'])))
+    return events
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -28,9 +80,8 @@ class TriviaTestCase(unittest.TestCase):
 
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
+            self.db = db
+            # create the missing tables, the app no longer does on start
             self.db.create_all()
 
     def tearDown(self):
@@ -54,6 +105,133 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(len(data['categories']), 6)
         self.assertTrue(data['total_categories'])
 
+    def test_retrieve_categories_after_category_change(self):
+        """Tests categories cache invalidation on insert and delete"""
+
+        # fill the categories cache
+        res = self.client().get('/categories')
+        self.assertEqual(json.loads(res.data)['total_categories'], 6)
+
+        # add a category, the cache is dropped on commit
+        category = Category(type='Music')
+        db.session.add(category)
+        db.session.commit()
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(data['total_categories'], 7)
+        self.assertEqual(data['categories'][str(category.id)], 'Music')
+
+        # remove the category again
+        db.session.delete(category)
+        db.session.commit()
+        res = self.client().get('/categories')
+        self.assertEqual(json.loads(res.data)['total_categories'], 6)
+
+    def test_retrieve_questions_not_modified(self):
+        """Tests conditional GET with ETag and cache invalidation"""
+
+        # get response and its validator
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('max-age', res.headers['Cache-Control'])
+
+        # check that an unchanged page is not sent again
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        # check that a write changes the validator of the page
+        res = self.client().post('/questions', json=self.new_question)
+        created = json.loads(res.data)['created']
+        res = self.client().get('/questions?page=100',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.client().delete('/questions/{}'.format(created))
+
+    def test_response_cache_invalidation(self):
+        """Tests responses read before a write are not cached"""
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+
+        # a write committed while a view runs, the response is not kept
+        cache = ResponseCache(FileSystemCacheBackend(
+            os.path.join(cache_dir.name, 'view')))
+        bodies = iter(['before', 'after'])
+
+        def view():
+            body = next(bodies)
+            if body == 'before':
+                cache.invalidate()
+            return body
+
+        view = cache.cached(view)
+        with self.app.test_request_context('/questions'):
+            self.assertEqual(view().get_data(True), 'before')
+            self.assertEqual(view().get_data(True), 'after')
+            self.assertEqual(view().get_data(True), 'after')
+
+        # workers sharing the directory see each other's writes
+        settings = {'HTTP_CACHE_BACKEND': 'filesystem',
+                    'HTTP_CACHE_DIR': os.path.join(cache_dir.name, 'app')}
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings).test_client()
+        total = json.loads(first.get('/questions').data)['total_questions']
+        res = second.post('/questions', json=self.new_question)
+        created = json.loads(res.data)['created']
+        res = first.get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], total + 1)
+        second.delete('/questions/{}'.format(created))
+
+    def test_response_cache_cleared_once_per_commit(self):
+        """Tests a commit clears the cache once, in every worker"""
+        settings = {'HTTP_CACHE_BACKEND': 'memory', 'CHANGE_SYNC_INTERVAL': 0}
+        first = create_app('testing', settings)
+        second = create_app('testing', settings).test_client()
+        backend = first.extensions['response_cache'].backend
+        clear = backend.clear
+        clears = []
+
+        def counted_clear():
+            clears.append(None)
+            clear()
+
+        backend.clear = counted_clear
+        # the versions are read once before
+        first.test_client().get('/questions')
+        clears.clear()
+        ratings = [{'id': question.id, 'rating': question.rating}
+                   for question in Question.query.filter(
+                       Question.category == 4)]
+        first.test_client().patch('/questions', json={'ratings': ratings})
+        self.assertEqual(len(clears), 1)
+
+        # the memory cache of a worker follows the writes of the others
+        total = json.loads(first.test_client().get('/questions').data)[
+            'total_questions']
+        created = json.loads(second.post(
+            '/questions', json=self.new_question).data)['created']
+        self.addCleanup(second.delete, '/questions/{}'.format(created))
+        res = first.test_client().get('/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'], total + 1)
+
+    def test_response_cache_directory_private(self):
+        """Tests the filesystem cache refuses a directory of others"""
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        directory = os.path.join(cache_dir.name, 'cache')
+        FileSystemCacheBackend(directory)
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        os.chmod(directory, 0o777)
+        with self.assertRaisesRegex(ValueError, 'without access for other'):
+            FileSystemCacheBackend(directory)
+        with self.assertRaisesRegex(ValueError, 'HTTP_CACHE_DIR'):
+            create_app('testing', {'HTTP_CACHE_BACKEND': 'filesystem'})
+
     def test_405_if_no_categories_found(self):
         """Tests categories retrieve Failure 405"""
 
@@ -94,6 +272,24 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource Not Found')
 
+    def test_retrieve_questions_after_id(self):
+        """Tests questions keyset pagination success"""
+
+        # get response and load data
+        res = self.client().get('/questions?after_id=10')
+        data = json.loads(res.data)
+
+        # check status code and message
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        # check that only questions after the cursor are returned in order
+        ids = [question['id'] for question in data['questions']]
+        self.assertTrue(len(ids))
+        self.assertTrue(all(question_id > 10 for question_id in ids))
+        self.assertEqual(ids, sorted(ids))
+        self.assertTrue(data['total_questions'])
+
     def test_delete_question(self):
         """Tests question deletion success"""
 
@@ -108,6 +304,8 @@ class TriviaTestCase(unittest.TestCase):
         # check status code and message
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
+        self.assertEqual(data['deleted'], question_id)
+        self.assertTrue(data['total_questions'])
 
         # check if deleted question is not available after delete
         self.assertEqual(question, None)
@@ -140,12 +338,27 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertTrue(data['created'])
-        self.assertTrue(len(data['questions']))
         self.assertTrue(data['total_questions'])
 
+        # check that no page of questions is returned by default
+        self.assertNotIn('questions', data)
+
         # check if created question is available after create
         self.assertNotEqual(question_created, None)
 
+    def test_create_question_with_page(self):
+        """Tests questions creation returning a page of questions"""
+
+        res = self.client().post('/questions?page=1', json=self.new_question)
+        data = json.loads(res.data)
+
+        # check status code and the requested page of questions
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['created'])
+        self.assertEqual(len(data['questions']), 10)
+        self.assertTrue(data['total_questions'])
+
     def test_405_if_question_creation_not_allowed(self):
         """Tests questions creation failure 405"""
 
@@ -170,6 +383,141 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertTrue(data['message'], 'Unprocessable Entity')
 
+    def test_import_questions_in_bulk(self):
+        """Tests bulk import of NDJSON questions with per-row errors"""
+
+        lines = [
+            json.dumps({'question': 'Which planet is the largest?',
+                        'answer': 'Jupiter', 'category': 1,
+                        'difficulty': 2, 'rating': 3}),
+            json.dumps({'question': 'Which gas do plants absorb?',
+                        'answer': 'Carbon dioxide', 'category': 1}),
+            json.dumps({'question': '', 'answer': 'Nothing'}),
+            '{not json',
+        ]
+        res = self.client().post('/questions/bulk',
+                                 data='\n'.join(lines),
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        # check status code and the report of the import
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['rejected'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [3, 4])
+
+    def test_import_questions_in_bulk_csv(self):
+        """Tests bulk import of CSV questions"""
+
+        body = ('question,answer,category,difficulty,rating\n'
+                'What is the chemical symbol of gold?,Au,1,2,4\n'
+                'What is the boiling point of water?,100,1,oops,4\n')
+        res = self.client().post('/questions/bulk?format=csv', data=body,
+                                 content_type='text/csv')
+        data = json.loads(res.data)
+
+        # check that the row with an invalid difficulty is rejected
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+
+    def test_import_questions_in_bulk_refused_rows(self):
+        """Tests bulk rows follow the rules of POST /questions and rows
+        refused by the database are reported one by one"""
+        insert_batch = bulk.insert_batch
+
+        # the database refuses the row answered 'Refused'
+        def refusing_insert_batch(batch):
+            if any(mapping['answer'] == 'Refused' for mapping in batch):
+                raise OverflowError('Python int too large')
+            insert_batch(batch)
+
+        bulk.insert_batch = refusing_insert_batch
+        self.addCleanup(setattr, bulk, 'insert_batch', insert_batch)
+        question = {'question': 'Which zephyrine wind is this?',
+                    'category': 1}
+        lines = [
+            dict(question, answer='Kept'),
+            dict(question, answer='Big', difficulty=2 ** 40),
+            dict(question, answer='Unrated', rating=9),
+            dict(question, answer='x' * (
+                self.app.config['QUESTION_MAX_LENGTH'] + 1)),
+            dict(question, answer='Refused'),
+            dict(question, answer='Also kept'),
+        ]
+        res = self.client().post(
+            '/questions/bulk', content_type='application/x-ndjson',
+            data='\n'.join(json.dumps(line) for line in lines))
+        data = json.loads(res.data)
+        created = Question.query.filter(
+            Question.question == question['question']).all()
+        for found in created:
+            self.addCleanup(self.client().delete,
+                            '/questions/{}'.format(found.id))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(sorted(found.answer for found in created),
+                         ['Also kept', 'Kept'])
+        self.assertEqual(data['errors'], [
+            {'line': 2, 'message': 'difficulty must be at most 2147483647'},
+            {'line': 3, 'message': 'rating must be at most 5'},
+            {'line': 4, 'message': 'answer is too long'},
+            {'line': 5,
+             'message': 'refused by the database (OverflowError)'},
+        ])
+
+    def test_import_questions_notified_after_failure(self):
+        """Tests committed batches reach the indexes when an import fails"""
+        app = create_app('testing', {'SEARCH_BACKEND': 'memory'})
+        client = app.test_client()
+        search = {'searchTerm': 'zephyrine'}
+        client.post('/questions/search', json=search)
+
+        # the second batch fails after the first one was committed
+        def rows():
+            yield 1, {'question': 'Which zephyrine wind is this?',
+                      'answer': 'Zephyr'}
+            raise RuntimeError('connection reset')
+
+        with app.app_context():
+            with self.assertRaises(RuntimeError):
+                bulk.import_questions(
+                    rows(), app.extensions['request_schemas']['question'],
+                    batch_size=1)
+        data = json.loads(client.post('/questions/search', json=search).data)
+        self.assertEqual(data['total_questions'], 1)
+        client.delete('/questions/{}'.format(data['questions'][0]['id']))
+
+    def test_415_if_bulk_format_not_supported(self):
+        """Tests bulk import failure 415"""
+
+        res = self.client().post('/questions/bulk', data='<questions/>',
+                                 content_type='application/xml')
+        data = json.loads(res.data)
+
+        # check status code and message
+        self.assertEqual(res.status_code, 415)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Unsupported Media Type')
+
+    def test_export_questions_in_bulk(self):
+        """Tests streamed NDJSON export of all questions"""
+
+        res = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in
+                res.get_data(as_text=True).splitlines()]
+        total_questions = json.loads(
+            self.client().get('/questions').data)['total_questions']
+
+        # check status code and that every question is exported
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), total_questions)
+        self.assertEqual(set(rows[0]), {'id', 'question', 'answer',
+                                        'category', 'difficulty', 'rating'})
+
     def test_get_question_search_with_result(self):
         """Tests search questions success_with_result"""
 
@@ -201,6 +549,176 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['total_questions'], 0)
         self.assertEqual(len(data['questions']), 0)
 
+    def test_get_question_search_paginated(self):
+        """Tests search questions pagination and result limit"""
+
+        # get the first page of 2 results
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'country', 'limit': 2})
+        data = json.loads(res.data)
+
+        # check that the page is limited but the total is not
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['questions']), 2)
+        self.assertEqual(data['total_questions'], 3)
+        first_page = [question['id'] for question in data['questions']]
+
+        # get the second page
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'country',
+                                       'limit': 2, 'page': 2})
+        data = json.loads(res.data)
+        self.assertEqual(len(data['questions']), 1)
+        self.assertNotIn(data['questions'][0]['id'], first_page)
+
+    def test_get_question_search_finds_created_question(self):
+        """Tests search questions after creating a question"""
+
+        # create question then search one of its words
+        res = self.client().post('/questions', json=self.new_question)
+        created = json.loads(res.data)['created']
+        res = self.client().post('/questions/search',
+                                 json={'searchTerm': 'silicon',
+                                       'limit': 50})
+        data = json.loads(res.data)
+
+        # check that the created question is found
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(created,
+                      [question['id'] for question in data['questions']])
+
+    def test_question_suggestions(self):
+        """Tests search-as-you-type suggestions follow the writes"""
+
+        # the last word is a prefix, the previous ones are whole words
+        res = self.client().get('/questions/suggest?q=Soccer%20wor')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [6, 7])
+        self.assertEqual(data['questions'][1]['snippet'],
+                         'Which country won the first ever soccer World Cup '
+                         'in 1930?')
+        self.assertEqual(data['categories'], [])
+
+        # categories are suggested by the words of their name
+        res = self.client().get('/questions/suggest?q=s&limit=2')
+        data = json.loads(res.data)
+        self.assertEqual(len(data['questions']), 2)
+        self.assertEqual(data['categories'], [
+            {'id': 1, 'type': 'Science'}, {'id': 6, 'type': 'Sports'}])
+
+        # a created question is suggested until it is deleted
+        question = dict(self.new_question,
+                        question='Which zephyrine wind blows from the west?')
+        res = self.client().post('/questions', json=question)
+        created = json.loads(res.data)['created']
+        res = self.client().get('/questions/suggest?q=zephyr')
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'], [
+            {'id': created, 'snippet': question['question']}])
+        self.client().delete('/questions/{}'.format(created))
+        res = self.client().get('/questions/suggest?q=zephyr')
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'], [])
+
+        # nothing typed yet or too much typed
+        res = self.client().get('/questions/suggest?q=')
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'], [])
+        res = self.client().get('/questions/suggest?q=' + 'a' * 201)
+        self.assertEqual(res.status_code, 400)
+
+    def test_suggestions_follow_other_workers(self):
+        """Tests the suggestion index reloads after another worker writes"""
+        settings = {'CHANGE_SYNC_INTERVAL': 0}
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings).test_client()
+        question = dict(self.new_question,
+                        question='Which zephyrine wind blows from the west?')
+
+        # the index of the second worker is built before the write
+        res = second.get('/questions/suggest?q=zephyr')
+        self.assertEqual(json.loads(res.data)['questions'], [])
+
+        # it suggests the question created through the first worker
+        created = json.loads(first.post('/questions', json=question).data)[
+            'created']
+        res = second.get('/questions/suggest?q=zephyr')
+        self.assertEqual(json.loads(res.data)['questions'], [
+            {'id': created, 'snippet': question['question']}])
+
+        # and no longer once deleted there
+        first.delete('/questions/{}'.format(created))
+        res = second.get('/questions/suggest?q=zephyr')
+        self.assertEqual(json.loads(res.data)['questions'], [])
+
+    def test_suggestion_index_keeps_changes_during_build(self):
+        """Tests changes committed while the index loads are applied"""
+        index = SuggestionIndex()
+        load = index.load
+
+        # a question is committed once the rows are read
+        def racing_load():
+            loaded = load()
+            index.on_change('insert', {'id': 1000,
+                                       'question': 'Which zephyrine wind?'})
+            return loaded
+
+        index.load = racing_load
+        with self.app.app_context():
+            self.assertEqual(index.suggest('zephyr', 5),
+                             [(1000, 'Which zephyrine wind?')])
+        self.assertIsNone(index.backlog)
+
+    def test_search_index_follows_other_workers(self):
+        """Tests the search index reloads after another worker writes"""
+        settings = {'SEARCH_BACKEND': 'memory', 'CHANGE_SYNC_INTERVAL': 0}
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings).test_client()
+        search = {'searchTerm': 'zephyrine'}
+        question = dict(self.new_question,
+                        question='Which zephyrine wind blows from the west?')
+
+        # the index of the second worker is built before the write
+        res = second.post('/questions/search', json=search)
+        self.assertEqual(json.loads(res.data)['total_questions'], 0)
+
+        # it finds the question created through the first worker
+        created = json.loads(first.post('/questions', json=question).data)[
+            'created']
+        res = second.post('/questions/search', json=search)
+        data = json.loads(res.data)
+        self.assertEqual([found['id'] for found in data['questions']],
+                         [created])
+
+        # and no longer counts it once deleted there
+        first.delete('/questions/{}'.format(created))
+        res = second.post('/questions/search', json=search)
+        self.assertEqual(json.loads(res.data)['total_questions'], 0)
+
+    def test_serialised_responses_match_jsonify(self):
+        """Tests listings are encoded byte for byte like jsonify"""
+
+        # create a question with characters escaped by jsonify
+        question = dict(self.new_question,
+                        question='Où est le café \u2615 \U0001F600 "x"?')
+        self.client().post('/questions', json=question)
+
+        for res in (
+                self.client().get('/questions?page=2'),
+                self.client().get('/categories'),
+                self.client().get('/categories/1/questions'),
+                self.client().post('/questions/search',
+                                   json={'searchTerm': 'café'})):
+            data = json.loads(res.data)
+            # compact, sorted and ASCII only like jsonify
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.data, (json.dumps(
+                data, sort_keys=True, separators=(',', ':')) + '\n'
+                ).encode('ascii'))
+
     def test_retrieve_questions_by_category(self):
         """Tests retrieve questions by category success"""
 
@@ -270,6 +788,160 @@ class TriviaTestCase(unittest.TestCase):
         # check that question returned is in Expected questions list
         self.assertIn(data['question']['id'], [3, 5, 22, 23])
 
+    def test_play_quiz_never_repeats_previous_questions(self):
+        """Tests playing quiz with almost every question played"""
+
+        # all questions in History Category are [3,5,8,18,22,23]
+        # only question 23 is left to play, then nothing is left
+        json_dict = {'previous_questions': [3, 5, 8, 18, 22],
+                     'quiz_category': {'type': 'History', 'id': 4}}
+        response = self.client().post('/quizzes', json=json_dict)
+        data = json.loads(response.data)
+
+        # check that the only question left is returned
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question']['id'], 23)
+
+        # check that no question is returned once all are played
+        json_dict['previous_questions'].append(23)
+        response = self.client().post('/quizzes', json=json_dict)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['question'], None)
+
+    def test_play_adaptive_quiz(self):
+        """Tests adaptive quiz steering difficulty by accuracy"""
+
+        # History questions by difficulty: 1: [5], 2: [3, 8], 3: [22, 23],
+        # 4: [18], difficulties range from 1 to 4 in the whole bank.
+        # five right answers out of five aim at difficulty 4
+        json_dict = {'previous_questions': [1, 2, 3, 8, 9],
+                     'correct_answers': 5, 'mode': 'adaptive',
+                     'quiz_category': {'type': 'History', 'id': 4}}
+        response = self.client().post('/quizzes', json=json_dict)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question']['id'], 18)
+
+        # one right answer aims at difficulty 2, all played, then 1
+        json_dict['correct_answers'] = 1
+        response = self.client().post('/quizzes', json=json_dict)
+        data = json.loads(response.data)
+        self.assertEqual(data['question']['id'], 5)
+
+        # more right answers than questions played is rejected
+        json_dict['correct_answers'] = 6
+        response = self.client().post('/quizzes', json=json_dict)
+        self.assertEqual(response.status_code, 400)
+
+    def test_adaptive_quiz_weights_follow_ratings(self):
+        """Tests rating updates reweight the adaptive quiz index"""
+
+        # build the index with a first draw
+        self.client().post('/quizzes', json={
+            'previous_questions': [], 'mode': 'adaptive',
+            'quiz_category': {'type': 'History', 'id': 4}})
+        bucket = self.app.extensions['adaptive_index'].buckets[(4, 3)]
+
+        # question 23 weighs its new rating after the update
+        self.client().patch('/questions/23', json={'rating': 5})
+        position = bucket.positions[23]
+        self.assertEqual(bucket.tree.weights[position], 5)
+        self.client().patch('/questions/23', json={'rating': 4})
+        self.assertEqual(bucket.tree.weights[position], 4)
+
+    def test_adaptive_quiz_follows_other_workers(self):
+        """Tests the adaptive index reloads after another worker writes"""
+        settings = {'CHANGE_SYNC_INTERVAL': 0}
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings)
+        previous = [question_id for question_id, in db.session.query(
+            Question.id).filter(Question.category == 1)]
+        body = {'previous_questions': previous, 'mode': 'adaptive',
+                'quiz_category': {'type': 'Science', 'id': 1}}
+
+        # the index of the second worker is built before the write
+        res = second.test_client().post('/quizzes', json=body)
+        self.assertIsNone(json.loads(res.data)['question'])
+
+        # it draws the question created through the first worker
+        created = json.loads(first.post(
+            '/questions', json=self.new_question).data)['created']
+        res = second.test_client().post('/quizzes', json=body)
+        self.assertEqual(json.loads(res.data)['question']['id'], created)
+
+        # and forgets it once deleted there
+        first.delete('/questions/{}'.format(created))
+        res = second.test_client().post('/quizzes', json=body)
+        self.assertIsNone(json.loads(res.data)['question'])
+        self.assertNotIn(created,
+                         second.extensions['adaptive_index'].placements)
+
+    def test_ratings_of_other_workers_apply_in_place(self):
+        """Tests a rating written elsewhere reloads none of the indexes"""
+        settings = {'CHANGE_SYNC_INTERVAL': 0, 'SEARCH_BACKEND': 'memory',
+                    'QUESTION_STORE': 'columnar'}
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings)
+        client = second.test_client()
+        rating = Question.query.get(23).rating
+        body = {'previous_questions': [], 'mode': 'adaptive',
+                'quiz_category': {'type': 'History', 'id': 4}}
+
+        # the indexes of the second worker are built before the write
+        client.post('/questions/search', json={'searchTerm': 'country'})
+        client.get('/questions/suggest?q=count')
+        client.post('/quizzes', json=body)
+        store = second.extensions['question_store']
+        postings = second.extensions['search_backend'].postings
+        tokens = second.extensions['suggestion_index'].tokens
+        bucket = second.extensions['adaptive_index'].buckets[(4, 3)]
+        ids = store.columns['id']
+
+        first.patch('/questions/23', json={'rating': rating % 5 + 1})
+        self.addCleanup(first.patch, '/questions/23',
+                        json={'rating': rating})
+        client.post('/questions/search', json={'searchTerm': 'country'})
+        client.get('/questions/suggest?q=count')
+        client.post('/quizzes', json=body)
+
+        # the new rating is applied in place
+        self.assertIs(second.extensions['search_backend'].postings, postings)
+        self.assertIs(second.extensions['suggestion_index'].tokens, tokens)
+        self.assertIs(second.extensions['adaptive_index'].buckets[(4, 3)],
+                      bucket)
+        self.assertEqual(bucket.tree.weights[bucket.positions[23]],
+                         rating % 5 + 1)
+        self.assertIs(store.columns['id'], ids)
+        with second.app_context():
+            self.assertEqual(store.get(23).rating, rating % 5 + 1)
+
+    def test_search_indexes_ignore_ratings(self):
+        """Tests new ratings leave the search and suggestion indexes"""
+        app = create_app('testing', {'SEARCH_BACKEND': 'memory'})
+        client = app.test_client()
+        client.post('/questions/search', json={'searchTerm': 'country'})
+        client.get('/questions/suggest?q=count')
+        search = app.extensions['search_backend']
+        suggestions = app.extensions['suggestion_index']
+        tokens = search.documents[23]
+        document = suggestions.documents[23]
+
+        # a rating of this worker is not sent to the indexes
+        rating = Question.query.get(23).rating
+        client.patch('/questions/23', json={'rating': rating % 5 + 1})
+        client.patch('/questions/23', json={'rating': rating})
+        self.assertIs(search.documents[23], tokens)
+        self.assertIs(suggestions.documents[23], document)
+
+        # nor is a change of its category reindexed
+        record = dict(Question.query.get(23).format(), category=1)
+        search.on_change('update', record)
+        suggestions.on_change('update', record)
+        self.assertIs(search.documents[23], tokens)
+        self.assertIs(suggestions.documents[23], document)
+
     def test_play_quiz_fails(self):
         """Tests playing quiz failure 400"""
 
@@ -284,6 +956,293 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Bad Request')
 
+    def test_request_validation(self):
+        """Tests malformed requests are refused before any query"""
+        statements = []
+        # the first request checks the tables once
+        self.client().get('/categories')
+
+        def count(*arguments):
+            statements.append(arguments[2])
+        event.listen(Engine, 'before_cursor_execute', count)
+        try:
+            requests = [
+                ('post', '/questions', {'question': 'Why?', 'answer': 7},
+                 422),
+                ('post', '/questions', {'question': 'Why?', 'answer': 'x',
+                                        'category': 'Science'}, 422),
+                ('post', '/quizzes', {
+                    'previous_questions': list(range(1001)),
+                    'quiz_category': {'type': 'click', 'id': 0}}, 400),
+                ('post', '/quizzes', {
+                    'previous_questions': ['one'],
+                    'quiz_category': {'type': 'Science', 'id': 1}}, 400),
+                ('post', '/quizzes', {'previous_questions': [],
+                                      'quiz_category': {'type': 'Art'}},
+                 400),
+                ('post', '/questions/search', {'searchTerm': 'a' * 201},
+                 400),
+                ('post', '/questions/search', {'searchTerm': 'a',
+                                               'page': 0}, 400),
+                ('patch', '/questions/5', {'rating': 'high'}, 400),
+                ('patch', '/questions', {'ratings': [{'id': 5}]}, 400),
+                ('post', '/quizzes/sessions', [], 400),
+            ]
+            for method, path, body, status in requests:
+                res = getattr(self.client(), method)(path, json=body)
+                self.assertEqual(res.status_code, status, (path, body))
+                self.assertEqual(json.loads(res.data)['success'], False)
+
+            # bodies over JSON_MAX_BYTES are refused without reading them
+            res = self.client().post('/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'type': 'x' * 70000, 'id': 1}})
+            self.assertEqual(res.status_code, 413)
+            self.assertEqual(json.loads(res.data)['message'],
+                             'Request Entity Too Large')
+
+            # and so are chunked bodies, which have no Content-Length
+            body = json.dumps({'previous_questions': [],
+                               'quiz_category': {'type': 'x' * 70000}})
+            res = self.client().post(
+                '/quizzes', input_stream=io.BytesIO(body.encode()),
+                content_type='application/json',
+                headers={'Transfer-Encoding': 'chunked'},
+                environ_overrides={'wsgi.input_terminated': True})
+            self.assertEqual(res.status_code, 413)
+        finally:
+            event.remove(Engine, 'before_cursor_execute', count)
+        self.assertEqual(statements, [])
+
+        # integer strings of the frontend are accepted
+        res = self.client().post('/quizzes', json={
+            'previous_questions': ['3', 5],
+            'quiz_category': {'type': 'History', 'id': '4'}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(data['question']['id'], [3, 5])
+
+    def test_malformed_schema_fails_at_startup(self):
+        """Tests the request schemas are checked when they are compiled"""
+        config = self.app.config
+        self.assertEqual(set(compile_schemas(config)), set(REQUEST_SCHEMAS))
+        for field in (Field('float'), Field('int', maximum='UNKNOWN_KEY'),
+                      Field('object'), Field('str', items=Field('int'))):
+            with self.assertRaises(ValueError):
+                Validator(Schema({'broken': field}), config)
+
+    def test_rate_limiting(self):
+        """Tests the rate and concurrency limits of the expensive routes"""
+        app = create_app('testing', settings={
+            'RATE_LIMIT_ENABLED': True,
+            'RATE_LIMITS': 'search_questions=1:2',
+            'EXPENSIVE_MAX_CONCURRENT': 1, 'EXPENSIVE_QUEUE_TIMEOUT': 0})
+        client = app.test_client()
+        search = {'searchTerm': 'title'}
+
+        # a burst of two searches, then the client waits for a token
+        for _ in range(2):
+            res = client.post('/questions/search', json=search)
+            self.assertEqual(res.status_code, 200)
+        res = client.post('/questions/search', json=search)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['message'], 'Too Many Requests')
+        self.assertEqual(res.headers['Retry-After'], '1')
+
+        # other clients and other routes are not limited
+        res = client.post('/questions/search', json=search,
+                          environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(res.status_code, 200)
+        res = client.get('/questions')
+        self.assertEqual(res.status_code, 200)
+
+        # with every slot busy the expensive routes are unavailable
+        admission_control = app.extensions['admission_control']
+        self.assertIsNone(admission_control.enter('other', None, 0))
+        try:
+            res = client.post('/quizzes', json={
+                'previous_questions': [],
+                'quiz_category': {'type': 'click', 'id': 0}})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res.headers['Retry-After'], '1')
+        finally:
+            admission_control.leave()
+        res = client.post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0}})
+        self.assertEqual(res.status_code, 200)
+
+    def test_asgi_error_messages(self):
+        """Tests the native routes answer the errors of the Flask views"""
+        app = create_app('testing')
+        for status in app.error_handler_spec[None]:
+            with app.test_request_context():
+                response = app.make_response(app.handle_http_exception(
+                    default_exceptions[status]()))
+            self.assertEqual(json.loads(response.data)['message'],
+                             ERROR_MESSAGES[status])
+
+    def test_asgi_store_reloads_in_thread_pool(self):
+        """Tests the native quiz route reloads the store off the loop"""
+        application = create_asgi_app('testing', {
+            'QUESTION_STORE': 'columnar', 'CHANGE_SYNC_INTERVAL': 3600})
+        store = application.app.extensions['question_store']
+        reset = store.reset
+        threads = []
+
+        def recorded_reset(*arguments):
+            threads.append(threading.get_ident())
+            reset(*arguments)
+
+        store.reset = recorded_reset
+        body = {'previous_questions': [3, 5, 8, 18, 22],
+                'quiz_category': {'type': 'History', 'id': 4}}
+        status, data = asgi_request(application, 'POST', '/quizzes', body)
+        self.assertEqual(data['question']['id'], 23)
+        self.assertEqual(threads, [])
+
+        # a stale store reloads in a thread of the pool
+        store.stale = True
+        status, data = asgi_request(application, 'POST', '/quizzes', body)
+        self.assertEqual(data['question']['id'], 23)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+        self.assertFalse(store.stale)
+
+    def test_rate_limiting_asgi(self):
+        """Tests the native ASGI routes share the rate limits"""
+        application = create_asgi_app('testing', {
+            'RATE_LIMIT_ENABLED': True, 'RATE_LIMITS': 'play_quiz=1:1'})
+        body = {'previous_questions': [],
+                'quiz_category': {'type': 'click', 'id': 0}}
+        status, data = asgi_request(application, 'POST', '/quizzes', body)
+        self.assertEqual(status, 200)
+        status, data = asgi_request(application, 'POST', '/quizzes', body)
+        self.assertEqual(status, 429)
+        self.assertEqual(data['message'], 'Too Many Requests')
+
+        # clients behind a trusted proxy have their own buckets
+        application = create_asgi_app('testing', {
+            'RATE_LIMIT_ENABLED': True, 'RATE_LIMITS': 'play_quiz=1:1',
+            'RATE_LIMIT_TRUSTED_PROXIES': 1})
+        for address in ('203.0.113.1', '203.0.113.2'):
+            status, data = asgi_request(
+                application, 'POST', '/quizzes', body,
+                [(b'x-forwarded-for', address.encode())])
+            self.assertEqual(status, 200)
+
+        # with every slot busy the native routes are unavailable
+        application = create_asgi_app('testing', {
+            'RATE_LIMIT_ENABLED': True, 'RATE_LIMITS': '',
+            'EXPENSIVE_MAX_CONCURRENT': 1, 'EXPENSIVE_QUEUE_TIMEOUT': 0})
+
+        async def play_while_busy():
+            slots = application.loop_slots()
+            await slots.acquire()
+            try:
+                busy = await asgi_call(application, 'POST', '/quizzes', body)
+            finally:
+                slots.release()
+            return busy, await asgi_call(application, 'POST', '/quizzes',
+                                         body)
+
+        (status, data), (free, _) = asyncio.run(play_while_busy())
+        self.assertEqual(status, 503)
+        self.assertEqual(data['message'], 'Service Unavailable')
+        self.assertEqual(free, 200)
+
+    def test_rate_limiting_behind_proxy(self):
+        """Tests the clients behind trusted proxies have their own rate"""
+        settings = {'RATE_LIMIT_ENABLED': True,
+                    'RATE_LIMITS': 'search_questions=1:1'}
+        search = {'searchTerm': 'title'}
+
+        # the forwarded address is ignored without trusted proxies
+        client = create_app('testing', settings).test_client()
+        statuses = [client.post('/questions/search', json=search, headers={
+            'X-Forwarded-For': address}).status_code
+            for address in ('203.0.113.1', '203.0.113.2')]
+        self.assertEqual(statuses, [200, 429])
+
+        # behind one proxy the client is its last X-Forwarded-For entry,
+        # the entries sent by the client itself are not trusted
+        client = create_app('testing', dict(
+            settings, RATE_LIMIT_TRUSTED_PROXIES=1)).test_client()
+        statuses = [client.post('/questions/search', json=search, headers={
+            'X-Forwarded-For': address}).status_code
+            for address in ('203.0.113.1', '203.0.113.2',
+                            '198.51.100.9, 203.0.113.1')]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_quiz_session(self):
+        """Tests playing a whole quiz session success"""
+
+        # start a session in History category [3,5,8,18,22,23]
+        json_dict = {'quiz_category': {'type': 'History', 'id': 4}}
+        response = self.client().post('/quizzes/sessions', json=json_dict)
+        data = json.loads(response.data)
+
+        # check response status code and message
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 6)
+        session_id = data['session_id']
+
+        # play every question of the session
+        played = []
+        for _ in range(6):
+            response = self.client().post(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['question']['category'], 4)
+            played.append(data['question']['id'])
+
+        # check that questions are never repeated
+        self.assertEqual(sorted(played), [3, 5, 8, 18, 22, 23])
+
+        # check that no question is left to play
+        response = self.client().post(
+            '/quizzes/sessions/{}/next'.format(session_id))
+        data = json.loads(response.data)
+        self.assertEqual(data['question'], None)
+
+        # end the session
+        response = self.client().delete(
+            '/quizzes/sessions/{}'.format(session_id))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], session_id)
+
+    def test_quiz_session_max_questions(self):
+        """Tests a quiz session keeps at most its maximum of questions"""
+        client = create_app('testing', {
+            'QUIZ_SESSION_MAX_QUESTIONS': 2}).test_client()
+        data = json.loads(client.post('/quizzes/sessions', json={
+            'quiz_category': {'type': 'History', 'id': 4}}).data)
+        self.assertEqual(data['total_questions'], 2)
+
+        # two distinct questions of the category, then none
+        path = '/quizzes/sessions/{}/next'.format(data['session_id'])
+        played = [json.loads(client.post(path).data)['question']
+                  for _ in range(3)]
+        self.assertIsNone(played[2])
+        self.assertEqual(len({question['id'] for question in played[:2]}), 2)
+        self.assertTrue(set(question['id'] for question in played[:2]) <=
+                        {3, 5, 8, 18, 22, 23})
+
+    def test_404_if_quiz_session_does_not_exist(self):
+        """Tests next question of unknown quiz session failure 404"""
+
+        response = self.client().post('/quizzes/sessions/unknown/next')
+        data = json.loads(response.data)
+
+        # check response status code and message
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'Resource Not Found')
+
     def test_update_question_rating(self):
         """Tests update question rating success"""
 
@@ -316,6 +1275,738 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'Resource Not Found')
 
+    def test_update_question_ratings_in_batch(self):
+        """Tests batch update of question ratings"""
+        # keep the ratings to restore them
+        ratings = {question.id: question.rating for question in
+                   Question.query.filter(Question.id.in_([9, 10]))}
+
+        # the last rating of an id wins, unknown ids are skipped
+        res = self.client().patch('/questions', json={'ratings': [
+            {'id': 9, 'rating': 1}, {'id': 10, 'rating': 2},
+            {'id': 9, 'rating': 5}, {'id': 1000, 'rating': 3}]})
+        data = json.loads(res.data)
+
+        # check response status code and reported ids
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['updated'], [9, 10])
+        self.assertEqual(data['not_found'], [1000])
+
+        # check that the ratings were written
+        db.session.expire_all()
+        self.assertEqual(Question.query.get(9).rating, 5)
+        self.assertEqual(Question.query.get(10).rating, 2)
+
+        self.client().patch('/questions', json={'ratings': [
+            {'id': question_id, 'rating': rating}
+            for question_id, rating in ratings.items()]})
+
+    def test_400_for_malformed_rating_batch(self):
+        """Tests batch update of question ratings failure 400"""
+        for body in ({}, {'ratings': []}, {'ratings': [{'id': 9}]},
+                     {'ratings': [{'id': 9, 'rating': 'high'}]}):
+            res = self.client().patch('/questions', json=body)
+            data = json.loads(res.data)
+
+            # check response status code and message
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    def test_400_for_rating_out_of_range(self):
+        """Tests ratings are refused outside of 1 to 5 stars"""
+        for rating in (0, 6, 2 ** 70):
+            res = self.client().patch('/questions/9',
+                                      json={'rating': rating})
+            self.assertEqual(res.status_code, 400)
+            res = self.client().patch('/questions', json={
+                'ratings': [{'id': 9, 'rating': rating}]})
+            self.assertEqual(res.status_code, 400)
+            res = self.client().post('/questions', json=dict(
+                self.new_question, rating=rating))
+            self.assertEqual(res.status_code, 422)
+
+    def test_rating_buffer_drops_refused_ratings(self):
+        """Tests a rating the database refuses does not block the others"""
+        app = create_app('testing', {'RATING_FLUSH_INTERVAL': 3600})
+        buffer = app.extensions['rating_buffer']
+        rating = Question.query.get(10).rating
+
+        # a temporary error keeps the batch for the next flush
+        write = buffer.write
+
+        def unavailable(ratings):
+            raise OperationalError('UPDATE', {}, Exception('locked'))
+        buffer.write = unavailable
+        buffer.submit({10: 4})
+        with self.assertRaises(OperationalError):
+            buffer.flush()
+        self.assertEqual(buffer.pending, {10: 4})
+
+        # a rating out of the column's range is dropped, not retried
+        buffer.write = write
+        buffer.submit({9: 2 ** 70})
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(buffer.pending, {})
+        db.session.expire_all()
+        self.assertEqual(Question.query.get(10).rating, 4)
+
+        buffer.submit({10: rating})
+        buffer.close()
+
+    def test_rating_buffer_coalesces_updates(self):
+        """Tests buffered ratings are coalesced, logged and replayed"""
+        log_dir = tempfile.mkdtemp()
+        rating = Question.query.get(10).rating
+
+        # a log left by a dead worker is replayed on startup
+        with open(os.path.join(log_dir, 'ratings-999999.log'), 'w') as log:
+            log.write('{"id": 10, "rating": 1}\n{"id": 10, "rating": 2}\n'
+                      '{"id": 10, "rat')
+        app = create_app('testing', {'RATING_FLUSH_INTERVAL': 3600,
+                                     'RATING_LOG_DIR': log_dir})
+        buffer = app.extensions['rating_buffer']
+        db.session.expire_all()
+        self.assertEqual(Question.query.get(10).rating, 2)
+        self.assertFalse(os.path.exists(
+            os.path.join(log_dir, 'ratings-999999.log')))
+
+        # so is the log of a dead worker whose pid this process reuses
+        with open(os.path.join(log_dir, 'ratings-{}.log'.format(
+                os.getpid())), 'w') as log:
+            log.write('{"id": 10, "rating": 5}\n')
+        other = create_app('testing', {'RATING_FLUSH_INTERVAL': 3600,
+                                       'RATING_LOG_DIR': log_dir})
+        db.session.expire_all()
+        self.assertEqual(Question.query.get(10).rating, 5)
+        self.assertFalse(os.path.exists(os.path.join(
+            log_dir, 'ratings-{}.log'.format(os.getpid()))))
+        other.extensions['rating_buffer'].close()
+
+        # two updates of a question wait in the buffer as one
+        client = app.test_client()
+        client.patch('/questions/10', json={'rating': 4})
+        res = client.patch('/questions/10', json={'rating': 3})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(buffer.pending, {10: 3})
+        db.session.expire_all()
+        self.assertEqual(Question.query.get(10).rating, 5)
+        self.assertEqual(RatingLog.read(buffer.log.path), {10: 3})
+
+        # one flush writes them and empties the log
+        self.assertEqual(buffer.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(Question.query.get(10).rating, 3)
+        self.assertEqual(RatingLog.read(buffer.log.path), {})
+
+        buffer.submit({10: rating})
+        buffer.close()
+
+    def test_read_replica_routing(self):
+        """Tests reads go to the replica until the client writes"""
+
+        # a replica lagging behind with a single question
+        replica_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(replica_dir.cleanup)
+        replica_uri = 'sqlite:///' + os.path.join(replica_dir.name,
+                                                  'replica.db')
+        engine = create_engine(replica_uri)
+        self.addCleanup(engine.dispose)
+        db.Model.metadata.create_all(engine)
+        engine.execute(Question.__table__.insert(), [{
+            'id': 1, 'question': 'Only on the replica?', 'answer': 'Yes',
+            'category': 1, 'difficulty': 1, 'rating': 1}])
+        app = create_app('testing', {
+            'SQLALCHEMY_REPLICA_URIS': [replica_uri],
+            'HTTP_CACHE_BACKEND': 'none'})
+        client = app.test_client()
+
+        # GET routes and quizzes read from the replica
+        data = json.loads(client.get('/questions?page=1').data)
+        self.assertEqual(data['total_questions'], 1)
+        data = json.loads(client.post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': {'type': 'click', 'id': 0}}).data)
+        self.assertEqual(data['question']['question'], 'Only on the replica?')
+
+        # a client reads its own writes from the primary
+        rating = Question.query.get(9).rating
+        res = client.patch('/questions/9', json={'rating': rating})
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_recent_write=', res.headers['Set-Cookie'])
+        data = json.loads(client.get('/questions?page=1').data)
+        self.assertGreater(data['total_questions'], 1)
+
+    def test_play_quiz_deck(self):
+        """Tests playing a precomputed deck without any query"""
+
+        # get a deck of the History category
+        res = self.client().post('/quizzes/decks', json={
+            'quiz_category': {'type': 'History', 'id': 4}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 6)
+
+        # walk the deck, each question is served from memory
+        deck_id = data['deck_id']
+        played = []
+        offset = 0
+        while offset is not None:
+            res = self.client().get(
+                '/quizzes/decks/{}/{}'.format(deck_id, offset))
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('sql;desc="0 statements"',
+                          res.headers['Server-Timing'])
+            question = Question.query.get(data['question']['id'])
+            self.assertEqual(data['question'], question.format())
+            played.append(question.id)
+            offset = data['next_offset']
+        self.assertEqual(sorted(played), [3, 5, 8, 18, 22, 23])
+
+        # past the end of the deck there is no question
+        res = self.client().get('/quizzes/decks/{}/6'.format(deck_id))
+        self.assertEqual(json.loads(res.data)['question'], None)
+
+    def test_live_room(self):
+        """Tests a live room played by two players"""
+
+        # the host opens a room of two History questions
+        res = self.client().post('/rooms', json={
+            'quiz_category': {'type': 'History', 'id': 4}, 'questions': 2})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], 2)
+        room_id, host_token = data['room_id'], data['host_token']
+        room = self.app.extensions['live_rooms'].get(room_id)
+
+        # two players join, only the host moves the room on
+        players = []
+        for name in ('Alice', 'Bob'):
+            res = self.client().post('/rooms/{}/players'.format(room_id),
+                                     json={'name': name})
+            players.append(json.loads(res.data)['player_id'])
+        res = self.client().post('/rooms/{}/next'.format(room_id),
+                                 json={'host_token': 'not the host'})
+        self.assertEqual(res.status_code, 403)
+
+        # Alice answers the first question right, once, and Bob wrong
+        res = self.client().post('/rooms/{}/next'.format(room_id),
+                                 json={'host_token': host_token})
+        self.assertEqual(json.loads(res.data)['question_number'], 1)
+        answers = [(players[0], ' ' + room.questions[0]['answer'].upper()),
+                   (players[0], room.questions[0]['answer']),
+                   (players[1], 'no idea')]
+        accepted = []
+        for player_id, answer in answers:
+            res = self.client().post('/rooms/{}/answers'.format(room_id),
+                                     json={'player_id': player_id,
+                                           'answer': answer})
+            accepted.append(json.loads(res.data)['accepted'])
+        self.assertEqual(accepted, [True, False, True])
+
+        # the second question, then the end
+        for _ in range(2):
+            res = self.client().post('/rooms/{}/next'.format(room_id),
+                                     json={'host_token': host_token})
+        self.assertEqual(json.loads(res.data)['finished'], True)
+        res = self.client().post('/rooms/{}/next'.format(room_id),
+                                 json={'host_token': host_token})
+        self.assertEqual(res.status_code, 422)
+
+        # the stream of the finished room replays every event and ends
+        res = self.client().get('/rooms/{}/events'.format(room_id))
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        events = parse_events(res.data)
+        self.assertEqual([name for _, name, _ in events],
+                         ['question', 'results', 'question', 'results',
+                          'end'])
+        self.assertNotIn('answer', events[0][2]['question'])
+        self.assertEqual(events[0][2]['question']['category'], 4)
+        self.assertEqual(events[1][2], {
+            'number': 1, 'answer': room.questions[0]['answer'],
+            'answered': 2, 'correct': 1, 'players': 2})
+        self.assertEqual(events[4][2]['leaders'][0],
+                         {'name': 'Alice', 'score': 1})
+
+        # a reconnecting client gets the events after its last one
+        res = self.client().get('/rooms/{}/events'.format(room_id),
+                                headers={'Last-Event-ID': '3'})
+        self.assertEqual([event_id for event_id, _, _
+                          in parse_events(res.data)], [4, 5])
+
+    def test_live_room_limits(self):
+        """Tests full rooms and closed rooms dropped after their grace"""
+        client = create_app('testing', {
+            'ROOM_MAX_PLAYERS': 1, 'ROOM_CLOSED_TTL': 0}).test_client()
+        data = json.loads(client.post('/rooms', json={
+            'quiz_category': {'type': 'History', 'id': 4},
+            'questions': 1}).data)
+        path = '/rooms/{}'.format(data['room_id'])
+
+        # the second player finds the room full
+        statuses = [client.post(path + '/players', json={
+            'name': name}).status_code for name in ('Alice', 'Bob')]
+        self.assertEqual(statuses, [200, 422])
+
+        # once ended the room is gone after its grace period
+        for _ in range(2):
+            client.post(path + '/next',
+                        json={'host_token': data['host_token']})
+        res = client.get(path + '/events')
+        self.assertEqual(res.status_code, 404)
+
+    def test_live_room_asgi_stream(self):
+        """Tests the ASGI application pushes room events to a stream"""
+        application = create_asgi_app('testing')
+        client = application.app.test_client()
+        data = json.loads(client.post('/rooms', json={
+            'quiz_category': {'type': 'click', 'id': 0},
+            'questions': 2}).data)
+
+        def advance():
+            client.post('/rooms/{}/next'.format(data['room_id']),
+                        json={'host_token': data['host_token']})
+
+        async def listen():
+            messages = []
+            disconnected = asyncio.Event()
+
+            async def receive():
+                await disconnected.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {'type': 'http', 'method': 'GET',
+                     'path': '/rooms/{}/events'.format(data['room_id']),
+                     'query_string': b'', 'headers': []}
+            stream = asyncio.ensure_future(application(scope, receive, send))
+            # the host moves on from other threads while the stream waits
+            loop = asyncio.get_event_loop()
+            for _ in range(3):
+                await asyncio.sleep(0.01)
+                await loop.run_in_executor(None, advance)
+            await asyncio.wait_for(stream, 5)
+            return messages
+
+        messages = asyncio.run(listen())
+        self.assertEqual(messages[0]['status'], 200)
+        events = parse_events(b''.join(message.get('body', b'')
+                                       for message in messages[1:]))
+        self.assertEqual([name for _, name, _ in events],
+                         ['question', 'results', 'question', 'results',
+                          'end'])
+        self.assertEqual(messages[-1]['body'], b'')
+
+    def test_404_for_unknown_live_room(self):
+        """Tests unknown rooms and malformed room requests"""
+        res = self.client().get('/rooms/unknown/events')
+        self.assertEqual(res.status_code, 404)
+        res = self.client().post('/rooms/unknown/players',
+                                 json={'name': 'Alice'})
+        self.assertEqual(res.status_code, 404)
+        res = self.client().post('/rooms', json={
+            'quiz_category': {'type': 'click', 'id': 0}, 'questions': 0})
+        self.assertEqual(res.status_code, 400)
+
+    def test_404_for_unknown_quiz_deck(self):
+        """Tests unknown decks and categories without questions"""
+        res = self.client().get('/quizzes/decks/0123456789ab.4.0/0')
+        self.assertEqual(res.status_code, 404)
+        res = self.client().post('/quizzes/decks', json={
+            'quiz_category': {'type': 'None', 'id': 1000}})
+        self.assertEqual(res.status_code, 404)
+
+    def test_quiz_decks_file_and_rebuild(self):
+        """Tests decks built into a file and rebuilt after changes"""
+        deck_file = os.path.join(tempfile.mkdtemp(), 'decks.bin')
+        settings = {'DECK_FILE': deck_file, 'HTTP_CACHE_BACKEND': 'none'}
+
+        # the command writes the decks the workers map
+        result = create_app('testing', settings).test_cli_runner().invoke(
+            args=['build-decks'])
+        self.assertEqual(result.exit_code, 0)
+        client = create_app('testing', settings).test_client()
+        body = {'quiz_category': {'type': 'Science', 'id': 1}}
+        deck_id = json.loads(client.post('/quizzes/decks', json=body).data)[
+            'deck_id']
+        self.assertIn(deck_id.split('.')[0], result.output)
+        data = json.loads(client.get(
+            '/quizzes/decks/{}/0'.format(deck_id)).data)
+        self.assertEqual(data['question']['category'], 1)
+
+        # a rating keeps the decks, a new question rebuilds them
+        client.patch('/questions/{}'.format(data['question']['id']),
+                     json={'rating': data['question']['rating']})
+        same = json.loads(client.post('/quizzes/decks', json=body).data)
+        self.assertEqual(same['deck_id'].split('.')[0], deck_id.split('.')[0])
+        created = json.loads(client.post(
+            '/questions', json=self.new_question).data)['created']
+        rebuilt = json.loads(client.post('/quizzes/decks', json=body).data)
+        self.assertNotEqual(rebuilt['deck_id'].split('.')[0],
+                            deck_id.split('.')[0])
+        self.assertEqual(rebuilt['total_questions'],
+                         same['total_questions'] + 1)
+
+        # the previous decks are still played
+        res = client.get('/quizzes/decks/{}/0'.format(deck_id))
+        self.assertEqual(res.status_code, 200)
+        client.delete('/questions/{}'.format(created))
+
+    def test_quiz_deck_file_out_of_date(self):
+        """Tests a deck file older than the questions is not served"""
+        deck_file = os.path.join(tempfile.mkdtemp(), 'decks.bin')
+        settings = {'DECK_FILE': deck_file, 'HTTP_CACHE_BACKEND': 'none'}
+        body = {'quiz_category': {'type': 'Science', 'id': 1}}
+        created = json.loads(self.client().post(
+            '/questions', json=self.new_question).data)['created']
+        self.addCleanup(self.client().delete,
+                        '/questions/{}'.format(created))
+        result = create_app('testing', settings).test_cli_runner().invoke(
+            args=['build-decks'])
+        generation = result.output.split()[1]
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings).test_client()
+
+        # the file is served while it matches the questions
+        data = json.loads(first.post('/quizzes/decks', json=body).data)
+        self.assertEqual(data['deck_id'].split('.')[0], generation)
+        total = data['total_questions']
+
+        # a question deleted before a worker mapped the file
+        second.delete('/questions/{}'.format(created))
+        for client in (second, create_app('testing', settings).test_client()):
+            data = json.loads(client.post('/quizzes/decks', json=body).data)
+            self.assertNotEqual(data['deck_id'].split('.')[0], generation)
+            self.assertEqual(data['total_questions'], total - 1)
+
+    def test_quiz_decks_of_other_workers(self):
+        """Tests a deck assigned by a worker is played on the others"""
+        # the versions are only read when a deck is unknown
+        settings = {'HTTP_CACHE_BACKEND': 'none',
+                    'CHANGE_SYNC_INTERVAL': 3600}
+        first = create_app('testing', settings).test_client()
+        second = create_app('testing', settings).test_client()
+        body = {'quiz_category': {'type': 'Science', 'id': 1}}
+
+        # a worker that never built its decks builds them
+        deck_id = json.loads(first.post('/quizzes/decks', json=body).data)[
+            'deck_id']
+        res = second.get('/quizzes/decks/{}/0'.format(deck_id))
+        self.assertEqual(res.status_code, 200)
+
+        # a worker behind the writes of another rebuilds its decks
+        created = json.loads(first.post(
+            '/questions', json=self.new_question).data)['created']
+        try:
+            data = json.loads(first.post('/quizzes/decks', json=body).data)
+            self.assertNotEqual(data['deck_id'], deck_id)
+            res = second.get('/quizzes/decks/{}/0'.format(data['deck_id']))
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['total_questions'],
+                             data['total_questions'])
+        finally:
+            first.delete('/questions/{}'.format(created))
+
+        # unknown decks are still not found
+        res = second.get('/quizzes/decks/0123456789ab.1.0/0')
+        self.assertEqual(res.status_code, 404)
+
+    def test_columnar_question_store(self):
+        """Tests the columnar store serves what the database serves"""
+        snapshot = os.path.join(tempfile.mkdtemp(), 'questions.snapshot')
+        settings = {'HTTP_CACHE_BACKEND': 'none', 'SEARCH_BACKEND': 'ilike'}
+        database = create_app('testing', settings).test_client()
+        columnar = create_app('testing', dict(
+            settings, QUESTION_STORE='columnar', SEARCH_BACKEND='auto',
+            QUESTION_SNAPSHOT=snapshot)).test_client()
+
+        # listings, category pages and searches have the same bodies
+        for path in ('/questions?page=2', '/questions?after_id=9',
+                     '/categories/4/questions'):
+            self.assertEqual(columnar.get(path).data, database.get(path).data)
+        body = {'searchTerm': 'TITLE'}
+        self.assertEqual(
+            columnar.post('/questions/search', json=body).data,
+            database.post('/questions/search', json=body).data)
+
+        # random picks never repeat the previous questions
+        data = json.loads(columnar.post('/quizzes', json={
+            'previous_questions': [3, 5, 8, 18, 22],
+            'quiz_category': {'type': 'History', 'id': 4}}).data)
+        self.assertEqual(data['question']['id'], 23)
+
+        # writes go to the database and update the store
+        created = json.loads(columnar.post(
+            '/questions', json=self.new_question).data)['created']
+        data = json.loads(columnar.post(
+            '/questions/search', json={'searchTerm': 'silicon'}).data)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [created])
+        columnar.patch('/questions/{}'.format(created), json={'rating': 1})
+        data = json.loads(columnar.get(
+            '/questions?after_id={}'.format(created - 1)).data)
+        self.assertEqual(data['questions'][0]['rating'], 1)
+        columnar.delete('/questions/{}'.format(created))
+        self.assertEqual(columnar.get('/questions?page=2').data,
+                         database.get('/questions?page=2').data)
+
+        # the next worker maps the snapshot of the same questions
+        store = create_app('testing', dict(
+            settings, QUESTION_STORE='columnar',
+            QUESTION_SNAPSHOT=snapshot)).extensions['question_store']
+        self.assertIsInstance(store.columns['id'].base, memoryview)
+        self.assertEqual(store.get(23).format(),
+                         Question.query.get(23).format())
+
+    def test_columnar_store_follows_other_workers(self):
+        """Tests a store reloads after the writes of another worker"""
+        settings = {'HTTP_CACHE_BACKEND': 'none', 'QUESTION_STORE': 'columnar',
+                    'CHANGE_SYNC_INTERVAL': 0}
+        first = create_app('testing', settings)
+        second = create_app('testing', settings)
+        store = second.extensions['question_store']
+        self.assertIsNone(store.get(10 ** 6))
+
+        # a question created through the first worker
+        created = json.loads(first.test_client().post(
+            '/questions', json=self.new_question).data)['created']
+        self.assertFalse(first.extensions['question_store'].stale)
+        with second.app_context():
+            self.assertEqual(store.get(created).format(),
+                             Question.query.get(created).format())
+
+        # and deleted through it
+        first.test_client().delete('/questions/{}'.format(created))
+        res = second.test_client().get(
+            '/questions?after_id={}'.format(created - 1))
+        self.assertEqual(res.status_code, 404)
+        with second.app_context():
+            self.assertIsNone(store.get(created))
+
+    def test_diagnostics_pool(self):
+        """Tests connection pool statistics of the worker"""
+
+        # get response and load data
+        res = self.client().get('/diagnostics/pool')
+        data = json.loads(res.data)
+
+        # check status code and statistics
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['pool']['pid'])
+        self.assertTrue(data['pool']['pool'])
+
+    def test_404_if_diagnostics_pool_not_local(self):
+        """Tests connection pool statistics hidden from remote clients"""
+
+        res = self.client().get(
+            '/diagnostics/pool',
+            environ_overrides={'REMOTE_ADDR': '203.0.113.7'})
+
+        # check status code
+        self.assertEqual(res.status_code, 404)
+
+        # a reverse proxy on the same host relays remote clients
+        res = self.client().get(
+            '/diagnostics/pool', headers={'X-Forwarded-For': '203.0.113.7'})
+        self.assertEqual(res.status_code, 404)
+
+        # diagnostics are off unless enabled
+        app = create_app('testing', {'DIAGNOSTICS_ENABLED': False})
+        res = app.test_client().get('/diagnostics/pool')
+        self.assertEqual(res.status_code, 404)
+
+    def test_request_instrumentation(self):
+        """Tests Server-Timing header and per route metrics"""
+
+        # get a page of questions
+        res = self.client().get('/questions?page=1')
+
+        # check the timings of the request
+        self.assertEqual(res.status_code, 200)
+        timing = res.headers['Server-Timing']
+        for phase in ('db;dur=', 'load;dur=', 'serialize;dur=', 'total;dur='):
+            self.assertIn(phase, timing)
+
+        # check the route counters of the worker
+        res = self.client().get('/metrics')
+        metrics = res.get_data(as_text=True)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('trivia_requests_total{route="GET /questions"', metrics)
+        self.assertIn('trivia_statements_total', metrics)
+
+    def test_request_over_query_budget(self):
+        """Tests requests running more statements than the budget"""
+
+        app = create_app('testing', {'QUERY_BUDGET': 0,
+                                     'HTTP_CACHE_BACKEND': 'none'})
+        app.test_client().get('/questions?page=1')
+
+        # check that the request is counted as over budget
+        metrics = app.test_client().get('/metrics').get_data(as_text=True)
+        self.assertRegex(
+            metrics, r'trivia_over_query_budget_total'
+                     r'\{route="GET /questions",pid="\d+"\} 1\n')
+
+    def test_asgi_application(self):
+        """Tests the native and the threaded routes of the ASGI mode"""
+
+        application = create_asgi_app('testing')
+
+        # POST /quizzes runs on the event loop
+        # all questions in History Category are [3,5,8,18,22,23]
+        status, data = asgi_request(application, 'POST', '/quizzes', {
+            'previous_questions': [3, 5, 8, 18, 22],
+            'quiz_category': {'type': 'History', 'id': 4}})
+        self.assertEqual(status, 200)
+        self.assertEqual(data['question']['id'], 23)
+
+        # the adaptive mode runs in the thread pool
+        status, data = asgi_request(application, 'POST', '/quizzes', {
+            'previous_questions': [1, 2, 3, 8, 9], 'correct_answers': 5,
+            'mode': 'adaptive',
+            'quiz_category': {'type': 'History', 'id': 4}})
+        self.assertEqual(status, 200)
+        self.assertEqual(data['question']['id'], 18)
+
+        # malformed quizzes fail like the flask route
+        status, data = asgi_request(application, 'POST', '/quizzes', {})
+        self.assertEqual(status, 400)
+        self.assertEqual(data['message'], 'Bad Request')
+        status, data = asgi_request(application, 'POST', '/quizzes', {
+            'previous_questions': [], 'quiz_category': {'type': 'x' * 70000}})
+        self.assertEqual(status, 413)
+        for length in (b'many', b'-1'):
+            status, data = asgi_request(
+                application, 'POST', '/quizzes', {},
+                [(b'content-length', length)])
+            self.assertEqual(status, 400)
+            self.assertEqual(data['message'], 'Bad Request')
+
+        # other routes run the flask application in the thread pool
+        status, data = asgi_request(application, 'GET', '/questions')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(data['questions']), 10)
+
+    # method for the statistics of the questions, counted one by one
+    def expected_stats(self):
+        db.session.expire_all()
+        stats = {}
+        for question in Question.query.all():
+            category = stats.setdefault(int(question.category), {
+                'total_questions': 0, 'difficulties': {}, 'ratings': []})
+            category['total_questions'] += 1
+            if question.difficulty:
+                key = str(question.difficulty)
+                category['difficulties'][key] = \
+                    category['difficulties'].get(key, 0) + 1
+            if question.rating is not None:
+                category['ratings'].append(question.rating)
+        return stats
+
+    # method for comparing the /stats response with expected_stats
+    def assert_stats(self):
+        expected = self.expected_stats()
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], sum(
+            category['total_questions'] for category in expected.values()))
+        for category in data['categories']:
+            counted = expected.get(category['id'], {
+                'total_questions': 0, 'difficulties': {}, 'ratings': []})
+            self.assertEqual(category['total_questions'],
+                             counted['total_questions'])
+            self.assertEqual(category['difficulties'],
+                             counted['difficulties'])
+            self.assertEqual(category['average_rating'], round(
+                sum(counted['ratings']) / len(counted['ratings']), 2)
+                if counted['ratings'] else None)
+        return data
+
+    def test_category_stats(self):
+        """Tests the category statistics follow the question changes"""
+
+        # recompute the aggregates of the test database
+        result = self.app.test_cli_runner().invoke(args=['refresh-stats'])
+        self.assertEqual(result.exit_code, 0)
+        before = self.assert_stats()
+
+        # a new question is counted in its category
+        res = self.client().post('/questions', json=self.new_question)
+        question_id = json.loads(res.data)['created']
+        data = self.assert_stats()
+        self.assertEqual(data['total_questions'],
+                         before['total_questions'] + 1)
+
+        # a new rating moves the average rating
+        self.client().patch('/questions/{}'.format(question_id),
+                            json={'rating': 5})
+        self.assert_stats()
+
+        # a deleted question is not counted anymore
+        self.client().delete('/questions/{}'.format(question_id))
+        data = self.assert_stats()
+        self.assertEqual(data['categories'], before['categories'])
+
+    def test_lazy_startup_and_create_db_command(self):
+        """Tests the app starts without the database and create-db"""
+
+        # sqlite creates the file on the first connection
+        path = os.path.join(tempfile.mkdtemp(), 'trivia_new.db')
+        app = create_app('testing', settings={
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+        self.assertFalse(os.path.exists(path))
+
+        # create the tables, the migrations find them up to date
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['create-db'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue({'questions', 'categories', 'schema_migrations'}
+                        <= set(create_engine('sqlite:///' + path)
+                               .table_names()))
+        result = runner.invoke(args=['migrate'])
+        self.assertIn('up to date', result.output)
+
+    def test_requests_refused_without_migrations(self):
+        """Tests a database missing migrated tables fails with a message"""
+        with tempfile.TemporaryDirectory() as directory:
+            uri = 'sqlite:///' + os.path.join(directory, 'trivia_old.db')
+            engine = create_engine(uri)
+            Category.__table__.create(engine)
+            Question.__table__.create(engine)
+            engine.dispose()
+            client = create_app('testing', settings={
+                'SQLALCHEMY_DATABASE_URI': uri}).test_client()
+            with self.assertRaisesRegex(
+                    SchemaError, r'no category_stats, change_versions, '
+                                 r'rating_changes tables: run '
+                                 r'`flask migrate`'):
+                client.get('/categories')
+            db.get_engine(client.application).dispose()
+
+    def test_migrate_command(self):
+        """Tests schema migrations are applied once"""
+
+        runner = self.app.test_cli_runner()
+
+        # apply the pending migrations, then check nothing is left
+        result = runner.invoke(args=['migrate'])
+        self.assertEqual(result.exit_code, 0)
+        result = runner.invoke(args=['migrate'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('up to date', result.output)
+
+        # check that category is an integer after the migrations
+        res = self.client().get('/categories/4/questions')
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'][0]['category'], 4)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":